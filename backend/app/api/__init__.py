@@ -14,6 +14,8 @@ from .analytics import analytics_bp
 from .system import system_bp
 from .tag_analytics import tag_analytics_bp
 from .agent_analytics import agent_analytics_bp
+from .jobs import jobs_bp
+from .enrichment import enrichment_bp
 
 # 注册子蓝图
 api_bp.register_blueprint(conversation_bp)
@@ -22,6 +24,8 @@ api_bp.register_blueprint(analytics_bp)
 api_bp.register_blueprint(system_bp)
 api_bp.register_blueprint(tag_analytics_bp)
 api_bp.register_blueprint(agent_analytics_bp)
+api_bp.register_blueprint(jobs_bp)
+api_bp.register_blueprint(enrichment_bp)
 
 # 导入工具函数，方便其他模块使用
 from .utils import make_response, parse_json
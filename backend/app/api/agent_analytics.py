@@ -1,7 +1,15 @@
 from flask import Blueprint, jsonify, request
 from ..database import get_db
+from ..stats import rollups, cube
 import logging
 from .utils import make_response, parse_json
+from .paging import PAGE_SORT, decode_cursor, after_query, split_page
+from .listing import AGENT_LIST_FIELDS, list_projection, fetch_page, decode_list_item, page_sort
+from ..search import search_query
+from .pipelines import (
+    status_percentages, metric_averages, status_count_fields, metric_sum_fields,
+    performance_stage, PERFORMANCE_FIELDS, METRIC_NAMES
+)
 from datetime import datetime, timedelta
 
 # 设置日志
@@ -10,6 +18,18 @@ logger = logging.getLogger(__name__)
 # 创建蓝图，不指定URL前缀，让父蓝图处理
 agent_analytics_bp = Blueprint('agent_analytics', __name__)
 
+# 客服会话列表和表现统计需要读取的字段
+AGENT_PAGE_FIELDS = {
+    **list_projection(AGENT_LIST_FIELDS),
+    'interactionAnalysis.avgResponseTime': 1,
+    'interactionAnalysis.resolutionTime': 1
+}
+
+# 客服列表支持的排序字段
+AGENT_SORT_FIELDS = ['agent', 'count', 'resolved', 'partially_resolved', 'unresolved', 'overall_performance'] + [
+    f'avg_{name}' for name in METRIC_NAMES
+]
+
 @agent_analytics_bp.route("/agent/<agent_name>", methods=['GET'])
 def get_agent_analysis(agent_name):
     """
@@ -18,12 +38,15 @@ def get_agent_analysis(agent_name):
     查询参数:
         page (int): 当前页码，默认为1
         pageSize (int): 每页记录数，默认为10
-        searchText (str): 搜索文本，用于搜索会话ID、客户ID或主要问题
+        after (str): 分页游标，取上一页返回的pagination.next；指定时按游标定位，page仅原样返回
+        searchText (str): 搜索文本，匹配会话ID、客户ID前缀及主要问题、摘要和消息内容，未指定after时按相关度排序且不返回游标
         tag (str): 标签名称
         resolutionStatus (str): 解决状态
         timeStart (str): 开始时间
         timeEnd (str): 结束时间
         
+    count和performance与会话列表使用相同的筛选条件统计。
+        
     返回:
         JSON: {
             "success": bool,
@@ -39,8 +62,8 @@ def get_agent_analysis(agent_name):
                     "avg_attitude": float,
                     "avg_security": float,
                     "overall_performance": float,
-                    "avg_response_time": float,
-                    "avg_resolution_time": float
+                    "avg_response_time": float,  # 秒
+                    "avg_resolution_time": float  # 秒
                 },
                 "conversations": [
                     {
@@ -60,7 +83,8 @@ def get_agent_analysis(agent_name):
                 "pagination": {
                     "current": int,
                     "pageSize": int,
-                    "total": int
+                    "total": int,
+                    "next": str | null
                 }
             },
             "message": str
@@ -73,6 +97,19 @@ def get_agent_analysis(agent_name):
         # 获取查询参数
         page = int(request.args.get('page', 1))
         page_size = int(request.args.get('pageSize', 10))
+        after = request.args.get('after')
+        
+        # 解析分页游标
+        position = None
+        if after:
+            try:
+                position = decode_cursor(after)
+            except ValueError as e:
+                return jsonify(make_response(
+                    success=False,
+                    message=str(e),
+                    data=None
+                )), 400
         
         # 获取筛选参数
         search_text = request.args.get('searchText')
@@ -84,17 +121,9 @@ def get_agent_analysis(agent_name):
         # 构建查询条件
         query = {'agent': agent_name}
         
-        # 文本搜索
+        # 文本搜索：会话ID、客户ID前缀，以及主要问题、摘要和消息内容的全文检索
         if search_text:
-            # 创建文本搜索条件（ID、客户ID或主要问题）
-            text_query = {
-                '$or': [
-                    {'id': {'$regex': search_text, '$options': 'i'}},
-                    {'customerInfo.userId': {'$regex': search_text, '$options': 'i'}},
-                    {'conversationSummary.mainIssue': {'$regex': search_text, '$options': 'i'}}
-                ]
-            }
-            query.update(text_query)
+            query.update(search_query(search_text))
         
         # 标签筛选
         if tag:
@@ -118,8 +147,30 @@ def get_agent_analysis(agent_name):
         # 获取数据库连接
         db = get_db()
         
-        # 计算总数
-        total = db.conversations.count_documents(query)
+        # 单次聚合同时获取当前页会话和筛选结果的统计数据，多取一条用于判断是否有下一页
+        facet_stages = {
+            'stats': [
+                {'$group': {
+                    '_id': None,
+                    'count': {'$sum': 1},
+                    **status_count_fields(),
+                    **metric_sum_fields(),
+                    # 缺少时间指标的会话不参与平均
+                    'response_time_avg': {'$avg': '$interactionAnalysis.avgResponseTime'},
+                    'resolution_time_avg': {'$avg': '$interactionAnalysis.resolutionTime'}
+                }}
+            ]
+        }
+        sort = page_sort(query, position)
+        pipeline = [{'$match': query}]
+        if not position:
+            pipeline.append({'$sort': dict(sort)})
+            facet_stages['page'] = [{'$skip': (page - 1) * page_size}, {'$limit': page_size + 1}]
+        pipeline += [{'$project': AGENT_PAGE_FIELDS}, {'$facet': facet_stages}]
+        result = list(db.conversations.aggregate(pipeline, allowDiskUse=True))
+        facets = result[0] if result else {}
+        stats = facets['stats'][0] if facets.get('stats') else {}
+        total = stats.get('count', 0)
         
         if total == 0:
             logger.warning(f"未找到客服: {agent_name}")
@@ -129,119 +180,40 @@ def get_agent_analysis(agent_name):
                 data=None
             )), 404
         
-        # 分页查询
-        skip = (page - 1) * page_size
-        cursor = db.conversations.find(query).sort('time', -1).skip(skip).limit(page_size)
-        
-        # 获取所有符合条件的会话（用于统计）
-        all_agent_conversations = list(db.conversations.find({'agent': agent_name}))
-        agent_conv_count = len(all_agent_conversations)
-        
-        # 统计不同解决状态的数量
-        resolved_count = 0
-        partially_resolved_count = 0
-        unresolved_count = 0
-        
-        # 计算平均指标
-        agent_total_satisfaction = 0
-        agent_total_resolution = 0
-        agent_total_attitude = 0
-        agent_total_security = 0
-        
-        # 计算响应时间和解决时间
-        agent_total_response_time = 0
-        agent_total_resolution_time = 0
-        
-        for conv in all_agent_conversations:
-            # 统计解决状态
-            resolution_status = conv.get('conversationSummary', {}).get('resolutionStatus', {}).get('status', '')
-            if resolution_status.lower() == '已解决':
-                resolved_count += 1
-            elif resolution_status.lower() == '部分解决':
-                partially_resolved_count += 1
-            else:
-                unresolved_count += 1
-            
-            # 累加各项指标
-            metrics = conv.get('metrics', {})
-            agent_total_satisfaction += metrics.get('satisfaction', {}).get('value', 0)
-            agent_total_resolution += metrics.get('resolution', {}).get('value', 0)
-            agent_total_attitude += metrics.get('attitude', {}).get('value', 0)
-            agent_total_security += metrics.get('security', {}).get('value', 0)
-            
-            # 累加响应时间和解决时间
-            interaction_analysis = conv.get('interactionAnalysis', {})
-            agent_total_response_time += interaction_analysis.get('avgResponseTime', 0)
-            agent_total_resolution_time += interaction_analysis.get('resolutionTime', 0)
-        
-        # 计算客服的各项平均指标
-        agent_avg_satisfaction = agent_total_satisfaction / agent_conv_count if agent_conv_count > 0 else 0
-        agent_avg_resolution = agent_total_resolution / agent_conv_count if agent_conv_count > 0 else 0
-        agent_avg_attitude = agent_total_attitude / agent_conv_count if agent_conv_count > 0 else 0
-        agent_avg_security = agent_total_security / agent_conv_count if agent_conv_count > 0 else 0
-        
-        # 计算平均响应时间和解决时间
-        agent_avg_response_time = agent_total_response_time / agent_conv_count if agent_conv_count > 0 else 0
-        agent_avg_resolution_time = agent_total_resolution_time / agent_conv_count if agent_conv_count > 0 else 0
-        
-        # 计算综合表现指标
-        overall_performance = (
-            agent_avg_satisfaction * 0.25 + 
-            agent_avg_resolution * 0.25 + 
-            agent_avg_security * 0.25 + 
-            agent_avg_attitude * 0.25
-        )
-        
-        # 计算百分比
-        resolved_percentage = (resolved_count / agent_conv_count) * 100 if agent_conv_count > 0 else 0
-        partially_resolved_percentage = (partially_resolved_count / agent_conv_count) * 100 if agent_conv_count > 0 else 0
-        unresolved_percentage = (unresolved_count / agent_conv_count) * 100 if agent_conv_count > 0 else 0
+        # 指定游标时当前页通过索引范围查询单独读取，$facet子管道无法使用索引
+        if position:
+            page_docs = fetch_page(db.conversations, after_query(query, position), AGENT_LIST_FIELDS,
+                                   limit=page_size + 1)
+        else:
+            page_docs = facets.get('page', [])
+        docs, next_after = split_page(page_docs, page_size)
+        if sort != PAGE_SORT:
+            # 按相关度排序时游标无法定位，使用page翻页
+            next_after = None
         
         # 格式化会话数据
-        conversations = []
-        for doc in cursor:
-            # 确保所有必要字段都存在
-            conversations.append({
-                'id': doc.get('id', ''),
-                'title': doc.get('title', '无标题会话'),
-                'time': doc.get('time', ''),
-                'customerId': doc.get('customerInfo', {}).get('userId', '未知用户'),
-                'mainIssue': doc.get('conversationSummary', {}).get('mainIssue', '未分类问题'),
-                'status': doc.get('conversationSummary', {}).get('resolutionStatus', {}).get('status', '未解决'),
-                'satisfaction': doc.get('metrics', {}).get('satisfaction', {}).get('value', 0),
-                'resolution': doc.get('metrics', {}).get('resolution', {}).get('value', 0),
-                'attitude': doc.get('metrics', {}).get('attitude', {}).get('value', 0),
-                'security': doc.get('metrics', {}).get('security', {}).get('value', 0),
-                'tags': doc.get('tags', [])
-            })
+        conversations = [decode_list_item(doc, AGENT_LIST_FIELDS) for doc in docs]
         
         # 构建分页数据
         pagination = {
             'current': page,
             'pageSize': page_size,
-            'total': total
+            'total': total,
+            'next': next_after
         }
         
-        # 构建客服表现数据
-        performance = {
-            'resolved': resolved_percentage,
-            'partially_resolved': partially_resolved_percentage,
-            'unresolved': unresolved_percentage,
-            'avg_satisfaction': agent_avg_satisfaction,
-            'avg_resolution': agent_avg_resolution,
-            'avg_attitude': agent_avg_attitude,
-            'avg_security': agent_avg_security,
-            'overall_performance': overall_performance,
-            'avg_response_time': agent_avg_response_time,
-            'avg_resolution_time': agent_avg_resolution_time
-        }
+        # 构建客服表现数据，统计范围与当前筛选条件一致
+        performance = agent_performance(stats)
+        del performance['count']
+        performance['avg_response_time'] = stats.get('response_time_avg') or 0
+        performance['avg_resolution_time'] = stats.get('resolution_time_avg') or 0
         
         return jsonify(make_response(
             success=True,
             message="获取客服分析数据成功",
             data={
                 "agent": agent_name,
-                "count": agent_conv_count,
+                "count": total,
                 "performance": performance,
                 "conversations": conversations,
                 "pagination": pagination
@@ -260,6 +232,15 @@ def get_all_agents():
     """
     获取所有客服列表及其基本表现数据
     
+    查询参数:
+        timeStart (str): 开始时间，按整天计算
+        timeEnd (str): 结束时间，按整天计算且包含当天
+        tag (str): 标签名称，多个标签使用逗号分隔
+        sort (str): 排序字段，默认为overall_performance
+        order (str): 排序方向，asc或desc，默认为desc
+        page (int): 当前页码，指定page或pageSize时分页返回
+        pageSize (int): 每页记录数，默认为20
+    
     返回:
         JSON: {
             "success": bool,
@@ -279,96 +260,107 @@ def get_all_agents():
             ],
             "message": str
         }
+        分页时data为 {"items": [...], "pagination": {"current": int, "pageSize": int, "total": int}}
     """
     try:
         # 记录请求日志
         logger.info("收到所有客服列表请求")
         
+        # 获取筛选参数
+        time_start = request.args.get('timeStart')
+        time_end = request.args.get('timeEnd')
+        tags = request.args.get('tag')
+        
+        # 获取排序和分页参数
+        sort_field = request.args.get('sort', 'overall_performance')
+        descending = request.args.get('order', 'desc') != 'asc'
+        paginate = 'page' in request.args or 'pageSize' in request.args
+        page = int(request.args.get('page', 1))
+        page_size = int(request.args.get('pageSize', 20))
+        
+        if sort_field not in AGENT_SORT_FIELDS:
+            return jsonify(make_response(
+                success=False,
+                message=f"不支持的排序字段: {sort_field}",
+                data=None
+            )), 400
+        
         # 获取数据库连接
         db = get_db()
         
-        # 获取所有客服
-        agents = db.conversations.distinct('agent')
-        
-        # 客服表现数据列表
-        agent_performance_list = []
+        # 未按标签筛选时优先读取预聚合数据：全量读取汇总，按时间范围读取指标立方体
+        summary = None
+        if not tags:
+            if time_start or time_end:
+                summary = cube.load(db, *cube.day_range(time_start, time_end))
+            else:
+                summary = rollups.load(db)
         
-        for agent_name in agents:
-            # 查询该客服处理的所有会话
-            agent_conversations = list(db.conversations.find({'agent': agent_name}))
-            agent_conv_count = len(agent_conversations)
-            
-            if agent_conv_count == 0:
-                continue
-                
-            # 统计不同解决状态的数量
-            resolved_count = 0
-            partially_resolved_count = 0
-            unresolved_count = 0
-            
-            # 计算平均指标
-            agent_total_satisfaction = 0
-            agent_total_resolution = 0
-            agent_total_attitude = 0
-            agent_total_security = 0
-            
-            for conv in agent_conversations:
-                # 统计解决状态
-                resolution_status = conv.get('conversationSummary', {}).get('resolutionStatus', {}).get('status', '')
-                if resolution_status.lower() == '已解决':
-                    resolved_count += 1
-                elif resolution_status.lower() == '部分解决':
-                    partially_resolved_count += 1
-                else:
-                    unresolved_count += 1
-                
-                # 累加各项指标
-                metrics = conv.get('metrics', {})
-                agent_total_satisfaction += metrics.get('satisfaction', {}).get('value', 0)
-                agent_total_resolution += metrics.get('resolution', {}).get('value', 0)
-                agent_total_attitude += metrics.get('attitude', {}).get('value', 0)
-                agent_total_security += metrics.get('security', {}).get('value', 0)
+        if summary is not None:
+            agent_performance_list = [
+                {'agent': row['key'], **agent_performance(row)}
+                for row in summary['agent']
+            ]
+            agent_performance_list.sort(key=lambda x: x['agent'])
+            agent_performance_list.sort(key=lambda x: x[sort_field], reverse=descending)
+            total = len(agent_performance_list)
+            if paginate:
+                skip = (page - 1) * page_size
+                agent_performance_list = agent_performance_list[skip:skip + page_size]
+        else:
+            # 单次$group聚合在数据库端完成统计、排序和分页
+            query = {'agent': {'$ne': None}}
+            if tags:
+                tag_list = tags.split(',')
+                query['tags'] = tag_list[0] if len(tag_list) == 1 else {'$in': tag_list}
+            if time_start or time_end:
+                query.update(cube.time_match(*cube.day_range(time_start, time_end)))
             
-            # 计算客服的各项平均指标
-            agent_avg_satisfaction = agent_total_satisfaction / agent_conv_count if agent_conv_count > 0 else 0
-            agent_avg_resolution = agent_total_resolution / agent_conv_count if agent_conv_count > 0 else 0
-            agent_avg_attitude = agent_total_attitude / agent_conv_count if agent_conv_count > 0 else 0
-            agent_avg_security = agent_total_security / agent_conv_count if agent_conv_count > 0 else 0
+            sort = {sort_field: -1 if descending else 1}
+            if sort_field != 'agent':
+                sort['agent'] = 1
             
-            # 计算综合表现指标
-            overall_performance = (
-                agent_avg_satisfaction * 0.25 + 
-                agent_avg_resolution * 0.25 + 
-                agent_avg_security * 0.25 + 
-                agent_avg_attitude * 0.25
-            )
-            
-            # 计算百分比
-            resolved_percentage = (resolved_count / agent_conv_count) * 100 if agent_conv_count > 0 else 0
-            partially_resolved_percentage = (partially_resolved_count / agent_conv_count) * 100 if agent_conv_count > 0 else 0
-            unresolved_percentage = (unresolved_count / agent_conv_count) * 100 if agent_conv_count > 0 else 0
-            
-            # 添加客服表现数据
-            agent_performance_list.append({
-                'agent': agent_name,
-                'count': agent_conv_count,
-                'resolved': resolved_percentage,
-                'partially_resolved': partially_resolved_percentage,
-                'unresolved': unresolved_percentage,
-                'avg_satisfaction': agent_avg_satisfaction,
-                'avg_resolution': agent_avg_resolution,
-                'avg_attitude': agent_avg_attitude,
-                'avg_security': agent_avg_security,
-                'overall_performance': overall_performance
-            })
+            pipeline = [
+                {'$match': query},
+                {'$project': PERFORMANCE_FIELDS},
+                {'$group': {
+                    '_id': '$agent',
+                    'count': {'$sum': 1},
+                    **status_count_fields(),
+                    **metric_sum_fields()
+                }},
+                performance_stage('agent'),
+                {'$sort': sort}
+            ]
+            if paginate:
+                pipeline.append({'$facet': {
+                    'items': [{'$skip': (page - 1) * page_size}, {'$limit': page_size}],
+                    'total': [{'$count': 'count'}]
+                }})
+                result = list(db.conversations.aggregate(pipeline, allowDiskUse=True))
+                facets = result[0] if result else {}
+                agent_performance_list = facets.get('items', [])
+                total = facets['total'][0]['count'] if facets.get('total') else 0
+            else:
+                agent_performance_list = list(db.conversations.aggregate(pipeline, allowDiskUse=True))
+                total = len(agent_performance_list)
         
-        # 按综合表现排序
-        agent_performance_list.sort(key=lambda x: x['overall_performance'], reverse=True)
+        if paginate:
+            data = {
+                'items': agent_performance_list,
+                'pagination': {
+                    'current': page,
+                    'pageSize': page_size,
+                    'total': total
+                }
+            }
+        else:
+            data = agent_performance_list
         
         return jsonify(make_response(
             success=True,
             message="获取所有客服列表成功",
-            data=agent_performance_list
+            data=data
         ))
     except Exception as e:
         logger.error(f"获取所有客服列表失败: {str(e)}")
@@ -377,3 +369,29 @@ def get_all_agents():
             message=f"获取所有客服列表失败: {str(e)}",
             data=None
         )), 500
+
+def agent_performance(row):
+    """根据分组统计结果计算客服表现数据
+
+    Args:
+        row: 包含count、resolved_count、partially_resolved_count及各指标总和的统计行
+
+    Returns:
+        客服表现数据字典
+    """
+    averages = metric_averages(row)
+    
+    # 计算综合表现指标
+    overall_performance = (
+        averages['avg_satisfaction'] * 0.25 + 
+        averages['avg_resolution'] * 0.25 + 
+        averages['avg_security'] * 0.25 + 
+        averages['avg_attitude'] * 0.25
+    )
+    
+    return {
+        'count': row.get('count', 0),
+        **status_percentages(row),
+        **averages,
+        'overall_performance': overall_performance
+    }
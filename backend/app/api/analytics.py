@@ -4,8 +4,10 @@
 """
 from flask import Blueprint, request, jsonify
 from ..database import get_db
+from ..stats import rollups, cube, cooccurrence, hotwords
 import logging
 from .utils import make_response
+from .pipelines import dashboard_pipeline, percentage, status_percentages, metric_averages, METRIC_NAMES, STATUS_FIELD
 from datetime import datetime, timedelta
 
 # 设置日志
@@ -18,6 +20,10 @@ analytics_bp = Blueprint('analytics', __name__)
 def get_statistics():
     """获取会话统计数据
     
+    查询参数:
+        timeStart (str): 开始时间，按整天计算
+        timeEnd (str): 结束时间，按整天计算且包含当天
+        
     返回:
         JSON: {
             "success": bool,
@@ -37,32 +43,51 @@ def get_statistics():
         # 获取数据库连接
         db = get_db()
         
-        # 获取总会话数
-        total_conversations = db.conversations.count_documents({})
+        # 优先读取预聚合的汇总数据
+        rollup, match = load_summary(db, request.args.get('timeStart'), request.args.get('timeEnd'))
+        if rollup is not None:
+            return jsonify(make_response(
+                success=True,
+                data={
+                    'totalConversations': rollup['global'].get('count', 0),
+                    'statusStatistics': [
+                        {'status': row['key'], 'count': row['count']}
+                        for row in sorted(rollup['status'], key=lambda row: row['key'])
+                    ],
+                    'agentStatistics': [
+                        {'agent': row['key'], 'count': row['count']}
+                        for row in sorted(rollup['agent'], key=lambda row: row['key'])
+                    ]
+                }
+            ))
         
-        # 按状态统计会话数
-        status_stats = []
-        statuses = db.conversations.distinct('conversationSummary.resolutionStatus.status')
-        for status in statuses:
-            count = db.conversations.count_documents({
-                'conversationSummary.resolutionStatus.status': status
-            })
-            status_stats.append({
-                'status': status,
-                'count': count
-            })
+        # 汇总尚未构建时，单次聚合按状态和客服统计会话数
+        pipeline = [{'$match': match}] if match else []
+        pipeline.append({'$facet': {
+            'total': [{'$count': 'count'}],
+            'status': [
+                {'$match': {'conversationSummary.resolutionStatus.status': {'$ne': None}}},
+                {'$group': {'_id': STATUS_FIELD, 'count': {'$sum': 1}}},
+                {'$sort': {'_id': 1}}
+            ],
+            'agent': [
+                {'$match': {'agent': {'$ne': None}}},
+                {'$group': {'_id': '$agent', 'count': {'$sum': 1}}},
+                {'$sort': {'_id': 1}}
+            ]
+        }})
+        result = list(db.conversations.aggregate(pipeline, allowDiskUse=True))
+        facets = result[0] if result else {}
         
-        # 按客服统计会话数
-        agent_stats = []
-        agents = db.conversations.distinct('agent')
-        for agent in agents:
-            count = db.conversations.count_documents({
-                'agent': agent
-            })
-            agent_stats.append({
-                'agent': agent,
-                'count': count
-            })
+        total_conversations = facets['total'][0]['count'] if facets.get('total') else 0
+        status_stats = [
+            {'status': row['_id'], 'count': row['count']}
+            for row in facets.get('status', [])
+        ]
+        agent_stats = [
+            {'agent': row['_id'], 'count': row['count']}
+            for row in facets.get('agent', [])
+        ]
         
         # 构建响应
         return jsonify(make_response(
@@ -86,6 +111,10 @@ def get_statistics():
 def get_dashboard_data():
     """获取会话分析看板数据
     
+    查询参数:
+        timeStart (str): 开始时间，按整天计算
+        timeEnd (str): 结束时间，按整天计算且包含当天
+        
     返回:
         JSON: {
             "success": bool,
@@ -127,274 +156,44 @@ def get_dashboard_data():
         # 获取数据库连接
         db = get_db()
         
-        # 获取总体指标
-        total_conversations = db.conversations.count_documents({})
-        # 计算平均消息数
-        avg_total_messages_cursor = db.conversations.aggregate([
-            {'$group': {'_id': None, 'avg_total_messages': {'$avg': '$interactionAnalysis.totalMessages'}}}
-        ])
-        avg_total_messages_result = list(avg_total_messages_cursor)
-        avg_total_messages = avg_total_messages_result[0]['avg_total_messages'] if avg_total_messages_result else 0
-
-        # 计算平均客服消息数
-        avg_agent_messages_cursor = db.conversations.aggregate([
-            {'$group': {'_id': None, 'avg_agent_messages': {'$avg': '$interactionAnalysis.agentMessages'}}}
-        ])
-        avg_agent_messages_result = list(avg_agent_messages_cursor)
-        avg_agent_messages = avg_agent_messages_result[0]['avg_agent_messages'] if avg_agent_messages_result else 0
-
-        # 计算平均用户消息数
-        avg_user_messages_cursor = db.conversations.aggregate([
-            {'$group': {'_id': None, 'avg_user_messages': {'$avg': '$interactionAnalysis.userMessages'}}}
-        ])
-        avg_user_messages_result = list(avg_user_messages_cursor)
-        avg_user_messages = avg_user_messages_result[0]['avg_user_messages'] if avg_user_messages_result else 0
-
-        # 计算平均指标
-        global_avg_satisfaction_cursor = db.conversations.aggregate([
-            {'$group': {'_id': None, 'avg_satisfaction': {'$avg': '$metrics.satisfaction.value'}}}
-        ])
-        global_avg_satisfaction_result = list(global_avg_satisfaction_cursor)
-        global_avg_satisfaction = global_avg_satisfaction_result[0]['avg_satisfaction'] if global_avg_satisfaction_result else 0
-        
-        global_avg_resolution_cursor = db.conversations.aggregate([
-            {'$group': {'_id': None, 'avg_resolution': {'$avg': '$metrics.resolution.value'}}}
-        ])
-        global_avg_resolution_result = list(global_avg_resolution_cursor)
-        global_avg_resolution = global_avg_resolution_result[0]['avg_resolution'] if global_avg_resolution_result else 0
-        
-        global_avg_attitude_cursor = db.conversations.aggregate([
-            {'$group': {'_id': None, 'avg_attitude': {'$avg': '$metrics.attitude.value'}}}
-        ])
-        global_avg_attitude_result = list(global_avg_attitude_cursor)
-        global_avg_attitude = global_avg_attitude_result[0]['avg_attitude'] if global_avg_attitude_result else 0
-        
-        global_avg_security_cursor = db.conversations.aggregate([
-            {'$group': {'_id': None, 'avg_security': {'$avg': '$metrics.security.value'}}}
-        ])
-        global_avg_security_result = list(global_avg_security_cursor)
-        global_avg_security = global_avg_security_result[0]['avg_security'] if global_avg_security_result else 0
-
-        # 获取Top标签
-        top_tag_cursor = db.conversations.aggregate([
-            {'$unwind': '$tags'},
-            {'$group': {'_id': '$tags', 'count': {'$sum': 1}}},
-            {'$sort': {'count': -1}},
-            {'$limit': 20}
-        ])
-        top_tag_result = list(top_tag_cursor)
-        top_tag = top_tag_result
-
-        # 获取Top热词
-        top_hotword_cursor = db.conversations.aggregate([
-            {'$unwind': '$hotWords'},
-            {'$group': {'_id': '$hotWords', 'count': {'$sum': 1}}},
-            {'$sort': {'count': -1}},
-            {'$limit': 20}
-        ])
-        top_hotword_result = list(top_hotword_cursor)
-        top_hotword = top_hotword_result
-        
-        # 计算Top标签和热词的百分比
-        for tag in top_tag:
-            tag['percentage'] = (tag['count'] / total_conversations) * 100
-        for hotword in top_hotword:
-            hotword['percentage'] = (hotword['count'] / total_conversations) * 100
-        
-        # 计算标签解决率分布
-        tag_resolution_rates = []
-        
-        # 获取所有标签
-        all_tags_cursor = db.conversations.aggregate([
-            {'$unwind': '$tags'},
-            {'$group': {'_id': '$tags', 'count': {'$sum': 1}}},
-            {'$sort': {'count': -1}}
-        ])
-        
-        all_tags_list = [tag['_id'] for tag in all_tags_cursor]
-        
-        for tag_name in all_tags_list:
-            # 查询包含该标签的会话
-            tag_conversations = list(db.conversations.find({'tags': tag_name}))
-            tag_count = len(tag_conversations)
-            
-            if tag_count == 0:
-                continue
-                
-            # 统计不同解决状态的数量
-            resolved_count = 0
-            partially_resolved_count = 0
-            unresolved_count = 0
-            
-            for conv in tag_conversations:
-                resolution_status = conv.get('conversationSummary', {}).get('resolutionStatus', {}).get('status', '')
-                if resolution_status.lower() == '已解决':
-                    resolved_count += 1
-                elif resolution_status.lower() == '部分解决':
-                    partially_resolved_count += 1
-                else:
-                    unresolved_count += 1
-            
-            # 计算百分比
-            tag_resolution_rates.append({
-                'tag': tag_name,
-                'resolved': (resolved_count / tag_count) * 100,
-                'partially_resolved': (partially_resolved_count / tag_count) * 100,
-                'unresolved': (unresolved_count / tag_count) * 100,
-                'count': tag_count
-            })
-        
-        # 计算标签共现网络
-        tag_cooccurrence = []
-        
-        # 聚合查询获取标签对
-        tag_pairs_cursor = db.conversations.aggregate([
-            {'$match': {'tags': {'$exists': True, '$ne': []}}},
-            {'$project': {'tags': 1}},
-            {'$unwind': '$tags'},
-            {'$unwind': {
-                'path': '$tags',
-                'includeArrayIndex': 'tagIndex'
-            }},
-            {'$group': {
-                '_id': {'conv_id': '$_id', 'tag': '$tags'},
-                'tagIndex': {'$first': '$tagIndex'}
-            }},
-            {'$group': {
-                '_id': '$_id.conv_id',
-                'tags': {'$push': '$_id.tag'}
-            }},
-            {'$match': {'tags.1': {'$exists': True}}},  # 至少有2个标签
-            {'$project': {
-                'tagPairs': {
-                    '$reduce': {
-                        'input': {'$range': [0, {'$size': '$tags'}]},
-                        'initialValue': [],
-                        'in': {
-                            '$concatArrays': [
-                                '$$value',
-                                {
-                                    '$map': {
-                                        'input': {'$range': [{'$add': ['$$this', 1]}, {'$size': '$tags'}]},
-                                        'as': 'j',
-                                        'in': [{'$arrayElemAt': ['$tags', '$$this']}, {'$arrayElemAt': ['$tags', '$$j']}]
-                                    }
-                                }
-                            ]
-                        }
-                    }
-                }
-            }},
-            {'$unwind': '$tagPairs'},
-            {'$group': {
-                '_id': '$tagPairs',
-                'count': {'$sum': 1}
-            }},
-            {'$sort': {'count': -1}},
-            {'$limit': 20}
-        ])
-        
-        tag_pairs_result = list(tag_pairs_cursor)
-        
-        for pair in tag_pairs_result:
-            tag_cooccurrence.append({
-                'tag_pair': pair['_id'],
-                'count': pair['count'],
-                'percentage': (pair['count'] / total_conversations) * 100
-            })
-        
-        # 计算客服服务指标
-        agent_service_rates = []
-        
-        # 获取所有客服
-        agents = db.conversations.distinct('agent')
-        
-        for agent_name in agents:
-            # 查询该客服处理的所有会话
-            agent_conversations = list(db.conversations.find({'agent': agent_name}))
-            agent_conv_count = len(agent_conversations)
-            
-            if agent_conv_count == 0:
-                continue
-                
-            # 统计不同解决状态的数量
-            resolved_count = 0
-            partially_resolved_count = 0
-            unresolved_count = 0
-            
-            # 计算平均指标
-            agent_total_satisfaction = 0
-            agent_total_resolution = 0
-            agent_total_attitude = 0
-            agent_total_security = 0
-            
-            for conv in agent_conversations:
-                # 统计解决状态
-                resolution_status = conv.get('conversationSummary', {}).get('resolutionStatus', {}).get('status', '')
-                if resolution_status.lower() == '已解决':
-                    resolved_count += 1
-                elif resolution_status.lower() == '部分解决':
-                    partially_resolved_count += 1
-                else:
-                    unresolved_count += 1
-                
-                # 累加各项指标
-                metrics = conv.get('metrics', {})
-                agent_total_satisfaction += metrics.get('satisfaction', {}).get('value', 0)
-                agent_total_resolution += metrics.get('resolution', {}).get('value', 0)
-                agent_total_attitude += metrics.get('attitude', {}).get('value', 0)
-                agent_total_security += metrics.get('security', {}).get('value', 0)
-            
-            # 计算客服的各项平均指标
-            agent_avg_satisfaction = agent_total_satisfaction / agent_conv_count if agent_conv_count > 0 else 0
-            agent_avg_resolution = agent_total_resolution / agent_conv_count if agent_conv_count > 0 else 0
-            agent_avg_attitude = agent_total_attitude / agent_conv_count if agent_conv_count > 0 else 0
-            agent_avg_security = agent_total_security / agent_conv_count if agent_conv_count > 0 else 0
-            
-            # 计算综合表现指标
-            overall_performance = (
-                agent_avg_satisfaction * 0.25 + 
-                agent_avg_resolution * 0.25 + 
-                agent_avg_security * 0.25 + 
-                agent_avg_attitude * 0.15
-            )
+        rollup, match = load_summary(db, request.args.get('timeStart'), request.args.get('timeEnd'))
+        if rollup is not None:
+            # 计数和指标读取预聚合汇总；全量看板的热词和标签共现读取增量维护的结构，
+            # 其余部分仍需聚合
+            facets = {}
+            sections = []
+            if match is None and hotwords.is_built(db):
+                facets['hotwords'] = [
+                    {'_id': word, 'count': count}
+                    for word, count, _ in hotwords.load(db, hotwords.GLOBAL_SCOPE).top(20)
+                ]
+            else:
+                sections.append('hotwords')
+            if match is None and cooccurrence.is_built(db):
+                facets['tag_pairs'] = [
+                    {'_id': pair['tag_pair'], 'count': pair['count']}
+                    for pair in cooccurrence.top_pairs(db, 20)
+                ]
+            else:
+                sections.append('tag_pairs')
             
-            # 计算平均值和百分比
-            agent_service_rates.append({
-                'agent': agent_name,
-                'count': agent_conv_count,
-                'resolved': (resolved_count / agent_conv_count) * 100,
-                'partially_resolved': (partially_resolved_count / agent_conv_count) * 100,
-                'unresolved': (unresolved_count / agent_conv_count) * 100,
-                'avg_satisfaction': agent_avg_satisfaction,
-                'avg_resolution': agent_avg_resolution,
-                'avg_attitude': agent_avg_attitude,
-                'avg_security': agent_avg_security,
-                'overall_performance': overall_performance
-            })
+            if sections:
+                result = list(db.conversations.aggregate(
+                    dashboard_pipeline(match=match, sections=sections),
+                    allowDiskUse=True
+                ))
+                facets.update(result[0] if result else {})
+            facets.update(rollup_facets(rollup))
+        else:
+            # 汇总尚未构建时，单次$facet聚合计算全部看板数据
+            result = list(db.conversations.aggregate(dashboard_pipeline(match=match), allowDiskUse=True))
+            facets = result[0] if result else {}
+        data = format_dashboard_data(facets)
         
         # 构建响应
         return jsonify(make_response(
             success=True,
-            data={
-                "overview": {
-                    "totalConversations": total_conversations,
-                    "avg_totalMessages": avg_total_messages,
-                    "avg_agentMessages": avg_agent_messages,
-                    "avg_userMessages": avg_user_messages
-                },
-                "conversationMetrics": {
-                    "avg_satisfaction": global_avg_satisfaction,
-                    "avg_resolution": global_avg_resolution,
-                    "avg_attitude": global_avg_attitude,
-                    "avg_security": global_avg_security
-                },
-                "Top_tags": top_tag,
-                "Top_hotwords": top_hotword,
-                "tag_resolution_rates": tag_resolution_rates,
-                "tag_cooccurrence": tag_cooccurrence,
-                "agent_service_rates": agent_service_rates
-            }
+            data=data
         ))
     except Exception as e:
         logger.error(f"获取看板数据出错: {str(e)}")
@@ -403,3 +202,138 @@ def get_dashboard_data():
             message=f"获取看板数据出错: {str(e)}",
             data={}
         ))
+
+def load_summary(db, time_start=None, time_end=None):
+    """读取预聚合统计
+
+    未指定时间范围时读取全量汇总，否则合并指标立方体中范围内的日桶。
+
+    Args:
+        db: 数据库连接
+        time_start: 开始时间
+        time_end: 结束时间
+
+    Returns:
+        (汇总数据, 等价的会话筛选条件)，汇总尚未构建时汇总数据为None
+    """
+    if time_start or time_end:
+        start_day, end_day = cube.day_range(time_start, time_end)
+        return cube.load(db, start_day, end_day), cube.time_match(start_day, end_day)
+    return rollups.load(db), None
+
+def rollup_facets(rollup):
+    """将汇总文档转换为与看板$facet聚合结果相同的结构
+
+    Args:
+        rollup: rollups.load的返回值
+
+    Returns:
+        包含overview、tags、agents分面的字典
+    """
+    overall = rollup['global']
+    overview = {'total': overall.get('count', 0)}
+    for name in rollups.INTERACTION_FIELDS + METRIC_NAMES:
+        overview[f'avg_{name}'] = rollups.average(overall, name)
+    
+    return {
+        'overview': [overview],
+        'tags': [
+            {**row, '_id': row['key']}
+            for row in sorted(rollup['tag'], key=lambda row: (-row['count'], row['key']))
+        ],
+        'agents': [
+            {**row, '_id': row['key']}
+            for row in sorted(rollup['agent'], key=lambda row: row['key'])
+        ]
+    }
+
+def format_dashboard_data(facets):
+    """将看板$facet聚合结果整理为接口返回格式
+
+    Args:
+        facets: dashboard_pipeline的聚合结果文档
+
+    Returns:
+        看板数据字典
+    """
+    overview = facets.get('overview') or [{}]
+    overview = overview[0]
+    total_conversations = overview.get('total', 0)
+    
+    # Top标签与标签解决率共用同一次分组结果
+    tag_rows = facets.get('tags', [])
+    top_tag = [
+        {
+            '_id': row['_id'],
+            'count': row['count'],
+            'percentage': percentage(row['count'], total_conversations)
+        }
+        for row in tag_rows[:20]
+    ]
+    tag_resolution_rates = [
+        {
+            'tag': row['_id'],
+            **status_percentages(row),
+            'count': row['count']
+        }
+        for row in tag_rows
+    ]
+    
+    top_hotword = [
+        {
+            '_id': row['_id'],
+            'count': row['count'],
+            'percentage': percentage(row['count'], total_conversations)
+        }
+        for row in facets.get('hotwords', [])
+    ]
+    
+    tag_cooccurrence = [
+        {
+            'tag_pair': row['_id'],
+            'count': row['count'],
+            'percentage': percentage(row['count'], total_conversations)
+        }
+        for row in facets.get('tag_pairs', [])
+    ]
+    
+    # 计算客服服务指标
+    agent_service_rates = []
+    for row in facets.get('agents', []):
+        averages = metric_averages(row)
+        
+        # 计算综合表现指标
+        overall_performance = (
+            averages['avg_satisfaction'] * 0.25 + 
+            averages['avg_resolution'] * 0.25 + 
+            averages['avg_security'] * 0.25 + 
+            averages['avg_attitude'] * 0.15
+        )
+        
+        agent_service_rates.append({
+            'agent': row['_id'],
+            'count': row['count'],
+            **status_percentages(row),
+            **averages,
+            'overall_performance': overall_performance
+        })
+    
+    return {
+        "overview": {
+            "totalConversations": total_conversations,
+            "avg_totalMessages": overview.get('avg_totalMessages') or 0,
+            "avg_agentMessages": overview.get('avg_agentMessages') or 0,
+            "avg_userMessages": overview.get('avg_userMessages') or 0
+        },
+        "conversationMetrics": {
+            "avg_satisfaction": overview.get('avg_satisfaction') or 0,
+            "avg_resolution": overview.get('avg_resolution') or 0,
+            "avg_attitude": overview.get('avg_attitude') or 0,
+            "avg_security": overview.get('avg_security') or 0
+        },
+        "Top_tags": top_tag,
+        "Top_hotwords": top_hotword,
+        "tag_resolution_rates": tag_resolution_rates,
+        "tag_cooccurrence": tag_cooccurrence,
+        "agent_service_rates": agent_service_rates
+    }
@@ -2,10 +2,23 @@
 会话管理API模块
 提供会话的增删改查功能
 """
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, current_app
+from pymongo import ReturnDocument
+import copy
+import json
+import time
 from ..database import get_db
+from ..config import Config
+from ..cache import TTLCache
+from .. import stats, ingest, writebehind
 import logging
 from .utils import make_response, parse_json
+from .paging import PAGE_SORT, decode_cursor, after_query, split_page
+from .counting import COUNT_STRATEGIES, count_total
+from .listing import CONVERSATION_LIST_FIELDS, fetch_page, decode_list_item, page_sort
+from ..search import search_query, search_fields, prefix_range, SEARCH_FIELD
+from ..sourcehash import SOURCE_HASH_FIELD
+from ..interaction import interaction_analysis, INTERACTION_FIELD
 
 # 设置日志
 logger = logging.getLogger(__name__)
@@ -13,6 +26,25 @@ logger = logging.getLogger(__name__)
 # 创建蓝图
 conversation_bp = Blueprint('conversation', __name__, url_prefix='/conversations')
 
+# 自动补全结果缓存，新写入的会话最多延迟一个有效期出现在补全结果中
+autocomplete_cache = TTLCache(Config.AUTOCOMPLETE_CACHE_SIZE, Config.AUTOCOMPLETE_CACHE_TTL)
+
+# 自动补全可匹配的字段：(匹配类型, 字段路径)
+AUTOCOMPLETE_FIELDS = [('id', 'id'), ('customerId', 'customerInfo.userId')]
+
+def _apply_set(doc, data):
+    """在文档副本上按$set语义应用更新，支持点分路径，返回更新后的文档"""
+    result = copy.deepcopy(doc)
+    for path, value in data.items():
+        target = result
+        *parents, key = path.split('.')
+        for parent in parents:
+            if not isinstance(target.get(parent), dict):
+                target[parent] = {}
+            target = target[parent]
+        target[key] = value
+    return result
+
 @conversation_bp.route('', methods=['GET'])
 def get_conversations():
     """获取会话列表，支持分页和筛选
@@ -20,12 +52,14 @@ def get_conversations():
     查询参数:
         page (int): 当前页码，默认为1
         pageSize (int): 每页记录数，默认为10
-        searchText (str): 搜索文本，用于搜索会话ID、客户ID或主要问题
+        after (str): 分页游标，取上一页返回的pagination.next；指定时按游标定位，page仅原样返回
+        searchText (str): 搜索文本，匹配会话ID、客户ID前缀及主要问题、摘要和消息内容，未指定after时按相关度排序且不返回游标
         agent (str): 客服名称
         resolutionStatus (str): 解决状态
         tags (str): 标签，多个标签使用逗号分隔
         timeStart (str): 开始时间
         timeEnd (str): 结束时间
+        count (str): 总数统计策略，exact/cached/estimated/capped，默认使用COUNT_STRATEGY配置
         
     返回:
         JSON: {
@@ -35,7 +69,10 @@ def get_conversations():
                 "pagination": {
                     "current": int,
                     "pageSize": int,
-                    "total": int
+                    "total": int,
+                    "totalMode": str,  # 实际使用的总数统计策略
+                    "totalCapped": bool,  # 为true时实际总数超过total
+                    "next": str | null
                 }
             },
             "message": str (可选)
@@ -45,6 +82,27 @@ def get_conversations():
         # 获取查询参数
         page = int(request.args.get('page', 1))
         page_size = int(request.args.get('pageSize', 10))
+        after = request.args.get('after')
+        count_strategy = request.args.get('count', current_app.config.get('COUNT_STRATEGY', 'exact'))
+        
+        if count_strategy not in COUNT_STRATEGIES:
+            return jsonify(make_response(
+                success=False,
+                message=f"不支持的总数统计策略: {count_strategy}",
+                data=None
+            )), 400
+        
+        # 解析分页游标
+        position = None
+        if after:
+            try:
+                position = decode_cursor(after)
+            except ValueError as e:
+                return jsonify(make_response(
+                    success=False,
+                    message=str(e),
+                    data=None
+                )), 400
         
         # 获取筛选参数
         filters = {}
@@ -58,17 +116,9 @@ def get_conversations():
         # 构建查询条件
         query = {}
         
-        # 文本搜索
+        # 文本搜索：会话ID、客户ID前缀，以及主要问题、摘要和消息内容的全文检索
         if search_text:
-            # 创建文本搜索条件（ID、客户ID或主要问题）
-            text_query = {
-                '$or': [
-                    {'id': {'$regex': search_text, '$options': 'i'}},
-                    {'customerInfo.userId': {'$regex': search_text, '$options': 'i'}},
-                    {'conversationSummary.mainIssue': {'$regex': search_text, '$options': 'i'}}
-                ]
-            }
-            query.update(text_query)
+            query.update(search_query(search_text))
         
         # 客服筛选
         if agent:
@@ -103,35 +153,33 @@ def get_conversations():
         # 获取数据库连接
         db = get_db()
         
-        # 计算总数
-        total = db.conversations.count_documents(query)
+        # 按策略计算总数
+        total, count_info = count_total(db.conversations, query, count_strategy)
         
-        # 分页查询
-        skip = (page - 1) * page_size
-        cursor = db.conversations.find(query).sort('time', -1).skip(skip).limit(page_size)
+        # 分页查询：指定游标时用范围条件定位，否则按页码跳过；多取一条用于判断是否有下一页
+        sort = page_sort(query, position)
+        if position:
+            page_docs = fetch_page(db.conversations, after_query(query, position), CONVERSATION_LIST_FIELDS,
+                                   limit=page_size + 1)
+        else:
+            page_docs = fetch_page(db.conversations, query, CONVERSATION_LIST_FIELDS,
+                                   skip=(page - 1) * page_size, limit=page_size + 1, sort=sort)
+        docs, next_after = split_page(page_docs, page_size)
+        if sort != PAGE_SORT:
+            # 按相关度排序时游标无法定位，使用page翻页
+            next_after = None
         
-        # 转换为列表项
-        items = []
-        for doc in cursor:
-            # 确保所有必要字段都存在
-            # 转换为列表项格式
-            list_item = {
-                'id': doc.get('id', ''),
-                'time': doc.get('time', ''),
-                'agent': doc.get('agent', ''),
-                'customerId': doc.get('customerInfo', {}).get('userId', '未知用户'),
-                'mainIssue': doc.get('conversationSummary', {}).get('mainIssue', '未分类问题'),
-                'resolutionStatus': doc.get('conversationSummary', {}).get('resolutionStatus', {}).get('status', '未解决'),
-                'tags': doc.get('tags', []),
-                'satisfaction': doc.get('metrics', {}).get('satisfaction', {}).get('value', 0)
-            }
-            items.append(list_item)
+        # 转换为列表项，只读取列表项需要的字段
+        items = [decode_list_item(doc, CONVERSATION_LIST_FIELDS) for doc in docs]
         
         # 构建分页数据
         pagination = {
             'current': page,
             'pageSize': page_size,
-            'total': total
+            'total': total,
+            'totalMode': count_info['mode'],
+            'totalCapped': count_info['capped'],
+            'next': next_after
         }
         
         # 构建响应
@@ -160,6 +208,89 @@ def get_conversations():
             }
         ))
 
+@conversation_bp.route('/autocomplete', methods=['GET'])
+def autocomplete_conversations():
+    """按会话ID或客户ID前缀自动补全
+    
+    查询参数:
+        q (str): 输入的前缀，如会话ID开头或客户手机号开头
+        limit (int): 返回数量，默认为10，最大为50
+        
+    返回:
+        JSON: {
+            "success": bool,
+            "data": {
+                "items": [
+                    {
+                        "match": str,  # id 或 customerId，表示命中的字段
+                        "id": str,
+                        "customerId": str,
+                        "time": str
+                    }
+                ],
+                "cached": bool
+            },
+            "message": str (可选)
+        }
+    """
+    try:
+        prefix = request.args.get('q', '').strip()
+        limit = min(max(int(request.args.get('limit', 10)), 1), 50)
+        
+        if not prefix:
+            return jsonify(make_response(
+                success=False,
+                message="缺少前缀参数: q",
+                data=None
+            )), 400
+        
+        key = (prefix, limit)
+        items = autocomplete_cache.get(key)
+        if items is not None:
+            return jsonify(make_response(
+                success=True,
+                data={'items': items, 'cached': True}
+            ))
+        
+        # 获取数据库连接
+        db = get_db()
+        
+        # 在id和customerInfo.userId索引上做前缀范围扫描，会话ID命中优先
+        items = []
+        seen = set()
+        for match, path in AUTOCOMPLETE_FIELDS:
+            cursor = db.conversations.find(
+                {path: prefix_range(prefix)},
+                {'_id': 0, 'id': 1, 'customerInfo.userId': 1, 'time': 1}
+            ).sort(path, 1).limit(limit)
+            for doc in cursor:
+                if doc.get('id') in seen:
+                    continue
+                seen.add(doc.get('id'))
+                items.append({
+                    'match': match,
+                    'id': doc.get('id', ''),
+                    'customerId': (doc.get('customerInfo') or {}).get('userId', ''),
+                    'time': doc.get('time', '')
+                })
+            if len(items) >= limit:
+                break
+        items = items[:limit]
+        
+        autocomplete_cache.set(key, items)
+        return jsonify(make_response(
+            success=True,
+            data={'items': items, 'cached': False}
+        ))
+    
+    except Exception as e:
+        logger.error(f"会话自动补全出错: {str(e)}")
+        return jsonify(make_response(
+            success=False,
+            message=f"会话自动补全出错: {str(e)}",
+            data=None
+        )), 500
+
 @conversation_bp.route('/<conversation_id>', methods=['GET'])
 def get_conversation_detail(conversation_id):
     """获取指定ID的会话详情
@@ -188,10 +319,12 @@ def get_conversation_detail(conversation_id):
                 data={}
             ))
         
-        # 移除MongoDB的_id字段
+        # 移除MongoDB的_id字段、检索词和源内容哈希字段
         conversation = parse_json(conversation)
         if '_id' in conversation:
             del conversation['_id']
+        conversation.pop(SEARCH_FIELD, None)
+        conversation.pop(SOURCE_HASH_FIELD, None)
         
         # 构建响应
         return jsonify(make_response(
@@ -224,9 +357,10 @@ def create_conversation():
     返回:
         JSON: {
             "success": bool,
-            "data": {"id": str},
+            "data": {"id": str, "status": str (可选)},
             "message": str (可选)
         }
+        启用合并提交且等待写入确认超时时返回202，status为pending，会话之后可能写入
     """
     try:
         # 获取请求数据
@@ -239,14 +373,49 @@ def create_conversation():
             ))
         
         # 验证必要字段
-        required_fields = ['id', 'time', 'agent', 'customerInfo', 'conversationSummary']
-        for field in required_fields:
-            if field not in data:
+        error = ingest.validate(data)
+        if error:
+            return jsonify(make_response(
+                success=False,
+                message=error,
+                data={}
+            ))
+        
+        # 合并提交模式：放入写入队列，所属批次写入确认后返回，重复ID由唯一索引判定
+        if current_app.config.get('WRITE_BEHIND_ENABLED'):
+            committer = writebehind.get_committer(current_app.config)
+            try:
+                result = committer.submit(
+                    ingest.prepare(data),
+                    timeout=current_app.config.get('WRITE_BEHIND_ENQUEUE_TIMEOUT'),
+                    wait=current_app.config.get('WRITE_BEHIND_ACK_TIMEOUT')
+                )
+            except writebehind.QueueFull as e:
+                logger.warning(str(e))
                 return jsonify(make_response(
                     success=False,
-                    message=f"缺少必要字段: {field}",
+                    message=str(e),
                     data={}
+                )), 503
+            except TimeoutError:
+                # 会话仍在写入队列中，之后可能写入成功，不能按失败处理，否则客户端重试会得到"已存在"
+                logger.warning(f"会话 {data['id']} 等待批量写入确认超时")
+                return jsonify(make_response(
+                    success=True,
+                    message="会话已进入写入队列，尚未确认写入，请稍后查询",
+                    data={'id': data['id'], 'status': 'pending'}
+                )), 202
+            if result['status'] == 'inserted':
+                return jsonify(make_response(
+                    success=True,
+                    message="会话创建成功",
+                    data={'id': data['id']}
                 ))
+            return jsonify(make_response(
+                success=False,
+                message=result['error'],
+                data={}
+            ))
         
         # 获取数据库连接
         db = get_db()
@@ -260,10 +429,13 @@ def create_conversation():
                 data={}
             ))
         
-        # 插入数据
+        # 生成检索词等派生字段并插入数据
+        data = ingest.prepare(data)
         result = db.conversations.insert_one(data)
         
         if result.acknowledged:
+            # 同步更新派生统计
+            stats.apply_changes(db, [(None, data)])
             return jsonify(make_response(
                 success=True,
                 message="会话创建成功",
@@ -284,6 +456,103 @@ def create_conversation():
             data={}
         ))
 
+@conversation_bp.route('/bulk', methods=['POST'])
+def bulk_upsert_conversations():
+    """批量写入会话，按会话ID新增或整体替换，源内容未变化的会话跳过
+    
+    请求体:
+        JSON数组: [ConversationData]
+        或NDJSON（Content-Type为application/x-ndjson）: 每行一个ConversationData
+        
+    返回:
+        JSON: {
+            "success": bool,  # 所有会话都写入成功时为true
+            "data": {
+                "inserted": int,
+                "updated": int,
+                "skipped": int,  # 源内容未变化，未写入
+                "duplicate": int,
+                "error": int,
+                "elapsed": float,  # 秒
+                "docsPerSecond": float,
+                "items": [
+                    {"index": int, "id": str, "status": str, "error": str (可选)}
+                ]
+            },
+            "message": str (可选)
+        }
+    """
+    try:
+        started = time.perf_counter()
+        batch_size = current_app.config.get('INGEST_BATCH_SIZE', 1000)
+        
+        # 获取数据库连接
+        db = get_db()
+        
+        results = []
+        parse_errors = {}
+        batch = []
+        
+        def flush():
+            results.extend(ingest.upsert_batch(db, batch, offset=len(results)))
+            batch.clear()
+        
+        if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+            # 逐行读取NDJSON，按批写入，不需要把整个请求体载入内存
+            index = 0
+            for line in request.stream:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    batch.append(json.loads(line))
+                except ValueError as e:
+                    parse_errors[index] = f"JSON解析失败: {str(e)}"
+                    batch.append(None)
+                index += 1
+                if len(batch) >= batch_size:
+                    flush()
+        else:
+            docs = request.get_json(silent=True)
+            if not isinstance(docs, list):
+                return jsonify(make_response(
+                    success=False,
+                    message="请求体必须是会话JSON数组或NDJSON",
+                    data={}
+                )), 400
+            for doc in docs:
+                batch.append(doc)
+                if len(batch) >= batch_size:
+                    flush()
+        if batch:
+            flush()
+        
+        for index, error in parse_errors.items():
+            results[index]['error'] = error
+        
+        summary = ingest.summarize(results)
+        elapsed = time.perf_counter() - started
+        logger.info(f"批量写入会话: {summary}，耗时 {elapsed:.2f}s")
+        
+        return jsonify(make_response(
+            success=summary['error'] == 0,
+            message=f"批量写入完成: 新增 {summary['inserted']}，更新 {summary['updated']}，跳过 {summary['skipped']}，失败 {summary['error']}",
+            data={
+                **summary,
+                'elapsed': elapsed,
+                'docsPerSecond': len(results) / elapsed if elapsed > 0 else 0,
+                'items': results
+            }
+        ))
+    
+    except Exception as e:
+        logger.error(f"批量写入会话出错: {str(e)}")
+        return jsonify(make_response(
+            success=False,
+            message=f"批量写入会话出错: {str(e)}",
+            data={}
+        )), 500
+
 @conversation_bp.route('/<conversation_id>', methods=['PUT'])
 def update_conversation(conversation_id):
     """更新指定ID的会话记录
@@ -331,13 +600,31 @@ def update_conversation(conversation_id):
                 data={}
             ))
         
-        # 更新数据
-        result = db.conversations.update_one(
+        # 更新数据，派生统计使用写入本身取回的更新前文档，并发更新同一会话时各自的变更前后一致
+        before = db.conversations.find_one_and_update(
             {'id': conversation_id},
-            {'$set': data}
+            {'$set': data},
+            return_document=ReturnDocument.BEFORE
         )
-        
-        if result.modified_count > 0:
+        updated = _apply_set(before, data) if before is not None else None
+        
+        if updated is not None and updated != before:
+            changes = [(before, updated)]
+            # 内容变化后同步检索词和交互指标，同样按写入时的更新前文档记录变更
+            derived = {SEARCH_FIELD: search_fields(updated)}
+            analysis = interaction_analysis(updated)
+            if analysis is not None:
+                derived[INTERACTION_FIELD] = analysis
+            derived = {field: value for field, value in derived.items() if updated.get(field) != value}
+            if derived:
+                current = db.conversations.find_one_and_update(
+                    {'_id': updated['_id']},
+                    {'$set': derived},
+                    return_document=ReturnDocument.BEFORE
+                )
+                if current is not None:
+                    changes.append((current, {**current, **derived}))
+            stats.apply_changes(db, changes)
             return jsonify(make_response(
                 success=True,
                 message="会话更新成功",
@@ -386,9 +673,10 @@ def delete_conversation(conversation_id):
             ))
         
         # 删除数据
-        result = db.conversations.delete_one({'id': conversation_id})
+        deleted = db.conversations.find_one_and_delete({'id': conversation_id})
         
-        if result.deleted_count > 0:
+        if deleted is not None:
+            stats.apply_changes(db, [(deleted, None)])
             return jsonify(make_response(
                 success=True,
                 message="会话删除成功",
@@ -0,0 +1,58 @@
+"""
+列表总数统计模块
+提供列表接口共用的总数统计策略
+
+    exact      精确计数，每次执行count_documents
+    cached     按规范化的查询条件缓存精确计数，超过有效期或本进程有会话写入后重新计数
+    estimated  无筛选条件时读取集合元数据估算总数，有筛选条件时退回精确计数
+    capped     最多计数到COUNT_CAP，超过时只返回上限并标记封顶
+"""
+import json
+from bson import json_util
+from ..config import Config
+from ..cache import TTLCache
+from .. import stats
+
+# 支持的总数统计策略
+COUNT_STRATEGIES = ['exact', 'cached', 'estimated', 'capped']
+
+# 精确计数缓存，键包含会话写入代数，写入后旧条目不再命中
+count_cache = TTLCache(Config.COUNT_CACHE_SIZE, Config.COUNT_CACHE_TTL)
+
+
+def count_key(collection, query):
+    """将查询条件规范化为缓存键，字段顺序不同的相同条件得到相同的键"""
+    return (collection.name, json.dumps(query, sort_keys=True, default=json_util.default), stats.generation)
+
+
+def count_total(collection, query, strategy='exact', cap=None):
+    """按指定策略统计查询结果总数
+
+    Args:
+        collection: 会话集合
+        query: 查询条件
+        strategy: 统计策略，见COUNT_STRATEGIES
+        cap: capped策略的计数上限，默认使用COUNT_CAP
+
+    Returns:
+        (总数, {'mode': 实际使用的策略, 'capped': 是否达到上限})
+    """
+    if strategy == 'estimated' and not query:
+        return collection.estimated_document_count(), {'mode': 'estimated', 'capped': False}
+
+    if strategy == 'capped':
+        cap = cap or Config.COUNT_CAP
+        total = collection.count_documents(query, limit=cap + 1)
+        if total > cap:
+            return cap, {'mode': 'capped', 'capped': True}
+        return total, {'mode': 'capped', 'capped': False}
+
+    if strategy == 'cached':
+        key = count_key(collection, query)
+        total = count_cache.get(key)
+        if total is None:
+            total = collection.count_documents(query)
+            count_cache.set(key, total)
+        return total, {'mode': 'cached', 'capped': False}
+
+    return collection.count_documents(query), {'mode': 'exact', 'capped': False}
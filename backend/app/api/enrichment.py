@@ -0,0 +1,88 @@
+"""
+会话分析用量API模块
+提供模型调用的token用量、吞吐、延迟、错误率和成本估算
+"""
+from flask import Blueprint, request, jsonify
+import logging
+from ..database import get_db
+from .utils import make_response, parse_json
+from ..enrichment import usage, pending_query
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 创建蓝图
+enrichment_bp = Blueprint('enrichment', __name__, url_prefix='/enrichment')
+
+@enrichment_bp.route('/usage', methods=['GET'])
+def get_usage():
+    """获取模型用量报表
+
+    查询参数:
+        days (int, 可选): 统计最近多少天，默认7，最多365
+        model (str, 可选): 只统计指定模型
+        groupBy (str, 可选): 分组维度，model、promptVersion、day或agent，默认day
+        runs (int, 可选): 返回最近多少次运行记录，默认10，最多100
+
+    返回:
+        JSON: {
+            "success": bool,
+            "data": {
+                "days": int,
+                "totals": Usage,
+                "groups": [Usage],  # 每项另含分组维度字段
+                "projection": {
+                    "dailyCost": float,  # 有用量的日期的日均成本
+                    "monthlyCost": float,
+                    "pendingConversations": int,
+                    "pendingCost": float  # 按单个会话成本估算的剩余成本
+                },
+                "runs": [{
+                    "id": str, "model": str, "startedAt": str, "finishedAt": str,
+                    "options": {"concurrency": int, "batchSize": int, "ratePerMinute": float, "useCache": bool},
+                    "processed": int, "succeeded": int, "failed": int, "calls": int, "retries": int,
+                    "tokens": int, "cacheHits": int, "elapsed": float, "cost": float,
+                    "tokensPerSecond": float, "perMinute": float, "costPerConversation": float
+                }]
+            },
+            "message": str (可选)
+        }
+
+        Usage: {
+            "calls": int, "errors": int, "errorRate": float,
+            "promptTokens": int, "completionTokens": int, "totalTokens": int,
+            "tokensPerSecond": float,  # 模型调用期间每秒处理的token数
+            "avgLatencyMs": float, "p50LatencyMs": int, "p95LatencyMs": int,
+            "conversations": int, "cacheHits": int, "tokensSaved": int,
+            "cost": float, "costPerConversation": float
+        }
+    """
+    try:
+        days = min(max(int(request.args.get('days', 7)), 1), 365)
+        model = request.args.get('model')
+        group_by = request.args.get('groupBy', 'day')
+        runs = min(max(int(request.args.get('runs', 10)), 0), 100)
+
+        if group_by not in usage.GROUP_FIELDS:
+            return jsonify(make_response(
+                success=False,
+                message=f"groupBy必须是 {', '.join(usage.GROUP_FIELDS)} 之一",
+                data={}
+            )), 400
+
+        db = get_db()
+        pending = db.conversations.count_documents(pending_query())
+        report = usage.usage_report(db, days=days, model=model, group_by=group_by, pending=pending, runs=runs)
+
+        return jsonify(make_response(
+            success=True,
+            data=parse_json(report)
+        ))
+
+    except Exception as e:
+        logger.error(f"获取模型用量出错: {str(e)}")
+        return jsonify(make_response(
+            success=False,
+            message=f"获取模型用量出错: {str(e)}",
+            data={}
+        ))
@@ -0,0 +1,219 @@
+"""
+任务队列API模块
+提交后台任务，查看任务列表和队列积压、等待时间、吞吐
+"""
+from flask import Blueprint, request, jsonify
+import logging
+from bson.errors import InvalidId
+from ..database import get_db
+from .utils import make_response, parse_json
+from .. import jobs
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 创建蓝图
+jobs_bp = Blueprint('jobs', __name__, url_prefix='/jobs')
+
+@jobs_bp.route('', methods=['GET'])
+def list_jobs():
+    """获取最近提交的任务
+
+    查询参数:
+        status (str, 可选): 任务状态，queued、running、done或dead
+        type (str, 可选): 任务类型
+        limit (int, 可选): 返回数量，默认20，最多200
+
+    返回:
+        JSON: {
+            "success": bool,
+            "data": {"items": [Job]},
+            "message": str (可选)
+        }
+    """
+    try:
+        status = request.args.get('status')
+        job_type = request.args.get('type')
+        limit = min(max(int(request.args.get('limit', 20)), 1), 200)
+
+        if status and status not in jobs.JOB_STATUSES:
+            return jsonify(make_response(
+                success=False,
+                message=f"status必须是 {', '.join(jobs.JOB_STATUSES)} 之一",
+                data={}
+            )), 400
+
+        query = {}
+        if status:
+            query['status'] = status
+        if job_type:
+            query['type'] = job_type
+
+        db = get_db()
+        items = list(db.jobs.find(query).sort('createdAt', -1).limit(limit))
+        for item in items:
+            item['id'] = str(item.pop('_id'))
+
+        return jsonify(make_response(
+            success=True,
+            data={'items': parse_json(items)}
+        ))
+
+    except Exception as e:
+        logger.error(f"获取任务列表出错: {str(e)}")
+        return jsonify(make_response(
+            success=False,
+            message=f"获取任务列表出错: {str(e)}",
+            data={}
+        ))
+
+@jobs_bp.route('', methods=['POST'])
+def create_job():
+    """提交任务
+
+    请求体:
+        JSON: {
+            "type": str,  # enrich、rebuild-rollups、rebuild-cube、rebuild-cooccurrence、rebuild-hotwords、reindex-search、derive-interactions
+            "params": obj (可选),
+            "priority": int (可选),  # 数值大的先执行，默认0
+            "maxAttempts": int (可选),
+            "delay": float (可选)  # 延迟执行的秒数
+        }
+
+    返回:
+        JSON: {
+            "success": bool,
+            "data": {"id": str},
+            "message": str (可选)
+        }
+    """
+    try:
+        data = request.json or {}
+        if data.get('type') not in jobs.HANDLERS:
+            return jsonify(make_response(
+                success=False,
+                message=f"type必须是 {', '.join(jobs.HANDLERS)} 之一",
+                data={}
+            )), 400
+
+        params = data.get('params')
+        try:
+            if params is not None and not isinstance(params, dict):
+                raise ValueError("params必须是对象")
+            priority = int(data.get('priority', 0))
+            max_attempts = data.get('maxAttempts')
+            if max_attempts is not None:
+                max_attempts = int(max_attempts)
+                if max_attempts < 1:
+                    raise ValueError("maxAttempts必须是正整数")
+            delay = float(data.get('delay', 0))
+        except (TypeError, ValueError) as e:
+            return jsonify(make_response(
+                success=False,
+                message=f"任务参数无效: {str(e)}",
+                data={}
+            )), 400
+
+        db = get_db()
+        job_id = jobs.enqueue(
+            db, data['type'],
+            params=params,
+            priority=priority,
+            max_attempts=max_attempts,
+            delay=delay
+        )
+
+        return jsonify(make_response(
+            success=True,
+            message="任务已提交",
+            data={'id': str(job_id)}
+        ))
+
+    except Exception as e:
+        logger.error(f"提交任务出错: {str(e)}")
+        return jsonify(make_response(
+            success=False,
+            message=f"提交任务出错: {str(e)}",
+            data={}
+        ))
+
+@jobs_bp.route('/<job_id>/retry', methods=['POST'])
+def retry_job(job_id):
+    """将dead状态的任务重新排队
+
+    返回:
+        JSON: {
+            "success": bool,
+            "data": {"id": str},
+            "message": str (可选)
+        }
+    """
+    try:
+        db = get_db()
+        if not jobs.retry(db, job_id):
+            return jsonify(make_response(
+                success=False,
+                message=f"未找到ID为 {job_id} 的dead任务",
+                data={}
+            )), 404
+
+        return jsonify(make_response(
+            success=True,
+            message="任务已重新排队",
+            data={'id': job_id}
+        ))
+
+    except InvalidId:
+        return jsonify(make_response(
+            success=False,
+            message=f"无效的任务ID: {job_id}",
+            data={}
+        )), 400
+    except Exception as e:
+        logger.error(f"重试任务出错: {str(e)}")
+        return jsonify(make_response(
+            success=False,
+            message=f"重试任务出错: {str(e)}",
+            data={}
+        ))
+
+@jobs_bp.route('/stats', methods=['GET'])
+def job_stats():
+    """获取队列统计
+
+    查询参数:
+        window (int, 可选): 吞吐统计的时间窗口（秒），默认3600
+
+    返回:
+        JSON: {
+            "success": bool,
+            "data": {
+                "byStatus": {"queued": int, "running": int, "done": int, "dead": int},
+                "byType": {类型: {状态: int}},
+                "depth": int,  # 已到期、等待执行的任务数
+                "lagSeconds": float,  # 最早到期的等待任务已等待的秒数
+                "expiredLeases": int,  # 租约已过期、等待其他工作进程接手的任务数
+                "windowSeconds": int,
+                "completed": int,
+                "deadLettered": int,
+                "throughputPerMinute": float,
+                "avgRunSeconds": float
+            },
+            "message": str (可选)
+        }
+    """
+    try:
+        window = max(int(request.args.get('window', 3600)), 1)
+        db = get_db()
+        return jsonify(make_response(
+            success=True,
+            data=jobs.queue_stats(db, window_seconds=window)
+        ))
+
+    except Exception as e:
+        logger.error(f"获取队列统计出错: {str(e)}")
+        return jsonify(make_response(
+            success=False,
+            message=f"获取队列统计出错: {str(e)}",
+            data={}
+        ))
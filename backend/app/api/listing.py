@@ -0,0 +1,118 @@
+"""
+列表项模块
+提供列表接口共用的字段投影、文档解码和分页读取
+
+列表页只读取列表项需要的字段，不再传输和解码messages、origin_conversation等大字段。
+"""
+from .paging import PAGE_SORT
+from ..search import SCORE_SORT, uses_text
+
+# 列表项字段与文档路径、缺省值的对应关系
+LIST_ITEM_PATHS = {
+    'id': ('id', ''),
+    'title': ('title', '无标题会话'),
+    'time': ('time', ''),
+    'agent': ('agent', ''),
+    'customerId': ('customerInfo.userId', '未知用户'),
+    'mainIssue': ('conversationSummary.mainIssue', '未分类问题'),
+    'status': ('conversationSummary.resolutionStatus.status', '未解决'),
+    'resolutionStatus': ('conversationSummary.resolutionStatus.status', '未解决'),
+    'tags': ('tags', []),
+    'satisfaction': ('metrics.satisfaction.value', 0),
+    'resolution': ('metrics.resolution.value', 0),
+    'attitude': ('metrics.attitude.value', 0),
+    'security': ('metrics.security.value', 0)
+}
+
+# 会话列表项字段，对应ConversationListItem
+CONVERSATION_LIST_FIELDS = [
+    'id', 'time', 'agent', 'customerId', 'mainIssue', 'resolutionStatus', 'tags', 'satisfaction'
+]
+
+# 标签分析会话列表项字段
+TAG_LIST_FIELDS = [
+    'id', 'title', 'time', 'agent', 'customerId', 'mainIssue', 'status',
+    'satisfaction', 'resolution', 'attitude', 'security'
+]
+
+# 客服分析会话列表项字段
+AGENT_LIST_FIELDS = [
+    'id', 'title', 'time', 'customerId', 'mainIssue', 'status',
+    'satisfaction', 'resolution', 'attitude', 'security', 'tags'
+]
+
+# 可由 (time, id)、(tags, time, id)、(agent, time, id) 索引完整处理的筛选字段
+INDEXED_FILTER_FIELDS = {'time', 'id', 'tags', 'agent'}
+
+
+def list_projection(fields):
+    """构建只读取列表项字段的投影，排除_id"""
+    projection = {'_id': 0}
+    for name in fields:
+        projection[LIST_ITEM_PATHS[name][0]] = 1
+    return projection
+
+
+def get_path(doc, path, default):
+    """按点分路径读取嵌套字段，中途缺失或不是字典时返回缺省值"""
+    value = doc
+    for key in path.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return default
+        value = value[key]
+    return value
+
+
+def decode_list_item(doc, fields):
+    """将投影后的文档转换为列表项，缺失字段使用缺省值"""
+    item = {}
+    for name in fields:
+        path, default = LIST_ITEM_PATHS[name]
+        item[name] = get_path(doc, path, default)
+    return item
+
+
+def is_index_only(query):
+    """判断查询条件是否只涉及索引字段，可在索引上完成筛选和排序"""
+    return all(key in INDEXED_FILTER_FIELDS for key in query)
+
+
+def page_sort(query, position=None):
+    """列表排序键：全文检索且未指定游标时按相关度排序，否则按 (time, id) 倒序"""
+    if position is None and uses_text(query):
+        return SCORE_SORT + PAGE_SORT
+    return PAGE_SORT
+
+
+def fetch_page(collection, query, fields, skip=0, limit=10, sort=PAGE_SORT):
+    """读取一页列表项文档
+
+    跳过的文档较多且筛选条件只涉及索引字段时，先用只投影 (time, id) 的覆盖查询
+    在索引上完成跳过和截取，再按id读取当前页的列表字段，跳过的文档不会被读取。
+
+    Args:
+        collection: 会话集合
+        query: 查询条件
+        fields: 列表项字段名列表，需包含id
+        skip: 跳过的文档数
+        limit: 读取的文档数
+        sort: 排序键，全文检索按相关度排序时包含textScore
+
+    Returns:
+        按sort排序的投影文档列表
+    """
+    projection = list_projection(fields)
+    if sort != PAGE_SORT:
+        projection['score'] = {'$meta': 'textScore'}
+    if skip == 0 or sort != PAGE_SORT or not is_index_only(query):
+        return list(collection.find(query, projection).sort(sort).skip(skip).limit(limit))
+
+    keys = list(collection.find(query, {'_id': 0, 'time': 1, 'id': 1}).sort(PAGE_SORT).skip(skip).limit(limit))
+    if not keys:
+        return []
+    docs = {
+        doc['id']: doc
+        for doc in collection.find({'id': {'$in': [key['id'] for key in keys]}}, projection)
+    }
+    # 两次查询之间被删除的会话直接跳过
+    return [docs[key['id']] for key in keys if key['id'] in docs]
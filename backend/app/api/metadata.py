@@ -4,8 +4,10 @@
 """
 from flask import Blueprint, request, jsonify
 from ..database import get_db
+from ..stats import cooccurrence, hotwords
 import logging
 from .utils import make_response
+from .pipelines import dashboard_pipeline, percentage
 
 # 设置日志
 logger = logging.getLogger(__name__)
@@ -110,3 +112,154 @@ def get_tags():
             message=f"获取标签数据出错: {str(e)}",
             data=[]
         ))
+
+@metadata_bp.route('/tags/cooccurrence', methods=['GET'])
+def get_tag_cooccurrence():
+    """获取标签共现数据
+    
+    查询参数:
+        tag (str): 标签名称，指定时返回与该标签共现最多的标签，否则返回全局Top标签对
+        limit (int): 返回数量，默认为20
+        
+    返回:
+        JSON: {
+            "success": bool,
+            "data": [
+                {"tag": str (仅指定tag时), "tag_pair": [str, str], "count": int, "percentage": float}
+            ],
+            "message": str (可选)
+        }
+    """
+    try:
+        tag = request.args.get('tag')
+        limit = int(request.args.get('limit', 20))
+        
+        # 获取数据库连接
+        db = get_db()
+        
+        if cooccurrence.is_built(db):
+            # 读取增量维护的共现矩阵
+            if tag:
+                pairs = cooccurrence.neighbours(db, tag, limit)
+            else:
+                pairs = cooccurrence.top_pairs(db, limit)
+        else:
+            # 共现矩阵尚未构建时回退到聚合计算
+            match = {'tags': tag} if tag else None
+            result = list(db.conversations.aggregate(
+                dashboard_pipeline(match=match, top_n=None if tag else limit, sections=['tag_pairs']),
+                allowDiskUse=True
+            ))
+            rows = result[0]['tag_pairs'] if result else []
+            pairs = []
+            for row in rows:
+                if tag and tag not in row['_id']:
+                    continue
+                pair = {'tag_pair': row['_id'], 'count': row['count']}
+                if tag:
+                    pair['tag'] = row['_id'][1] if row['_id'][0] == tag else row['_id'][0]
+                pairs.append(pair)
+            pairs = pairs[:limit]
+        
+        # 计算共现会话占全部会话的百分比
+        total_conversations = db.conversations.estimated_document_count()
+        for pair in pairs:
+            pair['percentage'] = percentage(pair['count'], total_conversations)
+        
+        # 构建响应
+        return jsonify(make_response(
+            success=True,
+            data=pairs
+        ))
+    
+    except Exception as e:
+        logger.error(f"获取标签共现数据出错: {str(e)}")
+        return jsonify(make_response(
+            success=False,
+            message=f"获取标签共现数据出错: {str(e)}",
+            data=[]
+        ))
+
+@metadata_bp.route('/hotwords', methods=['GET'])
+def get_hotwords():
+    """获取Top热词及其误差界限
+    
+    查询参数:
+        tag (str): 标签名称，指定时返回该标签下的热词
+        agent (str): 客服名称，指定时返回该客服会话中的热词
+        limit (int): 返回数量，默认为20
+        
+    返回:
+        JSON: {
+            "success": bool,
+            "data": {
+                "scope": str,
+                "items": [
+                    {"word": str, "count": int, "error": int, "guaranteed": int}
+                ],
+                "bounds": {
+                    "streamLength": int,
+                    "capacity": int,
+                    "maxError": int,
+                    "errorBound": float
+                }
+            },
+            "message": str (可选)
+        }
+    """
+    try:
+        tag = request.args.get('tag')
+        agent = request.args.get('agent')
+        limit = int(request.args.get('limit', 20))
+        
+        if tag:
+            scope = hotwords.scope_id('tag', tag)
+        elif agent:
+            scope = hotwords.scope_id('agent', agent)
+        else:
+            scope = hotwords.GLOBAL_SCOPE
+        
+        # 获取数据库连接
+        db = get_db()
+        
+        if hotwords.is_built(db):
+            # 读取热词摘要，count为真实频次上界，guaranteed为下界
+            sketch = hotwords.load(db, scope)
+            items = [
+                {'word': word, 'count': count, 'error': error, 'guaranteed': count - error}
+                for word, count, error in sketch.top(limit)
+            ]
+            bounds = sketch.bounds()
+        else:
+            # 热词摘要尚未构建时回退到精确聚合
+            match = {'tags': tag} if tag else ({'agent': agent} if agent else {})
+            pipeline = [
+                {'$match': {**match, 'hotWords.0': {'$exists': True}}},
+                {'$unwind': '$hotWords'},
+                {'$group': {'_id': '$hotWords', 'count': {'$sum': 1}}},
+                {'$sort': {'count': -1}},
+                {'$limit': limit}
+            ]
+            items = [
+                {'word': row['_id'], 'count': row['count'], 'error': 0, 'guaranteed': row['count']}
+                for row in db.conversations.aggregate(pipeline, allowDiskUse=True)
+            ]
+            bounds = {'streamLength': None, 'capacity': None, 'maxError': 0, 'errorBound': 0}
+        
+        # 构建响应
+        return jsonify(make_response(
+            success=True,
+            data={
+                'scope': scope,
+                'items': items,
+                'bounds': bounds
+            }
+        ))
+    
+    except Exception as e:
+        logger.error(f"获取热词数据出错: {str(e)}")
+        return jsonify(make_response(
+            success=False,
+            message=f"获取热词数据出错: {str(e)}",
+            data={}
+        ))
@@ -0,0 +1,76 @@
+"""
+游标分页模块
+提供列表接口共用的键集（keyset）分页工具
+
+列表统一按 (time, id) 倒序排列，after 游标编码上一页最后一条会话的 (time, id)，
+下一页通过范围条件直接从索引定位，不再随页码增长扫描并丢弃前面的文档。
+"""
+import base64
+import json
+
+# 列表排序键，id作为time相同时的稳定次序
+PAGE_SORT = [('time', -1), ('id', -1)]
+
+
+def encode_cursor(doc):
+    """将会话的 (time, id) 编码为不透明的游标字符串"""
+    raw = json.dumps([doc.get('time', ''), doc.get('id', '')], ensure_ascii=False)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """解析游标字符串
+
+    Args:
+        token: encode_cursor生成的游标
+
+    Returns:
+        (time, id) 元组
+
+    Raises:
+        ValueError: 游标格式无效
+    """
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        time_value, id_value = json.loads(raw.decode('utf-8'))
+    except Exception:
+        raise ValueError(f"无效的分页游标: {token}")
+    if not isinstance(time_value, str) or not isinstance(id_value, str):
+        raise ValueError(f"无效的分页游标: {token}")
+    return time_value, id_value
+
+
+def after_query(query, cursor):
+    """在查询条件上追加游标之后的范围条件
+
+    Args:
+        query: 原有查询条件
+        cursor: decode_cursor返回的 (time, id)
+
+    Returns:
+        新的查询条件，原条件不变
+    """
+    time_value, id_value = cursor
+    range_query = {'$or': [
+        {'time': {'$lt': time_value}},
+        {'time': time_value, 'id': {'$lt': id_value}}
+    ]}
+    if not query:
+        return range_query
+    return {'$and': [query, range_query]}
+
+
+def split_page(docs, page_size):
+    """从多取一条的结果中截取当前页并生成下一页游标
+
+    Args:
+        docs: 按PAGE_SORT排序、最多page_size + 1条的文档列表
+        page_size: 每页记录数
+
+    Returns:
+        (当前页文档列表, 下一页游标)，没有下一页时游标为None
+    """
+    if len(docs) > page_size:
+        docs = docs[:page_size]
+        return docs, encode_cursor(docs[-1])
+    return docs, None
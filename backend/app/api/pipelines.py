@@ -0,0 +1,187 @@
+"""
+聚合管道模块
+提供各分析接口共用的MongoDB聚合阶段和结果格式化函数
+"""
+from ..pipelines import STATUS_FIELD, STATUS_RESOLVED, STATUS_PARTIALLY_RESOLVED, METRIC_NAMES, tag_pairs_stage
+
+# 看板统计需要读取的字段，在管道开头裁剪文档以减少内存占用
+DASHBOARD_FIELDS = {
+    'agent': 1,
+    'tags': 1,
+    'hotWords': 1,
+    'conversationSummary.resolutionStatus.status': 1,
+    'metrics.satisfaction.value': 1,
+    'metrics.resolution.value': 1,
+    'metrics.attitude.value': 1,
+    'metrics.security.value': 1,
+    'interactionAnalysis.totalMessages': 1,
+    'interactionAnalysis.agentMessages': 1,
+    'interactionAnalysis.userMessages': 1
+}
+
+
+# 客服统计需要读取的字段
+PERFORMANCE_FIELDS = {
+    'agent': 1,
+    'conversationSummary.resolutionStatus.status': 1,
+    'metrics.satisfaction.value': 1,
+    'metrics.resolution.value': 1,
+    'metrics.attitude.value': 1,
+    'metrics.security.value': 1
+}
+
+
+def status_count_fields():
+    """$group阶段中按解决状态计数的累加器
+
+    未解决数量由 count - resolved_count - partially_resolved_count 得出，
+    与原有逻辑一致：除“已解决”“部分解决”外的状态（包括缺失）都计为未解决。
+    """
+    return {
+        'resolved_count': {'$sum': {'$cond': [{'$eq': [STATUS_FIELD, STATUS_RESOLVED]}, 1, 0]}},
+        'partially_resolved_count': {'$sum': {'$cond': [{'$eq': [STATUS_FIELD, STATUS_PARTIALLY_RESOLVED]}, 1, 0]}}
+    }
+
+
+def metric_sum_fields():
+    """$group阶段中累加各项指标的累加器，缺失的指标按0计入"""
+    return {
+        f'{name}_sum': {'$sum': f'$metrics.{name}.value'}
+        for name in METRIC_NAMES
+    }
+
+
+def dashboard_pipeline(match=None, top_n=20, sections=None):
+    """构建看板数据的单次$facet聚合管道
+
+    所有统计在一次集合扫描中完成，查询次数不再随标签数或客服数增长。
+
+    Args:
+        match: 可选的筛选条件
+        top_n: 热词和标签共现的返回数量，为None时不限制
+        sections: 需要计算的分面名称列表，默认计算全部
+
+    Returns:
+        聚合管道列表
+    """
+    pipeline = []
+    if match:
+        pipeline.append({'$match': match})
+    pipeline.append({'$project': DASHBOARD_FIELDS})
+    facets = {
+        'overview': [
+            {'$group': {
+                '_id': None,
+                'total': {'$sum': 1},
+                'avg_totalMessages': {'$avg': '$interactionAnalysis.totalMessages'},
+                'avg_agentMessages': {'$avg': '$interactionAnalysis.agentMessages'},
+                'avg_userMessages': {'$avg': '$interactionAnalysis.userMessages'},
+                **{
+                    f'avg_{name}': {'$avg': f'$metrics.{name}.value'}
+                    for name in METRIC_NAMES
+                }
+            }}
+        ],
+        'tags': [
+            {'$project': {
+                'tags': {'$setUnion': [{'$ifNull': ['$tags', []]}, []]},
+                'conversationSummary': 1
+            }},
+            {'$unwind': '$tags'},
+            {'$group': {
+                '_id': '$tags',
+                'count': {'$sum': 1},
+                **status_count_fields()
+            }},
+            {'$sort': {'count': -1, '_id': 1}}
+        ],
+        'hotwords': [
+            {'$unwind': '$hotWords'},
+            {'$group': {'_id': '$hotWords', 'count': {'$sum': 1}}},
+            {'$sort': {'count': -1}}
+        ] + ([{'$limit': top_n}] if top_n else []),
+        'tag_pairs': [
+            {'$project': {'tags': {'$setUnion': [{'$ifNull': ['$tags', []]}, []]}}},
+            {'$match': {'tags.1': {'$exists': True}}},  # 至少有2个标签
+            tag_pairs_stage(),
+            {'$unwind': '$tagPairs'},
+            {'$group': {'_id': '$tagPairs', 'count': {'$sum': 1}}},
+            {'$sort': {'count': -1}}
+        ] + ([{'$limit': top_n}] if top_n else []),
+        'agents': [
+            {'$match': {'agent': {'$ne': None}}},
+            {'$group': {
+                '_id': '$agent',
+                'count': {'$sum': 1},
+                **status_count_fields(),
+                **metric_sum_fields()
+            }},
+            {'$sort': {'_id': 1}}
+        ]
+    }
+    if sections is not None:
+        facets = {name: stages for name, stages in facets.items() if name in sections}
+    pipeline.append({'$facet': facets})
+    return pipeline
+
+
+def performance_stage(key_field, attitude_weight=0.25):
+    """由分组计数计算状态百分比、指标平均值和综合表现的$project阶段
+
+    与status_percentages、metric_averages的计算方式一致，
+    在数据库端完成计算以便直接排序和分页。
+
+    Args:
+        key_field: 分组键在输出中的字段名
+        attitude_weight: 态度指标在综合表现中的权重
+    """
+    def average(name):
+        return {'$divide': [f'${name}_sum', '$count']}
+
+    def percent(expression):
+        return {'$multiply': [{'$divide': [expression, '$count']}, 100]}
+
+    return {'$project': {
+        '_id': 0,
+        key_field: '$_id',
+        'count': 1,
+        'resolved': percent('$resolved_count'),
+        'partially_resolved': percent('$partially_resolved_count'),
+        'unresolved': percent({'$subtract': [
+            '$count',
+            {'$add': ['$resolved_count', '$partially_resolved_count']}
+        ]}),
+        **{f'avg_{name}': average(name) for name in METRIC_NAMES},
+        'overall_performance': {'$add': [
+            {'$multiply': [average('satisfaction'), 0.25]},
+            {'$multiply': [average('resolution'), 0.25]},
+            {'$multiply': [average('security'), 0.25]},
+            {'$multiply': [average('attitude'), attitude_weight]}
+        ]}
+    }}
+
+
+def percentage(count, total):
+    """计算百分比，总数为0时返回0"""
+    return (count / total) * 100 if total > 0 else 0
+
+
+def status_percentages(row):
+    """将分组结果中的状态计数转换为百分比"""
+    count = row.get('count', 0)
+    resolved = row.get('resolved_count', 0)
+    partially_resolved = row.get('partially_resolved_count', 0)
+    return {
+        'resolved': percentage(resolved, count),
+        'partially_resolved': percentage(partially_resolved, count),
+        'unresolved': percentage(count - resolved - partially_resolved, count)
+    }
+
+
+def metric_averages(row):
+    """将分组结果中的指标总和转换为平均值"""
+    count = row.get('count', 0)
+    return {
+        f'avg_{name}': row.get(f'{name}_sum', 0) / count if count > 0 else 0
+        for name in METRIC_NAMES
+    }
@@ -2,9 +2,11 @@
 系统API模块
 提供系统健康检查和状态信息
 """
-from flask import Blueprint, jsonify
+from flask import Blueprint, jsonify, current_app
 import logging
 from .utils import make_response
+from ..database import get_pool_stats
+from .. import writebehind
 import platform
 import sys
 from datetime import datetime
@@ -63,3 +65,87 @@ def health_check():
                 'status': 'error'
             }
         ))
+
+@system_bp.route('/db/pool', methods=['GET'])
+def pool_status():
+    """获取MongoDB连接池状态，用于评估连接池大小
+
+    返回:
+        JSON: {
+            "success": bool,
+            "data": {
+                "pid": int,
+                "initialized": bool,
+                "maxPoolSize": int,
+                "minPoolSize": int,
+                "waitQueueTimeoutMS": float,
+                "stats": {
+                    "openConnections": int,
+                    "checkedOut": int,
+                    "maxCheckedOut": int,
+                    "checkoutsSucceeded": int,
+                    "checkoutsFailed": int,
+                    "avgWaitMs": float,
+                    "maxWaitMs": float,
+                    ...
+                }
+            },
+            "message": str (可选)
+        }
+    """
+    try:
+        return jsonify(make_response(
+            success=True,
+            data=get_pool_stats()
+        ))
+
+    except Exception as e:
+        logger.error(f"获取连接池状态出错: {str(e)}")
+        return jsonify(make_response(
+            success=False,
+            message=f"获取连接池状态出错: {str(e)}",
+            data={}
+        ))
+
+@system_bp.route('/db/write-behind', methods=['GET'])
+def write_behind_status():
+    """获取单条创建合并提交的队列深度、批次大小和写入延迟统计
+
+    返回:
+        JSON: {
+            "success": bool,
+            "data": {
+                "enabled": bool,
+                "stats": {
+                    "queueDepth": int,
+                    "queueCapacity": int,
+                    "batches": int,
+                    "documents": int,
+                    "rejected": int,
+                    "avgBatchSize": float,
+                    "maxBatchSize": int,
+                    "avgFlushMs": float,
+                    "maxFlushMs": float,
+                    "avgAckMs": float,
+                    "maxAckMs": float,
+                    ...
+                } | null
+            },
+            "message": str (可选)
+        }
+    """
+    try:
+        return jsonify(make_response(
+            success=True,
+            data={
+                'enabled': current_app.config.get('WRITE_BEHIND_ENABLED', False),
+                'stats': writebehind.get_metrics()
+            }
+        ))
+    except Exception as e:
+        logger.error(f"获取合并提交状态出错: {str(e)}")
+        return jsonify(make_response(
+            success=False,
+            message=f"获取合并提交状态出错: {str(e)}",
+            data={}
+        ))
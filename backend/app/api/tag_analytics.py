@@ -2,6 +2,10 @@ from flask import Blueprint, jsonify, request
 from ..database import get_db
 import logging
 from .utils import make_response, parse_json
+from .paging import PAGE_SORT, decode_cursor, after_query, split_page
+from .listing import TAG_LIST_FIELDS, list_projection, fetch_page, decode_list_item, page_sort
+from ..search import search_query, uses_text
+from .pipelines import status_count_fields, status_percentages
 from datetime import datetime, timedelta
 
 # 设置日志
@@ -10,6 +14,12 @@ logger = logging.getLogger(__name__)
 # 创建蓝图，不指定URL前缀，让父蓝图处理
 tag_analytics_bp = Blueprint('tag_analytics', __name__)
 
+# 标签会话列表需要读取的字段
+TAG_PAGE_FIELDS = list_projection(TAG_LIST_FIELDS)
+
+# 状态分布的统计范围：tag为标签下全部会话，filtered为当前筛选结果
+STATS_SCOPES = ['tag', 'filtered']
+
 @tag_analytics_bp.route("/tag/<tag_name>", methods=['GET'])
 def get_tag_analysis(tag_name):
     """
@@ -18,11 +28,13 @@ def get_tag_analysis(tag_name):
     查询参数:
         page (int): 当前页码，默认为1
         pageSize (int): 每页记录数，默认为10
-        searchText (str): 搜索文本，用于搜索会话ID、客户ID或主要问题
+        after (str): 分页游标，取上一页返回的pagination.next；指定时按游标定位，page仅原样返回
+        searchText (str): 搜索文本，匹配会话ID、客户ID前缀及主要问题、摘要和消息内容，未指定after时按相关度排序且不返回游标
         agent (str): 客服名称
         resolutionStatus (str): 解决状态
         timeStart (str): 开始时间
         timeEnd (str): 结束时间
+        statsScope (str): 状态分布的统计范围，tag（默认）统计标签下全部会话，filtered统计当前筛选结果
         
     返回:
         JSON: {
@@ -30,6 +42,7 @@ def get_tag_analysis(tag_name):
             "data": {
                 "tag": str,
                 "count": int,
+                "statsScope": str,
                 "resolved": float,
                 "partially_resolved": float,
                 "unresolved": float,
@@ -48,7 +61,8 @@ def get_tag_analysis(tag_name):
                 "pagination": {
                     "current": int,
                     "pageSize": int,
-                    "total": int
+                    "total": int,
+                    "next": str | null
                 }
             },
             "message": str
@@ -68,21 +82,34 @@ def get_tag_analysis(tag_name):
         status = request.args.get('resolutionStatus')
         time_start = request.args.get('timeStart')
         time_end = request.args.get('timeEnd')
+        stats_scope = request.args.get('statsScope', 'tag')
+        after = request.args.get('after')
+        
+        if stats_scope not in STATS_SCOPES:
+            return jsonify(make_response(
+                success=False,
+                message=f"不支持的统计范围: {stats_scope}",
+                data=None
+            )), 400
+        
+        # 解析分页游标
+        position = None
+        if after:
+            try:
+                position = decode_cursor(after)
+            except ValueError as e:
+                return jsonify(make_response(
+                    success=False,
+                    message=str(e),
+                    data=None
+                )), 400
         
         # 构建查询条件
         query = {'tags': tag_name}
         
-        # 文本搜索
+        # 文本搜索：会话ID、客户ID前缀，以及主要问题、摘要和消息内容的全文检索
         if search_text:
-            # 创建文本搜索条件（ID、客户ID或主要问题）
-            text_query = {
-                '$or': [
-                    {'id': {'$regex': search_text, '$options': 'i'}},
-                    {'customerInfo.userId': {'$regex': search_text, '$options': 'i'}},
-                    {'conversationSummary.mainIssue': {'$regex': search_text, '$options': 'i'}}
-                ]
-            }
-            query.update(text_query)
+            query.update(search_query(search_text))
         
         # 客服筛选
         if agent:
@@ -106,8 +133,38 @@ def get_tag_analysis(tag_name):
         # 获取数据库连接
         db = get_db()
         
-        # 计算总数
-        total = db.conversations.count_documents(query)
+        stats_group = {'$group': {
+            '_id': None,
+            'count': {'$sum': 1},
+            **status_count_fields()
+        }}
+        
+        # 除标签外的筛选条件，按标签统计时只作用于分页和总数；
+        # 全文检索只能出现在管道的第一个$match中，此时按全部条件匹配，标签统计单独聚合
+        separate_stats = stats_scope == 'tag' and uses_text(query)
+        filters = {key: value for key, value in query.items() if key != 'tags'}
+        if stats_scope == 'filtered' or separate_stats:
+            pipeline = [{'$match': query}]
+            filtered_stages = []
+        else:
+            pipeline = [{'$match': {'tags': tag_name}}]
+            filtered_stages = [{'$match': filters}] if filters else []
+        
+        # 单次聚合同时获取当前页会话、筛选结果总数和状态分布，多取一条用于判断是否有下一页
+        facet_stages = {'total': filtered_stages + [{'$count': 'count'}]}
+        if not separate_stats:
+            facet_stages['stats'] = [stats_group]
+        sort = page_sort(query, position)
+        if not position:
+            pipeline.append({'$sort': dict(sort)})
+            facet_stages['page'] = filtered_stages + [{'$skip': (page - 1) * page_size}, {'$limit': page_size + 1}]
+        pipeline += [{'$project': TAG_PAGE_FIELDS}, {'$facet': facet_stages}]
+        result = list(db.conversations.aggregate(pipeline, allowDiskUse=True))
+        facets = result[0] if result else {}
+        total = facets['total'][0]['count'] if facets.get('total') else 0
+        if separate_stats:
+            facets['stats'] = list(db.conversations.aggregate([{'$match': {'tags': tag_name}}, stats_group]))
+        stats = facets['stats'][0] if facets.get('stats') else {}
         
         if total == 0:
             logger.warning(f"未找到标签: {tag_name}")
@@ -117,56 +174,28 @@ def get_tag_analysis(tag_name):
                 data=None
             )), 404
         
-        # 分页查询
-        skip = (page - 1) * page_size
-        cursor = db.conversations.find(query).sort('time', -1).skip(skip).limit(page_size)
-        
-        # 获取所有符合条件的会话（用于统计）
-        all_tag_conversations = list(db.conversations.find({'tags': tag_name}))
-        tag_count = len(all_tag_conversations)
-        
-        # 统计不同解决状态的数量
-        resolved_count = 0
-        partially_resolved_count = 0
-        unresolved_count = 0
-        
-        for conv in all_tag_conversations:
-            resolution_status = conv.get('conversationSummary', {}).get('resolutionStatus', {}).get('status', '')
-            if resolution_status.lower() == '已解决':
-                resolved_count += 1
-            elif resolution_status.lower() == '部分解决':
-                partially_resolved_count += 1
-            else:
-                unresolved_count += 1
-        
-        # 计算百分比
-        resolved_percentage = (resolved_count / tag_count) * 100 if tag_count > 0 else 0
-        partially_resolved_percentage = (partially_resolved_count / tag_count) * 100 if tag_count > 0 else 0
-        unresolved_percentage = (unresolved_count / tag_count) * 100 if tag_count > 0 else 0
+        percentages = status_percentages(stats)
+        
+        # 指定游标时当前页通过索引范围查询单独读取，$facet子管道无法使用索引
+        if position:
+            page_docs = fetch_page(db.conversations, after_query(query, position), TAG_LIST_FIELDS,
+                                   limit=page_size + 1)
+        else:
+            page_docs = facets.get('page', [])
+        docs, next_after = split_page(page_docs, page_size)
+        if sort != PAGE_SORT:
+            # 按相关度排序时游标无法定位，使用page翻页
+            next_after = None
         
         # 格式化会话数据
-        conversations = []
-        for doc in cursor:
-            # 确保所有必要字段都存在
-            conversations.append({
-                'id': doc.get('id', ''),
-                'title': doc.get('title', '无标题会话'),
-                'time': doc.get('time', ''),
-                'agent': doc.get('agent', ''),
-                'customerId': doc.get('customerInfo', {}).get('userId', '未知用户'),
-                'mainIssue': doc.get('conversationSummary', {}).get('mainIssue', '未分类问题'),
-                'status': doc.get('conversationSummary', {}).get('resolutionStatus', {}).get('status', '未解决'),
-                'satisfaction': doc.get('metrics', {}).get('satisfaction', {}).get('value', 0),
-                "resolution": doc.get('metrics', {}).get('resolution', {}).get('value', 0),
-                "attitude": doc.get('metrics', {}).get('attitude', {}).get('value', 0),
-                "security": doc.get('metrics', {}).get('security', {}).get('value', 0)
-            })
+        conversations = [decode_list_item(doc, TAG_LIST_FIELDS) for doc in docs]
         
         # 构建分页数据
         pagination = {
             'current': page,
             'pageSize': page_size,
-            'total': total
+            'total': total,
+            'next': next_after
         }
         
         return jsonify(make_response(
@@ -174,10 +203,9 @@ def get_tag_analysis(tag_name):
             message="获取标签分析数据成功",
             data={
                 "tag": tag_name,
-                "count": tag_count,
-                "resolved": resolved_percentage,
-                "partially_resolved": partially_resolved_percentage,
-                "unresolved": unresolved_percentage,
+                "count": stats.get('count', 0),
+                "statsScope": stats_scope,
+                **percentages,
                 "conversations": conversations,
                 "pagination": pagination
             }
@@ -1,4 +1,5 @@
 import os
+import json
 from dotenv import load_dotenv
 
 # 加载.env文件
@@ -9,6 +10,76 @@ class Config:
     # MongoDB配置
     MONGODB_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/')
     DB_NAME = os.getenv('DB_NAME', 'convoinsight-danghuan')
+
+    # MongoDB连接池配置
+    MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', 100))
+    MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', 0))
+    MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv('MONGO_WAIT_QUEUE_TIMEOUT_MS', 0)) or None
+    MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', 30000))
+
+    # 热词统计配置：每个范围保留的计数器数量和持久化间隔（秒）
+    HOTWORDS_CAPACITY = int(os.getenv('HOTWORDS_CAPACITY', 500))
+    HOTWORDS_FLUSH_SECONDS = float(os.getenv('HOTWORDS_FLUSH_SECONDS', 10))
+
+    # ID自动补全缓存：缓存条目数和有效期（秒）
+    AUTOCOMPLETE_CACHE_SIZE = int(os.getenv('AUTOCOMPLETE_CACHE_SIZE', 1024))
+    AUTOCOMPLETE_CACHE_TTL = float(os.getenv('AUTOCOMPLETE_CACHE_TTL', 30))
+
+    # 列表总数统计：默认策略（默认精确计数，缓存等近似策略需显式启用）、缓存条目数、缓存有效期（秒）和封顶计数上限
+    COUNT_STRATEGY = os.getenv('COUNT_STRATEGY', 'exact')
+    COUNT_CACHE_SIZE = int(os.getenv('COUNT_CACHE_SIZE', 256))
+    COUNT_CACHE_TTL = float(os.getenv('COUNT_CACHE_TTL', 60))
+    COUNT_CAP = int(os.getenv('COUNT_CAP', 10000))
+
+    # 批量写入时每批的会话数
+    INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', 1000))
+
+    # Excel导入：每个分块的行数、工作进程数（0为CPU核数）、同时在途的分块数上限（0为工作进程数的2倍）
+    EXCEL_CHUNK_SIZE = int(os.getenv('EXCEL_CHUNK_SIZE', 500))
+    EXCEL_WORKERS = int(os.getenv('EXCEL_WORKERS', 0))
+    EXCEL_MAX_IN_FLIGHT = int(os.getenv('EXCEL_MAX_IN_FLIGHT', 0))
+
+    # 单条创建的合并提交：是否启用、每批最大条数、最长等待（毫秒）、队列上限、
+    # 队列满时等待入队的秒数和等待写入确认的秒数
+    WRITE_BEHIND_ENABLED = os.getenv('WRITE_BEHIND_ENABLED', 'False').lower() == 'true'
+    WRITE_BEHIND_BATCH_SIZE = int(os.getenv('WRITE_BEHIND_BATCH_SIZE', 500))
+    WRITE_BEHIND_MAX_DELAY_MS = float(os.getenv('WRITE_BEHIND_MAX_DELAY_MS', 50))
+    WRITE_BEHIND_QUEUE_SIZE = int(os.getenv('WRITE_BEHIND_QUEUE_SIZE', 10000))
+    WRITE_BEHIND_ENQUEUE_TIMEOUT = float(os.getenv('WRITE_BEHIND_ENQUEUE_TIMEOUT', 5))
+    WRITE_BEHIND_ACK_TIMEOUT = float(os.getenv('WRITE_BEHIND_ACK_TIMEOUT', 30))
+
+    # 会话分析：模型客户端（openai或"模块路径:类名"）、模型名称、兼容接口地址和密钥、
+    # 并发数、每分钟调用上限（0为不限）及突发数、重试次数、退避基数和上限（秒）、调用超时（秒）、每批写回的会话数
+    ENRICH_CLIENT = os.getenv('ENRICH_CLIENT', 'openai')
+    ENRICH_MODEL = os.getenv('ENRICH_MODEL', 'gpt-4o-mini')
+    ENRICH_BASE_URL = os.getenv('ENRICH_BASE_URL', '')
+    ENRICH_API_KEY = os.getenv('ENRICH_API_KEY', os.getenv('OPENAI_API_KEY', ''))
+    ENRICH_CONCURRENCY = int(os.getenv('ENRICH_CONCURRENCY', 8))
+    ENRICH_RATE_PER_MINUTE = float(os.getenv('ENRICH_RATE_PER_MINUTE', 0))
+    ENRICH_BURST = int(os.getenv('ENRICH_BURST', 8))
+    ENRICH_MAX_RETRIES = int(os.getenv('ENRICH_MAX_RETRIES', 4))
+    ENRICH_BACKOFF_BASE = float(os.getenv('ENRICH_BACKOFF_BASE', 1))
+    ENRICH_BACKOFF_MAX = float(os.getenv('ENRICH_BACKOFF_MAX', 30))
+    ENRICH_TIMEOUT = float(os.getenv('ENRICH_TIMEOUT', 60))
+    ENRICH_BATCH_SIZE = int(os.getenv('ENRICH_BATCH_SIZE', 50))
+
+    # 模型结果缓存：是否启用、条目最后一次使用后保留的天数（由TTL索引淘汰，修改后启动时自动更新索引）
+    LLM_CACHE_ENABLED = os.getenv('LLM_CACHE_ENABLED', 'True').lower() == 'true'
+    LLM_CACHE_TTL_DAYS = float(os.getenv('LLM_CACHE_TTL_DAYS', 90))
+
+    # 模型单价（每千token），LLM_PRICES按模型覆盖，格式 {"模型": [输入单价, 输出单价]}
+    LLM_PRICE_INPUT_PER_1K = float(os.getenv('LLM_PRICE_INPUT_PER_1K', 0.00015))
+    LLM_PRICE_OUTPUT_PER_1K = float(os.getenv('LLM_PRICE_OUTPUT_PER_1K', 0.0006))
+    LLM_PRICES = json.loads(os.getenv('LLM_PRICES', '{}'))
+
+    # 任务队列：租约时长（秒）、空闲时的轮询间隔（秒）、默认最大尝试次数、失败重试的退避基数（秒）
+    JOBS_LEASE_SECONDS = float(os.getenv('JOBS_LEASE_SECONDS', 300))
+    JOBS_POLL_INTERVAL = float(os.getenv('JOBS_POLL_INTERVAL', 2))
+    JOBS_MAX_ATTEMPTS = int(os.getenv('JOBS_MAX_ATTEMPTS', 3))
+    JOBS_RETRY_BACKOFF = float(os.getenv('JOBS_RETRY_BACKOFF', 30))
+
+    # 启动时是否在后台创建索引注册表中的索引
+    INDEX_BUILD_ON_STARTUP = os.getenv('INDEX_BUILD_ON_STARTUP', 'True').lower() == 'true'
     
     # 应用配置
     PORT = int(os.getenv('PORT', 5000))
@@ -1,44 +1,216 @@
 from flask import Flask, current_app, g
-from pymongo import MongoClient
+from pymongo import MongoClient, monitoring
+import atexit
 import logging
+import os
+import threading
+import time
 
 # 设置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 进程级共享的MongoClient，按PID区分以保证fork安全
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """连接池事件监听器，统计连接的创建、检出和归还情况，用于评估连接池大小"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checkout_started = {}
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.connections_created = 0
+            self.connections_closed = 0
+            self.checkouts_started = 0
+            self.checkouts_succeeded = 0
+            self.checkouts_failed = 0
+            self.checkins = 0
+            self.checked_out = 0
+            self.max_checked_out = 0
+            self.total_wait_ms = 0.0
+            self.max_wait_ms = 0.0
+            self.pool_clears = 0
+            self.failure_reasons = {}
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pool_clears += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self.connections_created += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.connections_closed += 1
+
+    def connection_check_out_started(self, event):
+        with self._lock:
+            self.checkouts_started += 1
+            self._checkout_started[threading.get_ident()] = time.perf_counter()
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkouts_failed += 1
+            reason = str(event.reason)
+            self.failure_reasons[reason] = self.failure_reasons.get(reason, 0) + 1
+            self._checkout_started.pop(threading.get_ident(), None)
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.checkouts_succeeded += 1
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self.checked_out)
+            started = self._checkout_started.pop(threading.get_ident(), None)
+            if started is not None:
+                wait_ms = (time.perf_counter() - started) * 1000
+                self.total_wait_ms += wait_ms
+                self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checkins += 1
+            self.checked_out = max(self.checked_out - 1, 0)
+
+    def snapshot(self):
+        """返回当前统计数据的快照"""
+        with self._lock:
+            succeeded = self.checkouts_succeeded
+            return {
+                'connectionsCreated': self.connections_created,
+                'connectionsClosed': self.connections_closed,
+                'openConnections': self.connections_created - self.connections_closed,
+                'checkoutsStarted': self.checkouts_started,
+                'checkoutsSucceeded': succeeded,
+                'checkoutsFailed': self.checkouts_failed,
+                'checkins': self.checkins,
+                'checkedOut': self.checked_out,
+                'maxCheckedOut': self.max_checked_out,
+                'avgWaitMs': self.total_wait_ms / succeeded if succeeded > 0 else 0,
+                'maxWaitMs': self.max_wait_ms,
+                'poolClears': self.pool_clears,
+                'failureReasons': dict(self.failure_reasons)
+            }
+
+
+pool_stats = PoolStatsListener()
+
+
+def get_client(config=None):
+    """获取进程级共享的MongoClient
+
+    首次调用时按配置创建客户端；若检测到进程已fork（PID变化），
+    则丢弃从父进程继承的客户端并重新创建，避免多个进程共用同一套套接字。
+
+    Args:
+        config: 配置映射，默认使用当前应用的配置
+
+    Returns:
+        MongoClient实例
+    """
+    global _client, _client_pid
+
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+
+    if config is None:
+        config = current_app.config
+
+    with _client_lock:
+        if _client is None or _client_pid != pid:
+            if _client is not None:
+                # fork后继承的客户端不可再用，直接丢弃引用而不关闭父进程的连接
+                logger.info("检测到进程fork，重新创建MongoDB客户端")
+                pool_stats.reset()
+            try:
+                _client = MongoClient(
+                    config['MONGODB_URI'],
+                    maxPoolSize=config.get('MONGO_MAX_POOL_SIZE', 100),
+                    minPoolSize=config.get('MONGO_MIN_POOL_SIZE', 0),
+                    waitQueueTimeoutMS=config.get('MONGO_WAIT_QUEUE_TIMEOUT_MS'),
+                    serverSelectionTimeoutMS=config.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 30000),
+                    event_listeners=[pool_stats],
+                    connect=False
+                )
+                _client_pid = pid
+                logger.info(f"已创建MongoDB连接池: {config['DB_NAME']} (pid={pid})")
+            except Exception as e:
+                logger.error(f"MongoDB连接失败: {str(e)}")
+                raise e
+
+    return _client
+
+
+def get_pool_stats():
+    """获取连接池配置和检出统计"""
+    options = _client.options.pool_options if _client is not None else None
+    return {
+        'pid': _client_pid,
+        'initialized': _client is not None and _client_pid == os.getpid(),
+        'maxPoolSize': options.max_pool_size if options else None,
+        'minPoolSize': options.min_pool_size if options else None,
+        'waitQueueTimeoutMS': options.wait_queue_timeout * 1000 if options and options.wait_queue_timeout else None,
+        'stats': pool_stats.snapshot()
+    }
+
+
 def get_db():
     """获取数据库连接"""
     if 'db' not in g:
-        try:
-            # 创建MongoDB客户端连接
-            client = MongoClient(current_app.config['MONGODB_URI'])
-            # 获取数据库
-            db = client[current_app.config['DB_NAME']]
-            g.client = client
-            g.db = db
-            logger.info(f"已连接到MongoDB: {current_app.config['DB_NAME']}")
-        except Exception as e:
-            logger.error(f"MongoDB连接失败: {str(e)}")
-            raise e
-    
+        g.db = get_client()[current_app.config['DB_NAME']]
+
     return g.db
 
+
 def close_db(e=None):
-    """关闭数据库连接"""
-    client = g.pop('client', None)
-    
-    if client is not None:
-        client.close()
-        logger.info("MongoDB连接已关闭")
+    """释放请求上下文中的数据库引用
+
+    连接由进程级连接池管理，请求结束时不再关闭客户端。
+    """
+    g.pop('db', None)
+
+
+def close_client():
+    """关闭进程级共享的MongoClient，用于进程退出时释放连接"""
+    global _client, _client_pid
+
+    with _client_lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+            logger.info("MongoDB连接池已关闭")
+        _client = None
+        _client_pid = None
+
 
 def init_db(app: Flask):
     """初始化数据库"""
-    # 注册关闭连接的回调
+    # 注册请求结束时的回调
     app.teardown_appcontext(close_db)
-    
-    # 创建索引等初始化操作
-    with app.app_context():
-        db = get_db()
-        # 确保conversations集合上有索引
-        db.conversations.create_index("id", unique=True)
-        logger.info("MongoDB索引已创建")
+    atexit.register(close_client)
+
+    # 唯一索引关系到数据正确性，启动时同步创建；其余索引在后台线程中创建
+    from .indexes import ensure_indexes, build_in_background
+    db = get_client(app.config)[app.config['DB_NAME']]
+    ensure_indexes(db, sync_only=True)
+    if app.config.get('INDEX_BUILD_ON_STARTUP', True):
+        build_in_background(db)
@@ -0,0 +1,14 @@
+"""
+会话分析模块
+将原始会话文本交给模型做结构化抽取和分析，结果写回会话集合
+
+    prompts    提示词、提示词版本和输出校验
+    client     可替换的模型客户端
+    ratelimit  令牌桶限流和重试退避
+    cache      按会话文本、提示词版本和模型缓存模型结果
+    usage      token用量、延迟和成本核算
+    worker     并发分析任务
+"""
+from . import cache, usage
+from .client import ModelError, load_client
+from .worker import Enricher, enrich, pending_query
@@ -0,0 +1,103 @@
+"""
+模型结果缓存
+按 (原始会话文本, 提示词版本, 模型) 的哈希缓存解析后的模型输出和token用量
+
+会话文本和提示词都没有变化时直接复用缓存结果，不再调用模型；修改某个阶段的提示词并递增其版本后，
+只有该阶段需要重新调用模型。长期未命中的条目由lastUsedAt上的TTL索引自动淘汰，
+旧提示词版本的条目可用compact命令清理。
+"""
+import hashlib
+import json
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+from . import prompts
+
+# 缓存集合
+COLLECTION = 'llm_cache'
+
+# 当前使用的提示词版本，compact时保留
+CURRENT_VERSIONS = [prompts.EXTRACT_PROMPT_VERSION, prompts.ANALYZE_PROMPT_VERSION]
+
+
+def cache_key(conversation, prompt_version, model):
+    """缓存键：原始会话文本、提示词版本和模型名称的SHA-256"""
+    payload = json.dumps([conversation, prompt_version, model], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def lookup(db, keys):
+    """一次查询取回多个缓存条目
+
+    Returns:
+        {键: {'result', 'tokens'}}
+    """
+    if not keys:
+        return {}
+    return {
+        entry['_id']: entry
+        for entry in db[COLLECTION].find({'_id': {'$in': list(set(keys))}}, {'result': 1, 'tokens': 1})
+    }
+
+
+def store_operation(key, prompt_version, model, result, tokens):
+    """生成写入缓存条目的操作，已存在的条目保持不变"""
+    now = datetime.utcnow()
+    return UpdateOne(
+        {'_id': key},
+        {
+            '$setOnInsert': {
+                'promptVersion': prompt_version,
+                'model': model,
+                'result': result,
+                'tokens': tokens,
+                'hits': 0,
+                'createdAt': now
+            },
+            '$set': {'lastUsedAt': now}
+        },
+        upsert=True
+    )
+
+
+def hit_operation(key):
+    """生成记录一次命中的操作"""
+    return UpdateOne({'_id': key}, {'$inc': {'hits': 1}, '$set': {'lastUsedAt': datetime.utcnow()}})
+
+
+def cache_stats(db):
+    """按提示词版本和模型统计缓存条目数、累计命中次数和节省的token数"""
+    rows = list(db[COLLECTION].aggregate([
+        {'$group': {
+            '_id': {'promptVersion': '$promptVersion', 'model': '$model'},
+            'entries': {'$sum': 1},
+            'hits': {'$sum': '$hits'},
+            'tokensSaved': {'$sum': {'$multiply': ['$hits', {'$ifNull': ['$tokens', 0]}]}}
+        }},
+        {'$sort': {'_id.promptVersion': 1, '_id.model': 1}}
+    ]))
+    return [
+        {
+            'promptVersion': row['_id'].get('promptVersion'),
+            'model': row['_id'].get('model'),
+            'current': row['_id'].get('promptVersion') in CURRENT_VERSIONS,
+            'entries': row['entries'],
+            'hits': row['hits'],
+            'tokensSaved': row['tokensSaved']
+        }
+        for row in rows
+    ]
+
+
+def compact(db, older_than_days=None, dry_run=False):
+    """清理不再使用的提示词版本的条目，以及超过older_than_days天未命中的条目
+
+    Returns:
+        删除（dry_run时为将删除）的条目数
+    """
+    conditions = [{'promptVersion': {'$nin': CURRENT_VERSIONS}}]
+    if older_than_days is not None:
+        conditions.append({'lastUsedAt': {'$lt': datetime.utcnow() - timedelta(days=older_than_days)}})
+    query = {'$or': conditions}
+    if dry_run:
+        return db[COLLECTION].count_documents(query)
+    return db[COLLECTION].delete_many(query).deleted_count
@@ -0,0 +1,81 @@
+"""
+模型客户端
+封装对话补全调用，返回模型输出文本和token用量
+
+默认使用OpenAI兼容接口，base_url可指向DeepSeek等兼容服务或本地压测用的模拟服务；
+也可以通过ENRICH_CLIENT指定 "模块路径:类名" 接入其他实现，类需提供
+__init__(model, base_url, api_key, timeout) 和异步方法 complete(system_prompt, user_prompt)。
+"""
+import importlib
+
+
+class ModelError(Exception):
+    """模型调用失败"""
+
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class OpenAIClient:
+    """OpenAI兼容的对话补全客户端，要求以JSON对象格式输出"""
+
+    def __init__(self, model, base_url=None, api_key=None, timeout=60):
+        try:
+            from openai import AsyncOpenAI
+        except ImportError:
+            raise RuntimeError("调用模型需要安装openai: pip install openai")
+
+        self.model = model
+        self._client = AsyncOpenAI(api_key=api_key or None, base_url=base_url or None, timeout=timeout, max_retries=0)
+
+    async def complete(self, system_prompt, user_prompt):
+        """调用模型
+
+        Returns:
+            (输出文本, {'prompt_tokens', 'completion_tokens', 'total_tokens'})
+
+        Raises:
+            ModelError: 调用失败，retryable表示是否值得重试
+        """
+        import openai
+
+        try:
+            response = await self._client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {'role': 'system', 'content': system_prompt},
+                    {'role': 'user', 'content': user_prompt}
+                ],
+                stream=False,
+                response_format={'type': 'json_object'}
+            )
+        except (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError) as e:
+            raise ModelError(f"模型调用失败: {str(e)}")
+        except openai.APIStatusError as e:
+            raise ModelError(f"模型调用失败: {str(e)}", retryable=e.status_code in (408, 409, 429))
+
+        usage = response.usage
+        return response.choices[0].message.content, {
+            'prompt_tokens': getattr(usage, 'prompt_tokens', 0) or 0,
+            'completion_tokens': getattr(usage, 'completion_tokens', 0) or 0,
+            'total_tokens': getattr(usage, 'total_tokens', 0) or 0
+        }
+
+
+# 内置客户端
+CLIENTS = {
+    'openai': OpenAIClient
+}
+
+
+def load_client(spec, model, base_url=None, api_key=None, timeout=60):
+    """按名称或 "模块路径:类名" 创建模型客户端"""
+    if spec in CLIENTS:
+        client_class = CLIENTS[spec]
+    else:
+        module_name, _, class_name = spec.partition(':')
+        if not class_name:
+            raise ValueError(f"未知的模型客户端: {spec}，可选 {', '.join(CLIENTS)} 或 模块路径:类名")
+        client_class = getattr(importlib.import_module(module_name), class_name)
+    return client_class(model, base_url=base_url, api_key=api_key, timeout=timeout)
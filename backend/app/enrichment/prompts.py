@@ -0,0 +1,185 @@
+"""
+模型提示词
+会话结构化抽取和会话分析两个阶段的提示词，以及对模型输出的结构校验
+
+修改提示词或输出结构时同步递增对应的版本号，分析结果会记录所用版本。
+"""
+
+# 提示词版本
+EXTRACT_PROMPT_VERSION = 'extract-v1'
+ANALYZE_PROMPT_VERSION = 'analyze-v1'
+
+# 结构化抽取：由原始会话文本生成客服、客户信息和消息列表
+EXTRACT_SYSTEM_PROMPT = """请将以下客服会话数据转换成结构化的JSON格式。根据对话内容提取相关信息，并按照以下结构组织：
+
+1. 生成唯一会话ID（如果原始数据中没有明确ID，可使用时间戳或随机字符串）
+2. 确定客服人员姓名
+3. 提取客户信息（手机号或用户ID）
+4. 分析互动情况（总消息数、客服消息数、客户消息数）
+5. 按顺序整理所有消息，包括:
+   - 消息类型（系统/客服/客户）
+   - 消息内容
+   - 发送者
+   - 对客户消息添加情感分析（正向/中立/负向）
+
+请使用以下JSON结构：
+
+{
+  "agent": "客服姓名",
+  "customerInfo": {
+    "userId": "客户ID或手机号",
+    "device": "相关设备信息（如有）",
+    "history": "客户历史信息（如有）"
+  },
+  "interactionAnalysis": {
+    "totalMessages": 消息总数,
+    "agentMessages": 客服消息数,
+    "userMessages": 客户消息数
+  },
+  "messages": [
+    {
+      "type": "消息类型（system/agent/user）",
+      "content": "消息内容",
+      "sender": "发送者名称/ID",
+      "sentiment": "情感分析（仅用户消息需要）"
+    },
+    // 更多消息...
+  ]
+}
+"""
+
+# 会话分析：生成指标、摘要、标签、热词和改进建议
+ANALYZE_SYSTEM_PROMPT = """# 客服对话结构化分析
+你是一个有着十年专业经验的客服总监，现在需要基于客户对话进行会话内容的分析和诊断
+## 任务描述
+分析以下客服与客户的对话内容，将其转化为结构化数据，包括:
+1. 客户满意度、问题解决程度、客服态度和安全风险评估等关键指标
+2. 对话摘要和主要问题识别
+3. 问题解决情况及解决方案
+4. 相关标签和关键词提取
+5. 客服改进建议
+
+## 分析指南
+1. **对话指标评估**:
+   - 客户满意度(0-100): 根据客户回应的积极程度、问题解决情况评估
+   - 问题解决程度(0-100): 根据客户问题是否得到全面解答评估
+   - 客服态度(0-100): 根据客服回应的礼貌度、专业性、响应速度评估
+   - 安全评估(0-100): 分析对话中可能存在的安全隐患，数值越高代表越安全
+2. **对话摘要**:
+   - 提取对话的主要主题和要点，用1-2句话概括
+3. **对话详细分析**:
+   - 识别客户的主要问题
+   - 确定问题解决状态(已解决/部分解决/未解决/无法解决)
+   - 概括客服提供的解决方案
+4. **标签和关键词**:
+   - 标签：根据对话内容提取最匹配的相关标签
+   - 关键词：识别客户对话中出现的热门词汇或产品名称
+5. **改进建议**:
+   - 根据对话分析，提供2-4条客服可以改进的具体建议
+
+## 输出格式
+请按以下JSON格式输出分析结果:
+
+```json
+{
+  "metrics": {
+    "satisfaction": { "value": 0-100 },
+    "resolution": { "value": 0-100 },
+    "attitude": { "value": 0-100 },
+    "security": { "value": 0-100 }
+  },
+  "summary": "一句话总结对话内容",
+  "conversationSummary": {
+    "mainIssue": "客户主要问题",
+    "resolutionStatus": {
+      "status": "已解决/部分解决/未解决/无法解决",
+      "description": "解决方案描述"
+    },
+    "mainSolution": "客服提供的主要解决方案"
+  },
+  "tags": ["标签1"],
+  "improvementSuggestions": [
+    "改进建议1",
+    "改进建议2",
+    "改进建议3"
+  ],
+  "hotWords": ["关键词1", "关键词2", "关键词3"]
+}
+```
+## 特别注意事项
+1. 所有评分必须基于客观事实，避免主观臆断
+2. 标签应精准反映对话主题和产品类别
+3. 改进建议应具体、可操作且有建设性
+4. 如对话未明确表明某信息，应做合理推断并注明
+"""
+
+# 分析结果必需的字段及类型
+ANALYZE_REQUIRED_FIELDS = {
+    'metrics': dict,
+    'summary': str,
+    'conversationSummary': dict,
+    'tags': list,
+    'improvementSuggestions': list,
+    'hotWords': list
+}
+
+# 抽取结果必需的字段及类型
+EXTRACT_REQUIRED_FIELDS = {
+    'agent': str,
+    'customerInfo': dict,
+    'messages': list
+}
+
+
+def extract_user_prompt(conversation):
+    """结构化抽取的用户提示词"""
+    return f"""# 原始会话数据：
+{conversation}
+请根据上述要求将原始会话数据转换为结构化的JSON格式。
+"""
+
+
+def analyze_user_prompt(conversation):
+    """会话分析的用户提示词"""
+    return f"""# 原始会话数据：
+{conversation}
+"""
+
+
+def _check_fields(data, required):
+    if not isinstance(data, dict):
+        return "模型输出不是JSON对象"
+    for key, expected_type in required.items():
+        if not isinstance(data.get(key), expected_type):
+            return f"模型输出缺少字段或类型错误: {key}"
+    return None
+
+
+def validate_extraction(data):
+    """校验结构化抽取结果
+
+    Returns:
+        错误信息，校验通过时返回None
+    """
+    return _check_fields(data, EXTRACT_REQUIRED_FIELDS)
+
+
+def validate_analysis(data):
+    """校验会话分析结果
+
+    Returns:
+        错误信息，校验通过时返回None
+    """
+    error = _check_fields(data, ANALYZE_REQUIRED_FIELDS)
+    if error:
+        return error
+    for key in ('satisfaction', 'resolution', 'attitude', 'security'):
+        if not isinstance(data['metrics'].get(key), dict):
+            return f"模型输出缺少指标: metrics.{key}"
+    for key in ('mainIssue', 'resolutionStatus', 'mainSolution'):
+        if key not in data['conversationSummary']:
+            return f"模型输出缺少字段: conversationSummary.{key}"
+    resolution_status = data['conversationSummary']['resolutionStatus']
+    if not isinstance(resolution_status, dict) or not all(key in resolution_status for key in ('status', 'description')):
+        return "模型输出缺少字段: conversationSummary.resolutionStatus"
+    return None
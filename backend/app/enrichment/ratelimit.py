@@ -0,0 +1,41 @@
+"""
+限流与重试退避
+令牌桶控制模型调用速率，指数退避加随机抖动分散重试时间
+"""
+import asyncio
+import random
+import time
+
+
+class TokenBucket:
+    """异步令牌桶：每秒补充rate个令牌，最多积累capacity个，rate为0表示不限速
+
+    只在同一个事件循环中使用，取令牌时不需要加锁。
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.waited = 0.0
+
+    async def acquire(self):
+        """取一个令牌，令牌不足时等待"""
+        if self.rate <= 0:
+            return
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            delay = (1 - self.tokens) / self.rate
+            self.waited += delay
+            await asyncio.sleep(delay)
+
+
+def backoff_delay(attempt, base=1.0, cap=30.0):
+    """第attempt次重试前的等待秒数：在[0, min(cap, base * 2^attempt)]内均匀随机"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
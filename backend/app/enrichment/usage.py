@@ -0,0 +1,260 @@
+"""
+模型用量核算
+按 (模型, 提示词版本, 日期, 客服) 增量累计调用次数、失败次数、token用量和调用延迟分布，
+每次分析任务结束时另记一条运行记录（并发数、批大小、耗时、吞吐、成本），用于调整并发数和批大小。
+
+用量在内存中累计，随分析结果按批以$inc写入；多个工作进程写同一组维度时可能产生多行，
+报表按维度求和，不影响结果。延迟按固定分桶计数，p50/p95取所在桶的上界。
+"""
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+from ..config import Config
+
+# 用量集合和运行记录集合
+COLLECTION = 'llm_usage'
+RUNS_COLLECTION = 'llm_runs'
+
+# 延迟分桶上界（毫秒），超过最后一个上界的调用计入 'inf'
+LATENCY_BUCKETS_MS = [250, 500, 1000, 2000, 4000, 8000, 15000, 30000, 60000]
+
+# 可累加的计数字段
+COUNTER_FIELDS = [
+    'calls', 'errors', 'promptTokens', 'completionTokens', 'totalTokens', 'latencyMs',
+    'conversations', 'cacheHits', 'tokensSaved'
+]
+
+# 报表支持的分组维度
+GROUP_FIELDS = ['model', 'promptVersion', 'day', 'agent']
+
+
+def latency_bucket(latency_ms):
+    """延迟所在分桶的名称"""
+    for bound in LATENCY_BUCKETS_MS:
+        if latency_ms <= bound:
+            return str(bound)
+    return 'inf'
+
+
+def percentile(histogram, q):
+    """按分桶计数估计延迟分位数（毫秒），没有调用时返回None"""
+    total = sum(histogram.values())
+    if not total:
+        return None
+    cumulative = 0
+    for bound in LATENCY_BUCKETS_MS:
+        cumulative += histogram.get(str(bound), 0)
+        if cumulative >= q * total:
+            return bound
+    return LATENCY_BUCKETS_MS[-1]
+
+
+def price(model):
+    """模型的 (输入, 输出) 每千token单价，LLM_PRICES未配置的模型使用默认单价"""
+    prices = Config.LLM_PRICES.get(model)
+    if prices:
+        return float(prices[0]), float(prices[1])
+    return Config.LLM_PRICE_INPUT_PER_1K, Config.LLM_PRICE_OUTPUT_PER_1K
+
+
+def cost(model, prompt_tokens, completion_tokens, total_tokens=0):
+    """按单价计算成本，只记录了总量的部分（如历史数据）按输入单价估算"""
+    input_price, output_price = price(model)
+    unsplit = max(total_tokens - prompt_tokens - completion_tokens, 0)
+    return ((prompt_tokens + unsplit) * input_price + completion_tokens * output_price) / 1000
+
+
+class UsageRecorder:
+    """在内存中累计用量，drain时生成写入操作
+
+    分析在事件循环中记录，写回在线程中进行，两边通过锁交接。
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self._lock = threading.Lock()
+        self._rows = defaultdict(lambda: defaultdict(int))
+
+    def _row(self, prompt_version, agent):
+        day = datetime.now().strftime("%Y-%m-%d")
+        return self._rows[(prompt_version, day, agent or '')]
+
+    def record_call(self, prompt_version, agent, latency, usage=None, error=False):
+        """记录一次模型调用，latency为秒，usage为客户端返回的token用量"""
+        usage = usage or {}
+        with self._lock:
+            row = self._row(prompt_version, agent)
+            row['calls'] += 1
+            row['errors'] += 1 if error else 0
+            row['promptTokens'] += usage.get('prompt_tokens') or 0
+            row['completionTokens'] += usage.get('completion_tokens') or 0
+            row['totalTokens'] += usage.get('total_tokens') or 0
+            row['latencyMs'] += int(latency * 1000)
+            row[f'latency.{latency_bucket(latency * 1000)}'] += 1
+
+    def record_cache_hit(self, prompt_version, agent, tokens_saved):
+        """记录一次缓存命中"""
+        with self._lock:
+            row = self._row(prompt_version, agent)
+            row['cacheHits'] += 1
+            row['tokensSaved'] += tokens_saved or 0
+
+    def record_conversation(self, prompt_version, agent):
+        """记录一个分析完成的会话，用于计算单个会话的成本"""
+        with self._lock:
+            self._row(prompt_version, agent)['conversations'] += 1
+
+    def drain(self):
+        """取出累计的用量，返回$inc写入操作"""
+        with self._lock:
+            rows, self._rows = self._rows, defaultdict(lambda: defaultdict(int))
+        return [
+            UpdateOne(
+                {'model': self.model, 'promptVersion': prompt_version, 'day': day, 'agent': agent},
+                {'$inc': dict(counters)},
+                upsert=True
+            )
+            for (prompt_version, day, agent), counters in rows.items()
+        ]
+
+
+def record_run(db, model, options, report):
+    """保存一次分析任务的运行记录
+
+    Args:
+        model: 模型名称
+        options: 运行参数（并发数、批大小、限速）
+        report: Enricher.snapshot的结果
+    """
+    finished = datetime.now()
+    run_cost = cost(model, report.get('promptTokens', 0), report.get('completionTokens', 0), report.get('tokens', 0))
+    db[RUNS_COLLECTION].insert_one({
+        'model': model,
+        'startedAt': finished - timedelta(seconds=report['elapsed']),
+        'finishedAt': finished,
+        'options': options,
+        **{key: report[key] for key in [
+            'processed', 'succeeded', 'failed', 'calls', 'retries', 'tokens', 'cacheHits', 'elapsed'
+        ]},
+        'cost': run_cost
+    })
+
+
+def _summarize(rows, model_of):
+    """合并多行用量并计算吞吐、延迟分位数、错误率和成本"""
+    totals = defaultdict(int)
+    histogram = defaultdict(int)
+    total_cost = 0.0
+    for row in rows:
+        for field in COUNTER_FIELDS:
+            totals[field] += row.get(field) or 0
+        for bucket, count in (row.get('latency') or {}).items():
+            histogram[bucket] += count
+        total_cost += cost(
+            model_of(row), row.get('promptTokens') or 0, row.get('completionTokens') or 0, row.get('totalTokens') or 0
+        )
+    # 历史回填的行没有延迟，吞吐只按有调用记录的行计算
+    timed_tokens = sum(row.get('totalTokens') or 0 for row in rows if row.get('latencyMs'))
+    latency_seconds = totals['latencyMs'] / 1000
+    calls = totals['calls']
+    return {
+        **{field: totals[field] for field in COUNTER_FIELDS if field != 'latencyMs'},
+        'errorRate': totals['errors'] / calls if calls else 0,
+        'tokensPerSecond': timed_tokens / latency_seconds if latency_seconds else 0,
+        'avgLatencyMs': totals['latencyMs'] / calls if calls else 0,
+        'p50LatencyMs': percentile(histogram, 0.5),
+        'p95LatencyMs': percentile(histogram, 0.95),
+        'cost': round(total_cost, 6),
+        'costPerConversation': total_cost / totals['conversations'] if totals['conversations'] else None
+    }
+
+
+def usage_report(db, days=7, model=None, group_by='day', pending=0, runs=10):
+    """用量报表
+
+    Args:
+        days: 统计最近多少天（含今天）
+        model: 只统计指定模型
+        group_by: 分组维度，model、promptVersion、day或agent
+        pending: 待分析的会话数，用于估算剩余成本
+        runs: 返回最近多少次运行记录
+
+    Returns:
+        {'totals', 'groups', 'projection', 'runs'}
+    """
+    start = (datetime.now() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    query = {'day': {'$gte': start}}
+    if model:
+        query['model'] = model
+    rows = list(db[COLLECTION].find(query, {'_id': 0}))
+
+    def model_of(row):
+        return row.get('model')
+
+    groups = defaultdict(list)
+    for row in rows:
+        groups[row.get(group_by)].append(row)
+
+    totals = _summarize(rows, model_of)
+    active_days = len({row['day'] for row in rows})
+    daily_cost = totals['cost'] / active_days if active_days else 0
+    per_conversation = totals['costPerConversation'] or 0
+
+    recent_runs = []
+    for run in db[RUNS_COLLECTION].find({'model': model} if model else {}).sort('startedAt', -1).limit(runs):
+        run['id'] = str(run.pop('_id'))
+        elapsed = run.get('elapsed') or 0
+        run['tokensPerSecond'] = run['tokens'] / elapsed if elapsed else 0
+        run['perMinute'] = run['processed'] / elapsed * 60 if elapsed else 0
+        run['costPerConversation'] = run['cost'] / run['succeeded'] if run.get('succeeded') else None
+        recent_runs.append(run)
+
+    return {
+        'days': days,
+        'totals': totals,
+        'groups': [
+            {group_by: key, **_summarize(items, model_of)}
+            for key, items in sorted(groups.items(), key=lambda item: str(item[0]))
+        ],
+        'projection': {
+            'dailyCost': daily_cost,
+            'monthlyCost': daily_cost * 30,
+            'pendingConversations': pending,
+            'pendingCost': pending * per_conversation
+        },
+        'runs': recent_runs
+    }
+
+
+def backfill(db, model='legacy'):
+    """按会话上已有的token_usage回填历史用量
+
+    只统计没有enrichment字段的会话（分析任务之前的笔记本流程处理的），按会话时间的日期和客服分组，
+    提示词版本记为legacy。结果整体覆盖之前的回填，可重复执行。
+
+    Returns:
+        回填的行数
+    """
+    rows = list(db.conversations.aggregate([
+        {'$match': {'token_usage': {'$gt': 0}, 'enrichment': {'$exists': False}}},
+        {'$group': {
+            '_id': {'day': {'$substrCP': [{'$ifNull': ['$time', '']}, 0, 10]}, 'agent': {'$ifNull': ['$agent', '']}},
+            'totalTokens': {'$sum': '$token_usage'},
+            'conversations': {'$sum': 1}
+        }}
+    ]))
+    db[COLLECTION].delete_many({'promptVersion': 'legacy'})
+    if rows:
+        db[COLLECTION].insert_many([
+            {
+                'model': model,
+                'promptVersion': 'legacy',
+                'day': row['_id']['day'],
+                'agent': row['_id']['agent'],
+                'totalTokens': row['totalTokens'],
+                'conversations': row['conversations']
+            }
+            for row in rows
+        ])
+    return len(rows)
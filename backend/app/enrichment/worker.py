@@ -0,0 +1,428 @@
+"""
+会话分析任务
+查找尚未分析的会话，并发调用模型生成指标、摘要、标签等字段，按批写回会话集合
+
+同时进行的模型调用数由并发数限制，调用速率由令牌桶限制；失败的调用按指数退避加随机抖动重试，
+超过重试次数后在会话上记录失败原因，默认不再重复处理。结果按批写入并同步检索词和派生统计。
+调用模型前先查结果缓存，每页会话的缓存条目在读取会话时一次取回，新结果随分析结果一起按批写入缓存。
+每次调用的token用量和延迟在内存中累计，随每批结果写入用量集合，任务结束时保存运行记录。
+"""
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime
+from pymongo import UpdateOne
+from .. import stats
+from ..search import search_fields, SEARCH_FIELD
+from ..interaction import interaction_analysis, INTERACTION_FIELD
+from . import prompts
+from . import cache as llm_cache
+from . import usage
+from .client import ModelError
+from .ratelimit import TokenBucket, backoff_delay
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 会话上记录分析状态的字段
+ENRICHMENT_FIELD = 'enrichment'
+
+# 分析结果写回会话的字段
+ANALYSIS_FIELDS = ['metrics', 'summary', 'conversationSummary', 'tags', 'improvementSuggestions', 'hotWords']
+
+
+def pending_query(retry_failed=False, reprocess=False):
+    """待分析会话的查询条件：有原始会话文本但还没有指标
+
+    reprocess为True时改为选取未用当前分析提示词版本处理过的会话，用于修改提示词后重新分析，
+    会话文本未变的抽取阶段和其他未受影响的条目由结果缓存直接返回。
+    """
+    query = {'origin_conversation': {'$exists': True}}
+    if reprocess:
+        query[f'{ENRICHMENT_FIELD}.promptVersions'] = {'$ne': prompts.ANALYZE_PROMPT_VERSION}
+    else:
+        query['metrics'] = {'$exists': False}
+    if not retry_failed:
+        query[f'{ENRICHMENT_FIELD}.status'] = {'$ne': 'failed'}
+    return query
+
+
+class Enricher:
+    """并发分析会话
+
+    Args:
+        db: 数据库对象
+        client: 模型客户端，见client.py
+        model: 模型名称，记录在分析结果中
+        concurrency: 同时进行的会话分析数
+        rate_per_minute: 每分钟最多发起的模型调用数，0为不限
+        burst: 令牌桶容量，允许的瞬时突发调用数
+        max_retries: 单次模型调用的最大重试次数
+        backoff_base: 首次重试的退避上限（秒），之后每次翻倍
+        backoff_max: 退避上限（秒）
+        timeout: 单次模型调用的超时（秒）
+        batch_size: 每批写回的会话数
+        use_cache: 是否使用模型结果缓存
+        progress: 每写回一批后调用，参数为当前统计
+        cancel: 取消标记（threading.Event），置位后不再读取和开始分析新的会话，
+            正在进行的分析完成后写回并返回
+    """
+
+    def __init__(self, db, client, model, concurrency=8, rate_per_minute=0, burst=1, max_retries=4,
+                 backoff_base=1.0, backoff_max=30.0, timeout=60, batch_size=50, use_cache=True, progress=None,
+                 cancel=None):
+        self.db = db
+        self.client = client
+        self.model = model
+        self.concurrency = max(concurrency, 1)
+        self.bucket = TokenBucket(rate_per_minute / 60, burst)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.batch_size = max(batch_size, 1)
+        self.use_cache = use_cache
+        self.progress = progress
+        self.cancel = cancel
+
+        self.processed = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.calls = 0
+        self.retries = 0
+        self.tokens = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.usage = usage.UsageRecorder(model)
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.tokens_saved = 0
+        self.started = None
+        self._pending = []
+        self._write_lock = None
+
+    async def call_model(self, system_prompt, user_prompt, validate, prompt_version=None, agent=None):
+        """调用模型并解析、校验JSON输出，失败时退避重试
+
+        每次调用（包括失败的）按prompt_version和agent记入用量。
+
+        Returns:
+            (解析后的结果, 包括重试在内消耗的token数)
+
+        Raises:
+            ModelError: 重试次数用尽或遇到不可重试的错误
+        """
+        tokens = 0
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            self.calls += 1
+            started = time.perf_counter()
+            call_usage = None
+            try:
+                try:
+                    content, call_usage = await asyncio.wait_for(
+                        self.client.complete(system_prompt, user_prompt), self.timeout
+                    )
+                except asyncio.TimeoutError:
+                    raise ModelError(f"模型调用超时（{self.timeout}s）")
+                except ModelError:
+                    raise
+                except Exception as e:
+                    raise ModelError(f"模型调用失败: {str(e)}")
+
+                used = call_usage.get('total_tokens') or 0
+                tokens += used
+                self.tokens += used
+                self.prompt_tokens += call_usage.get('prompt_tokens') or 0
+                self.completion_tokens += call_usage.get('completion_tokens') or 0
+                try:
+                    data = json.loads(content)
+                except (TypeError, ValueError) as e:
+                    raise ModelError(f"JSON 解析失败: {str(e)}")
+                error = validate(data)
+                if error:
+                    raise ModelError(error)
+                self.usage.record_call(prompt_version, agent, time.perf_counter() - started, call_usage)
+                return data, tokens
+            except ModelError as e:
+                self.usage.record_call(prompt_version, agent, time.perf_counter() - started, call_usage, error=True)
+                if not e.retryable or attempt >= self.max_retries:
+                    raise
+                self.retries += 1
+                delay = backoff_delay(attempt, self.backoff_base, self.backoff_max)
+                logger.warning(f"{str(e)}，{delay:.1f}s后第 {attempt + 1} 次重试")
+                await asyncio.sleep(delay)
+        raise ModelError("模型调用重试次数已用尽")
+
+    def cache_keys(self, doc):
+        """会话各阶段对应的缓存键"""
+        keys = {}
+        conversation = doc.get('origin_conversation')
+        if not doc.get('messages'):
+            keys['extract'] = llm_cache.cache_key(conversation, prompts.EXTRACT_PROMPT_VERSION, self.model)
+        keys['analyze'] = llm_cache.cache_key(conversation, prompts.ANALYZE_PROMPT_VERSION, self.model)
+        return keys
+
+    async def run_stage(self, key, cached, prompt_version, system_prompt, user_prompt, validate, cache_ops, agent):
+        """执行一个阶段：命中缓存时直接返回缓存结果，否则调用模型并把结果加入待写入的缓存操作
+
+        Returns:
+            (结果, 本次消耗的token数)
+        """
+        if self.use_cache:
+            entry = cached.get(key)
+            if entry is not None:
+                self.cache_hits += 1
+                self.tokens_saved += entry.get('tokens') or 0
+                self.usage.record_cache_hit(prompt_version, agent, entry.get('tokens'))
+                cache_ops.append(llm_cache.hit_operation(key))
+                return entry['result'], 0
+            self.cache_misses += 1
+
+        data, used = await self.call_model(system_prompt, user_prompt, validate, prompt_version, agent)
+        if self.use_cache:
+            cache_ops.append(llm_cache.store_operation(key, prompt_version, self.model, data, used))
+        return data, used
+
+    async def process(self, doc, cached=None):
+        """分析单个会话
+
+        Args:
+            doc: 会话
+            cached: 预先取回的缓存条目 {键: 条目}
+
+        Returns:
+            (需要写回的字段, 是否成功, 缓存写入操作)
+        """
+        conversation = doc['origin_conversation']
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        keys = self.cache_keys(doc)
+        cached = cached or {}
+        cache_ops = []
+        fields = {}
+        tokens = 0
+        versions = []
+        try:
+            # 没有消息列表的会话先做结构化抽取
+            if 'extract' in keys:
+                extracted, used = await self.run_stage(
+                    keys['extract'], cached,
+                    prompts.EXTRACT_PROMPT_VERSION,
+                    prompts.EXTRACT_SYSTEM_PROMPT,
+                    prompts.extract_user_prompt(conversation),
+                    prompts.validate_extraction,
+                    cache_ops,
+                    doc.get('agent')
+                )
+                tokens += used
+                versions.append(prompts.EXTRACT_PROMPT_VERSION)
+                fields['messages'] = extracted['messages']
+                # 消息数等指标由抽取出的消息重新计算，不采用模型给出的计数
+                reported = extracted.get(INTERACTION_FIELD)
+                analysis = interaction_analysis({
+                    'messages': extracted['messages'],
+                    INTERACTION_FIELD: reported if isinstance(reported, dict) else None
+                })
+                if analysis is not None:
+                    fields[INTERACTION_FIELD] = analysis
+                if not (doc.get('customerInfo') or {}).get('userId'):
+                    fields['customerInfo'] = extracted['customerInfo']
+                if not doc.get('agent'):
+                    fields['agent'] = extracted['agent']
+
+            analysis, used = await self.run_stage(
+                keys['analyze'], cached,
+                prompts.ANALYZE_PROMPT_VERSION,
+                prompts.ANALYZE_SYSTEM_PROMPT,
+                prompts.analyze_user_prompt(conversation),
+                prompts.validate_analysis,
+                cache_ops,
+                fields.get('agent') or doc.get('agent')
+            )
+            tokens += used
+            versions.append(prompts.ANALYZE_PROMPT_VERSION)
+            self.usage.record_conversation(prompts.ANALYZE_PROMPT_VERSION, fields.get('agent') or doc.get('agent'))
+            fields.update({key: analysis[key] for key in ANALYSIS_FIELDS})
+            fields[ENRICHMENT_FIELD] = {'status': 'done', 'model': self.model, 'promptVersions': versions, 'time': now}
+            succeeded = True
+        except ModelError as e:
+            fields = {ENRICHMENT_FIELD: {
+                'status': 'failed', 'model': self.model, 'promptVersions': versions, 'time': now, 'error': str(e)
+            }}
+            succeeded = False
+            logger.error(f"分析会话 {doc.get('id')} 失败: {str(e)}")
+
+        # 与已有的token用量累加
+        if tokens:
+            fields['token_usage'] = (doc.get('token_usage') or 0) + tokens
+        return fields, succeeded, cache_ops
+
+    def write(self, items):
+        """批量写回分析结果，并同步检索词和派生统计
+
+        先写会话再写缓存和用量：缓存和用量写入失败只记录日志，不影响已写入的分析结果，
+        缓存缺失的会话下次会重新调用模型。
+
+        Args:
+            items: [(分析前的会话, 写回字段, 是否成功, 缓存写入操作)]
+        """
+        operations = []
+        changes = []
+        for before, fields, succeeded, _ in items:
+            update = dict(fields)
+            if succeeded:
+                after = {**before, **fields}
+                update[SEARCH_FIELD] = search_fields(after)
+                changes.append((before, {**after, SEARCH_FIELD: update[SEARCH_FIELD]}))
+            operations.append(UpdateOne({'_id': before['_id']}, {'$set': update}))
+        if operations:
+            self.db.conversations.bulk_write(operations, ordered=False)
+        stats.apply_changes(self.db, changes)
+
+        cache_ops = [operation for item in items for operation in item[3]]
+        if cache_ops:
+            try:
+                self.db[llm_cache.COLLECTION].bulk_write(cache_ops, ordered=False)
+            except Exception as e:
+                logger.error(f"写入模型结果缓存出错: {str(e)}")
+        usage_ops = self.usage.drain()
+        if usage_ops:
+            try:
+                self.db[usage.COLLECTION].bulk_write(usage_ops, ordered=False)
+            except Exception as e:
+                logger.error(f"写入模型用量出错: {str(e)}")
+
+    async def flush(self, force=False):
+        """待写回结果达到批大小时写回一批，force为True时写回全部
+
+        已有批次正在写入时直接返回，写入方会在完成后继续写回期间积累的结果，其他会话的分析不必等待。
+        """
+        if self._write_lock.locked() and not force:
+            return
+        async with self._write_lock:
+            while self._pending and (force or len(self._pending) >= self.batch_size):
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+                await asyncio.to_thread(self.write, batch)
+                if self.progress:
+                    self.progress(self.snapshot())
+
+    def cancelled(self):
+        """是否已收到取消请求"""
+        return self.cancel is not None and self.cancel.is_set()
+
+    async def _produce(self, queue, query, limit):
+        """按_id顺序分页读取待分析会话，队列满时等待"""
+        page_size = max(self.batch_size, self.concurrency * 2)
+        last_id = None
+        remaining = limit
+        while (remaining is None or remaining > 0) and not self.cancelled():
+            page_query = dict(query)
+            if last_id is not None:
+                page_query['_id'] = {'$gt': last_id}
+            size = page_size if remaining is None else min(page_size, remaining)
+            docs = await asyncio.to_thread(
+                lambda: list(self.db.conversations.find(page_query).sort('_id', 1).limit(size))
+            )
+            if not docs:
+                break
+            # 一次取回这一页会话的全部缓存条目
+            cached = {}
+            if self.use_cache:
+                keys = [key for doc in docs for key in self.cache_keys(doc).values()]
+                cached = await asyncio.to_thread(llm_cache.lookup, self.db, keys)
+            for doc in docs:
+                await queue.put((doc, cached))
+            last_id = docs[-1]['_id']
+            if remaining is not None:
+                remaining -= len(docs)
+        for _ in range(self.concurrency):
+            await queue.put(None)
+
+    async def _consume(self, queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            # 取消后丢弃队列中尚未开始的会话
+            if self.cancelled():
+                continue
+            doc, cached = item
+            fields, succeeded, cache_ops = await self.process(doc, cached)
+            self.processed += 1
+            if succeeded:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+            self._pending.append((doc, fields, succeeded, cache_ops))
+            await self.flush()
+
+    async def run(self, query, limit=None):
+        """处理符合query的会话，limit为最多处理的会话数
+
+        Returns:
+            统计结果，见snapshot
+        """
+        self.started = time.perf_counter()
+        self._write_lock = asyncio.Lock()
+        queue = asyncio.Queue(self.concurrency * 2)
+        producer = asyncio.create_task(self._produce(queue, query, limit))
+        consumers = [asyncio.create_task(self._consume(queue)) for _ in range(self.concurrency)]
+        try:
+            await asyncio.gather(producer, *consumers)
+        finally:
+            await self.flush(force=True)
+        report = self.snapshot()
+        if self.processed:
+            options = {
+                'concurrency': self.concurrency,
+                'batchSize': self.batch_size,
+                'ratePerMinute': self.bucket.rate * 60,
+                'useCache': self.use_cache
+            }
+            await asyncio.to_thread(usage.record_run, self.db, self.model, options, report)
+        return report
+
+    def snapshot(self):
+        """返回处理数量、调用次数、token用量和成本、缓存命中率和吞吐"""
+        elapsed = time.perf_counter() - self.started if self.started else 0
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            'processed': self.processed,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'calls': self.calls,
+            'retries': self.retries,
+            'tokens': self.tokens,
+            'promptTokens': self.prompt_tokens,
+            'completionTokens': self.completion_tokens,
+            'cost': usage.cost(self.model, self.prompt_tokens, self.completion_tokens, self.tokens),
+            'cacheHits': self.cache_hits,
+            'cacheMisses': self.cache_misses,
+            'cacheHitRate': self.cache_hits / lookups if lookups > 0 else 0,
+            'tokensSaved': self.tokens_saved,
+            'rateLimitWaitSeconds': self.bucket.waited,
+            'elapsed': elapsed,
+            'perMinute': self.processed / elapsed * 60 if elapsed > 0 else 0,
+            'cancelled': self.cancelled()
+        }
+
+
+def enrich(db, client, model, limit=None, retry_failed=False, reprocess=False, **options):
+    """同步入口：分析待处理的会话
+
+    Args:
+        db: 数据库对象
+        client: 模型客户端
+        model: 模型名称
+        limit: 最多处理的会话数
+        retry_failed: 是否重新处理之前失败的会话
+        reprocess: 重新分析未用当前提示词版本处理过的会话
+        options: Enricher的其他参数
+
+    Returns:
+        统计结果
+    """
+    enricher = Enricher(db, client, model, **options)
+    return asyncio.run(enricher.run(pending_query(retry_failed, reprocess), limit))
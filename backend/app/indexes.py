@@ -0,0 +1,230 @@
+"""
+索引注册模块
+集中声明各集合需要的索引，并提供基于explain()的索引诊断
+
+INDEXES 按接口实际发出的查询形状声明复合索引：列表统一按 (time, id) 倒序排列，
+按客服、标签、解决状态筛选时以筛选字段为前缀。
+"""
+import logging
+import threading
+import time
+from pymongo import ASCENDING, DESCENDING
+from .api.paging import PAGE_SORT, after_query
+from .stats import cube
+from . import search
+from .config import Config
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 列表排序键对应的索引后缀
+PAGE_KEYS = [('time', DESCENDING), ('id', DESCENDING)]
+
+# 索引注册表：collection为集合名，keys为索引键，options为create_index的其他参数，
+# sync为True的索引关系到数据正确性，启动时同步创建
+INDEXES = [
+    # 会话：按id读取、写入和去重
+    {'collection': 'conversations', 'keys': [('id', ASCENDING)], 'options': {'unique': True}, 'sync': True},
+    # 重复导入时按id批量读取源内容哈希，覆盖查询不读取会话正文
+    {'collection': 'conversations', 'keys': [('id', ASCENDING), ('sourceHash', ASCENDING)]},
+    # 会话列表及时间范围筛选
+    {'collection': 'conversations', 'keys': PAGE_KEYS},
+    # 按标签、客服、解决状态筛选的会话列表
+    {'collection': 'conversations', 'keys': [('tags', ASCENDING)] + PAGE_KEYS},
+    {'collection': 'conversations', 'keys': [('agent', ASCENDING)] + PAGE_KEYS},
+    {'collection': 'conversations', 'keys': [('conversationSummary.resolutionStatus.status', ASCENDING)] + PAGE_KEYS},
+    # 搜索：按客户ID前缀匹配，以及对检索词的加权全文检索；
+    # search_query把$text与ID前缀放在同一个$or中，要求各分支都有索引，缺少时搜索直接报错，因此同步创建
+    {'collection': 'conversations', 'keys': [('customerInfo.userId', ASCENDING)], 'sync': True},
+    {**search.text_index(), 'sync': True},
+    # 预聚合统计
+    {'collection': 'rollups', 'keys': [('kind', ASCENDING)]},
+    {'collection': 'metric_cube', 'keys': [('day', ASCENDING), ('tag', ASCENDING)]},
+    {'collection': 'tag_pairs', 'keys': [('count', DESCENDING)]},
+    {'collection': 'tag_pairs', 'keys': [('a', ASCENDING), ('count', DESCENDING)]},
+    {'collection': 'tag_pairs', 'keys': [('b', ASCENDING), ('count', DESCENDING)]},
+    # 模型结果缓存：长期未使用的条目自动淘汰，按提示词版本清理；
+    # 修改LLM_CACHE_TTL_DAYS后，ensure_indexes通过collMod更新已有TTL索引的过期时间
+    {'collection': 'llm_cache', 'keys': [('lastUsedAt', ASCENDING)],
+     'options': {'expireAfterSeconds': int(Config.LLM_CACHE_TTL_DAYS * 86400)}},
+    {'collection': 'llm_cache', 'keys': [('promptVersion', ASCENDING)]},
+    # 模型用量：报表按日期范围读取，运行记录按时间倒序
+    {'collection': 'llm_usage', 'keys': [('day', ASCENDING), ('model', ASCENDING)]},
+    {'collection': 'llm_runs', 'keys': [('startedAt', DESCENDING)]},
+    # 任务队列：按优先级领取到期任务、回收租约过期的任务、统计最近完成的任务
+    {'collection': 'jobs', 'keys': [('status', ASCENDING), ('priority', DESCENDING), ('runAt', ASCENDING)]},
+    {'collection': 'jobs', 'keys': [('status', ASCENDING), ('leaseUntil', ASCENDING)]},
+    {'collection': 'jobs', 'keys': [('finishedAt', DESCENDING)]}
+]
+
+
+def sync_ttl(db, spec):
+    """已有TTL索引的过期时间与注册表不一致时用collMod更新
+
+    create_index不能修改已有索引的选项，直接创建会因IndexOptionsConflict失败。
+
+    Returns:
+        是否更新了过期时间
+    """
+    expire = spec['options']['expireAfterSeconds']
+    for info in db[spec['collection']].index_information().values():
+        if info['key'] != list(spec['keys']) or 'expireAfterSeconds' not in info:
+            continue
+        if info['expireAfterSeconds'] == expire:
+            return False
+        db.command('collMod', spec['collection'], index={
+            'keyPattern': dict(spec['keys']),
+            'expireAfterSeconds': expire
+        })
+        logger.info(
+            f"TTL索引 {spec['collection']} {dict(spec['keys'])} 的过期时间已从 "
+            f"{info['expireAfterSeconds']}s 更新为 {expire}s"
+        )
+        return True
+    return False
+
+
+def ensure_indexes(db, sync_only=False):
+    """按注册表创建索引，已存在的索引不会重复创建，TTL索引的过期时间随配置更新
+
+    Args:
+        db: 数据库对象
+        sync_only: 只创建需要同步创建的索引
+
+    Returns:
+        {'created': [索引名], 'failed': [{'name', 'error'}]}
+    """
+    report = {'created': [], 'failed': []}
+    for spec in INDEXES:
+        if sync_only and not spec.get('sync'):
+            continue
+        try:
+            if 'expireAfterSeconds' in spec.get('options', {}):
+                sync_ttl(db, spec)
+            name = db[spec['collection']].create_index(spec['keys'], **spec.get('options', {}))
+            report['created'].append(f"{spec['collection']}.{name}")
+        except Exception as e:
+            name = '_'.join(f'{field}_{direction}' for field, direction in spec['keys'])
+            logger.error(f"创建索引失败 {spec['collection']}.{name}: {str(e)}")
+            report['failed'].append({'name': f"{spec['collection']}.{name}", 'error': str(e)})
+    return report
+
+
+def build_in_background(db):
+    """在后台线程中按注册表创建索引，不阻塞应用启动
+
+    Returns:
+        后台线程对象
+    """
+    def run():
+        started = time.perf_counter()
+        report = ensure_indexes(db)
+        logger.info(
+            f"MongoDB索引已就绪: {len(report['created'])} 个，失败 {len(report['failed'])} 个，"
+            f"耗时 {time.perf_counter() - started:.1f}s"
+        )
+
+    thread = threading.Thread(target=run, name='index-builder', daemon=True)
+    thread.start()
+    return thread
+
+
+def canonical_queries(sample):
+    """按接口实际发出的查询形状生成诊断用查询
+
+    Args:
+        sample: 用于填充查询条件的示例会话
+
+    Returns:
+        [{'name', 'filter', 'sort'}] 列表，sort为None表示不排序
+    """
+    agent = sample.get('agent', '')
+    tags = sample.get('tags') or ['']
+    status = (sample.get('conversationSummary') or {}).get('resolutionStatus', {}).get('status', '')
+    day = str(sample.get('time', ''))[:10]
+    day_range = cube.time_match(day, day)['time']
+    position = (sample.get('time', ''), sample.get('id', ''))
+
+    return [
+        {'name': '会话详情', 'filter': {'id': sample.get('id', '')}, 'sort': None},
+        {'name': '会话列表', 'filter': {}, 'sort': PAGE_SORT},
+        {'name': '会话列表-时间范围', 'filter': {'time': day_range}, 'sort': PAGE_SORT},
+        {'name': '会话列表-客服', 'filter': {'agent': agent}, 'sort': PAGE_SORT},
+        {'name': '会话列表-标签', 'filter': {'tags': tags[0]}, 'sort': PAGE_SORT},
+        {'name': '会话列表-多标签', 'filter': {'tags': {'$in': tags}}, 'sort': PAGE_SORT},
+        {'name': '会话列表-解决状态', 'filter': {'conversationSummary.resolutionStatus.status': status}, 'sort': PAGE_SORT},
+        {'name': '客服分析-时间范围', 'filter': {'agent': agent, 'time': day_range}, 'sort': PAGE_SORT},
+        {'name': '客服分析-解决状态', 'filter': {'agent': agent, 'conversationSummary.resolutionStatus.status': status}, 'sort': PAGE_SORT},
+        {'name': '标签分析-客服', 'filter': {'tags': tags[0], 'agent': agent}, 'sort': PAGE_SORT},
+        {'name': '客服分析-游标分页', 'filter': after_query({'agent': agent}, position), 'sort': PAGE_SORT},
+        {'name': '客服列表-标签', 'filter': {'agent': {'$ne': None}, 'tags': tags[0]}, 'sort': None}
+    ]
+
+
+def plan_values(plan, field):
+    """递归收集查询计划各阶段中指定字段的值，如stage、indexName"""
+    if not isinstance(plan, dict):
+        return []
+    values = [plan[field]] if field in plan else []
+    for key in ('inputStage', 'queryPlan'):
+        values += plan_values(plan.get(key), field)
+    for child in plan.get('inputStages', []):
+        values += plan_values(child, field)
+    return values
+
+
+def explain_query(db, query, limit=10):
+    """对单个查询运行explain并提取诊断指标
+
+    Returns:
+        {'name', 'stages', 'indexes', 'docsExamined', 'keysExamined', 'nReturned', 'ratio'}
+    """
+    command = {'find': 'conversations', 'filter': query['filter'], 'limit': limit}
+    if query['sort']:
+        command['sort'] = dict(query['sort'])
+    explain = db.command('explain', command, verbosity='executionStats')
+
+    winning_plan = explain.get('queryPlanner', {}).get('winningPlan', {})
+    stats = explain.get('executionStats', {})
+    docs_examined = stats.get('totalDocsExamined', 0)
+    n_returned = stats.get('nReturned', 0)
+    return {
+        'name': query['name'],
+        'stages': plan_values(winning_plan, 'stage'),
+        'indexes': sorted(set(plan_values(winning_plan, 'indexName'))),
+        'docsExamined': docs_examined,
+        'keysExamined': stats.get('totalKeysExamined', 0),
+        'nReturned': n_returned,
+        'ratio': docs_examined / max(n_returned, 1)
+    }
+
+
+def advise(db, max_ratio=10, limit=10):
+    """对各接口的典型查询运行explain，标记全表扫描、内存排序和扫描返回比过高的查询
+
+    Args:
+        db: 数据库对象
+        max_ratio: docsExamined/nReturned 的告警阈值
+        limit: 每个查询读取的文档数，与列表默认页大小一致
+
+    Returns:
+        每个查询的诊断结果列表，problems为发现的问题描述；集合为空时返回空列表
+    """
+    sample = db.conversations.find_one({}, {'_id': 0, 'id': 1, 'time': 1, 'agent': 1, 'tags': 1,
+                                           'conversationSummary.resolutionStatus.status': 1})
+    if sample is None:
+        return []
+
+    results = []
+    for query in canonical_queries(sample):
+        result = explain_query(db, query, limit)
+        problems = []
+        if 'COLLSCAN' in result['stages']:
+            problems.append('全表扫描(COLLSCAN)')
+        if 'SORT' in result['stages']:
+            problems.append('内存排序(SORT)')
+        if result['ratio'] > max_ratio:
+            problems.append(f"扫描返回比 {result['ratio']:.1f} 超过 {max_ratio}")
+        result['problems'] = problems
+        results.append(result)
+    return results
@@ -0,0 +1,175 @@
+"""
+会话写入模块
+批量校验、预处理并写入会话，同步维护检索词和派生统计
+
+批量接口和导入脚本共用这里的逻辑：每批会话先按ID取回已有会话的源内容哈希，
+哈希相同的会话直接跳过，其余按会话ID在一次无序bulk_write中upsert；
+合并提交的单条创建按批插入，不覆盖已有会话。
+"""
+import logging
+from pymongo import InsertOne, ReplaceOne
+from pymongo.errors import BulkWriteError
+from . import stats
+from .search import search_fields, SEARCH_FIELD
+from .sourcehash import source_hash, SOURCE_HASH_FIELD, DERIVED_FIELDS
+from .interaction import interaction_analysis, INTERACTION_FIELD
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 会话必需字段
+REQUIRED_FIELDS = ['id', 'time', 'agent', 'customerInfo', 'conversationSummary']
+
+# 唯一索引冲突的错误码
+DUPLICATE_KEY_ERROR = 11000
+
+
+def validate(doc):
+    """校验单个会话
+
+    Returns:
+        错误信息，校验通过时返回None
+    """
+    if not isinstance(doc, dict):
+        return "会话数据必须是JSON对象"
+    for field in REQUIRED_FIELDS:
+        if field not in doc:
+            return f"缺少必要字段: {field}"
+    if not isinstance(doc['id'], str) or not doc['id']:
+        return "会话ID必须是非空字符串"
+    return None
+
+
+def prepare(doc):
+    """生成写入前需要的派生字段，返回新的文档，不修改传入的会话
+
+    源内容哈希按提交的内容计算，之后再由消息列表派生交互指标。
+    """
+    doc = {key: value for key, value in doc.items() if key not in DERIVED_FIELDS}
+    doc[SOURCE_HASH_FIELD] = source_hash(doc)
+    doc[SEARCH_FIELD] = search_fields(doc)
+    analysis = interaction_analysis(doc)
+    if analysis is not None:
+        doc[INTERACTION_FIELD] = analysis
+    return doc
+
+
+def upsert_batch(db, docs, offset=0, apply_stats=True):
+    """校验并批量写入一批会话
+
+    同一批中重复的会话ID以最后一次出现为准，之前的记为duplicate。
+    源内容哈希与已有会话相同的记为skipped，不读取也不写入；
+    更新前的已有文档和写入后的文档一并交给派生统计同步。
+
+    Args:
+        db: 数据库对象
+        docs: 会话列表
+        offset: 本批第一条会话在整个请求中的序号，用于生成结果中的index
+        apply_stats: 是否同步派生统计，大批量导入时可关闭并在导入后运行重建命令
+
+    Returns:
+        逐条结果列表：{'index', 'id', 'status', 'error'}，status为inserted、updated、
+        skipped、duplicate或error
+    """
+    results = [{'index': offset + i, 'id': None, 'status': None} for i in range(len(docs))]
+
+    # 批量校验，同一ID只保留最后一次出现
+    latest = {}
+    for i, doc in enumerate(docs):
+        error = validate(doc)
+        if error:
+            results[i].update({'status': 'error', 'error': error})
+            if isinstance(doc, dict) and isinstance(doc.get('id'), str):
+                results[i]['id'] = doc['id']
+            continue
+        results[i]['id'] = doc['id']
+        if doc['id'] in latest:
+            results[latest[doc['id']]].update({'status': 'duplicate', 'error': "被同一请求中相同ID的会话覆盖"})
+        latest[doc['id']] = i
+
+    if not latest:
+        return results
+
+    # 一次查询取回已有会话的源内容哈希，由(id, sourceHash)索引覆盖，不读取会话正文
+    hashes = {
+        doc['id']: doc.get(SOURCE_HASH_FIELD)
+        for doc in db.conversations.find({'id': {'$in': list(latest)}}, {'_id': 0, 'id': 1, SOURCE_HASH_FIELD: 1})
+    }
+
+    positions = []
+    operations = []
+    prepared = {}
+    for conversation_id, i in latest.items():
+        if conversation_id in hashes and hashes[conversation_id] == source_hash(docs[i]):
+            results[i]['status'] = 'skipped'
+            continue
+        doc = prepare(docs[i])
+        prepared[i] = doc
+        positions.append(i)
+        operations.append(ReplaceOne({'id': conversation_id}, doc, upsert=True))
+
+    # 只为内容变化的已有会话取回完整文档，用于同步派生统计
+    updated_ids = [results[i]['id'] for i in positions if results[i]['id'] in hashes]
+    existing = {}
+    if apply_stats and updated_ids:
+        existing = {doc['id']: doc for doc in db.conversations.find({'id': {'$in': updated_ids}})}
+
+    failed = {}
+    if operations:
+        try:
+            db.conversations.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                failed[positions[error['index']]] = error.get('errmsg', str(error))
+
+    changes = []
+    for i in positions:
+        if i in failed:
+            results[i].update({'status': 'error', 'error': failed[i]})
+            continue
+        results[i]['status'] = 'updated' if results[i]['id'] in hashes else 'inserted'
+        changes.append((existing.get(results[i]['id']), prepared[i]))
+
+    # 同步更新派生统计
+    if apply_stats:
+        stats.apply_changes(db, changes)
+    return results
+
+
+def insert_batch(db, docs, apply_stats=True):
+    """批量插入已校验并预处理的会话，已存在的会话ID不会被覆盖
+
+    Args:
+        db: 数据库对象
+        docs: prepare处理后的会话列表
+        apply_stats: 是否同步派生统计
+
+    Returns:
+        逐条结果列表：{'id', 'status', 'error'}，status为inserted或error
+    """
+    results = [{'id': doc['id'], 'status': 'inserted'} for doc in docs]
+    try:
+        db.conversations.bulk_write([InsertOne(doc) for doc in docs], ordered=False)
+    except BulkWriteError as e:
+        for error in e.details.get('writeErrors', []):
+            result = results[error['index']]
+            result['status'] = 'error'
+            if error.get('code') == DUPLICATE_KEY_ERROR:
+                result['error'] = f"ID为 {result['id']} 的会话已存在"
+            else:
+                result['error'] = error.get('errmsg', str(error))
+
+    # 同步更新派生统计
+    if apply_stats:
+        stats.apply_changes(db, [
+            (None, doc) for doc, result in zip(docs, results) if result['status'] == 'inserted'
+        ])
+    return results
+
+
+def summarize(results):
+    """统计逐条结果中各状态的数量"""
+    summary = {'inserted': 0, 'updated': 0, 'skipped': 0, 'duplicate': 0, 'error': 0}
+    for result in results:
+        summary[result['status']] += 1
+    return summary
@@ -0,0 +1,209 @@
+"""
+会话交互指标
+由消息列表派生interactionAnalysis：各类消息数、图片消息数、首次响应时间、平均响应时间和解决时长
+
+写入和更新会话时调用interaction_analysis生成，已有会话通过backfill分批重算。
+时间指标单位为秒，由messages[].time计算，消息缺少可解析的时间时对应指标为None。
+本模块不依赖数据库和派生统计，可在导入的工作进程中使用。
+"""
+import logging
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pymongo import UpdateOne
+from .search import SEARCH_FIELD
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 会话中存放交互指标的字段
+INTERACTION_FIELD = 'interactionAnalysis'
+
+# 消息时间格式
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# 图片消息的内容前缀
+IMAGE_PREFIX = '[图片]'
+
+
+def _parse_time(value):
+    try:
+        return datetime.strptime(value, TIME_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+
+def interaction_metrics(messages):
+    """一次遍历消息列表计算交互指标
+
+    客户发言后到客服下一次发言之间的间隔为一次响应时间，客户连续发送多条消息时从第一条算起；
+    首次响应时间为第一次响应的间隔，解决时长为第一条到最后一条消息的时间跨度。
+
+    Returns:
+        {'totalMessages', 'agentMessages', 'userMessages', 'imageMessages',
+         'firstResponseTime', 'avgResponseTime', 'resolutionTime'}
+    """
+    agent_messages = 0
+    user_messages = 0
+    image_messages = 0
+    first_time = None
+    last_time = None
+    waiting_since = None
+    response_total = 0.0
+    responses = 0
+    first_response = None
+
+    for message in messages:
+        kind = message.get('type')
+        if kind == 'user':
+            user_messages += 1
+        elif kind == 'agent':
+            agent_messages += 1
+        content = message.get('content')
+        if isinstance(content, str) and content.startswith(IMAGE_PREFIX):
+            image_messages += 1
+
+        moment = _parse_time(message.get('time'))
+        if moment is None:
+            continue
+        if first_time is None:
+            first_time = moment
+        last_time = moment
+        if kind == 'user':
+            if waiting_since is None:
+                waiting_since = moment
+        elif kind == 'agent' and waiting_since is not None:
+            gap = (moment - waiting_since).total_seconds()
+            waiting_since = None
+            # 导出内容偶有乱序，负间隔不计入
+            if gap < 0:
+                continue
+            response_total += gap
+            responses += 1
+            if first_response is None:
+                first_response = gap
+
+    return {
+        'totalMessages': len(messages),
+        'agentMessages': agent_messages,
+        'userMessages': user_messages,
+        'imageMessages': image_messages,
+        'firstResponseTime': first_response,
+        'avgResponseTime': response_total / responses if responses else None,
+        'resolutionTime': (last_time - first_time).total_seconds() if first_time is not None else None
+    }
+
+
+def interaction_analysis(doc):
+    """会话的交互指标：在已有interactionAnalysis上覆盖由消息计算的字段
+
+    没有消息列表时返回None，调用方保留原有字段。
+    """
+    messages = doc.get('messages')
+    if not isinstance(messages, list) or not messages:
+        return None
+    return {**(doc.get(INTERACTION_FIELD) or {}), **interaction_metrics(messages)}
+
+
+def derive_rows(rows):
+    """工作进程入口：计算一批会话的交互指标
+
+    Args:
+        rows: [(_id, 消息列表, 已有的interactionAnalysis)]
+
+    Returns:
+        [(_id, interactionAnalysis)]
+    """
+    return [
+        (doc_id, interaction_analysis({'messages': messages, INTERACTION_FIELD: existing}))
+        for doc_id, messages, existing in rows
+    ]
+
+
+def backfill(db, batch_size=1000, workers=None, max_in_flight=None, only_missing=False,
+             apply_stats=True, progress=None, cancel=None):
+    """并行重算已有会话的交互指标
+
+    会话按批读取，每批交给一个工作进程计算，同时在途的批数有上限；
+    主进程按提交顺序取回结果，只写回有变化的会话并同步派生统计。
+
+    Args:
+        db: 数据库对象
+        batch_size: 每批的会话数
+        workers: 工作进程数，默认CPU核数
+        max_in_flight: 同时在途的批数上限，默认工作进程数的2倍
+        only_missing: 只处理还没有时间指标的会话
+        apply_stats: 是否同步派生统计
+        progress: 每写回一批后调用，参数为当前统计
+        cancel: 取消标记（threading.Event），置位后不再读取新的批次，已在途的批次写回后返回
+
+    Returns:
+        {'documents', 'updated', 'cancelled'}
+    """
+    from . import stats
+
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or workers * 2
+    report = {'documents': 0, 'updated': 0, 'cancelled': False}
+
+    query = {'messages.0': {'$exists': True}}
+    if only_missing:
+        query[f'{INTERACTION_FIELD}.resolutionTime'] = {'$exists': False}
+    # 派生统计需要完整的会话，不同步时只读取计算所需的字段
+    if apply_stats:
+        projection = {'origin_conversation': 0, SEARCH_FIELD: 0}
+    else:
+        projection = {'messages': 1, INTERACTION_FIELD: 1}
+
+    def write(docs, results):
+        report['documents'] += len(docs)
+        operations = []
+        changes = []
+        for doc_id, analysis in results:
+            before = docs[doc_id]
+            if analysis is None or analysis == before.get(INTERACTION_FIELD):
+                continue
+            operations.append(UpdateOne({'_id': doc_id}, {'$set': {INTERACTION_FIELD: analysis}}))
+            changes.append((before, {**before, INTERACTION_FIELD: analysis}))
+        if operations:
+            db.conversations.bulk_write(operations, ordered=False)
+            report['updated'] += len(operations)
+        if apply_stats:
+            stats.apply_changes(db, changes)
+
+    def batches():
+        batch = {}
+        for doc in db.conversations.find(query, projection).sort('_id', 1).batch_size(batch_size):
+            batch[doc['_id']] = doc
+            if len(batch) >= batch_size:
+                yield batch
+                batch = {}
+        if batch:
+            yield batch
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # 按提交顺序取回结果，在途批数达到上限时先写回最早的一批，读取随之暂停
+        pending = deque()
+        for docs in batches():
+            if cancel is not None and cancel.is_set():
+                report['cancelled'] = True
+                break
+            rows = [(doc_id, doc['messages'], doc.get(INTERACTION_FIELD)) for doc_id, doc in docs.items()]
+            pending.append((docs, executor.submit(derive_rows, rows)))
+            if len(pending) >= max_in_flight:
+                docs, future = pending.popleft()
+                write(docs, future.result())
+                if progress:
+                    progress(report)
+        while pending:
+            docs, future = pending.popleft()
+            write(docs, future.result())
+            if progress:
+                progress(report)
+
+    logger.info(
+        f"交互指标重算{'已取消' if report['cancelled'] else '完成'}: "
+        f"处理 {report['documents']} 个会话，更新 {report['updated']} 个"
+    )
+    return report
@@ -0,0 +1,370 @@
+"""
+任务队列模块
+基于jobs集合的持久化任务队列，用于会话分析、统计重建、检索词重建等耗时任务
+
+工作进程通过find_one_and_update原子地领取任务并获得租约，执行期间定时心跳续租；
+进程崩溃后租约过期，任务可被其他工作进程重新领取。失败的任务退避后重新排队，
+超过最大尝试次数后进入dead状态，需人工重试。多个主机上的工作进程可同时从同一集合领取任务，
+同一时刻一个任务只属于一个持有有效租约的工作进程。
+
+租约失效（心跳续租失败）后，工作进程通过取消标记通知任务处理函数，处理函数在批次之间检查标记并尽快返回，
+结果不再写回任务状态。这只能缩小而不能消除重复执行：从租约过期到下一次心跳发现失效（最长约租约时长的1/3），
+以及处理函数发现取消标记前正在处理的一批（例如进行中的模型调用、正在写入的一批会话），
+可能与重新领取该任务的工作进程重叠，因此任务语义为至少执行一次。重叠部分会重复计算和写入，
+会话分析还可能重复调用模型、重复计入用量；派生统计若因此出现偏差，可通过rebuild-*任务修复。
+
+任务状态: queued -> running -> done
+                           -> queued（失败后退避重试） -> ... -> dead
+"""
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import ReturnDocument
+from .config import Config
+from .stats import rollups, cube, cooccurrence, hotwords
+from . import search, enrichment, interaction
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 任务状态
+JOB_STATUSES = ['queued', 'running', 'done', 'dead']
+
+
+def _rebuild_handler(module):
+    def handler(db, params, cancel):
+        report = module.rebuild(db, dry_run=bool(params.get('dryRun')), cancel=cancel)
+        return {'documents': report['documents'], 'drifted': report['drifted'], 'cancelled': report['cancelled']}
+    return handler
+
+
+def _reindex_handler(db, params, cancel):
+    return search.reindex(
+        db, batch_size=params.get('batchSize', 500), only_missing=bool(params.get('missingOnly')), cancel=cancel
+    )
+
+
+def _interaction_handler(db, params, cancel):
+    return interaction.backfill(
+        db, batch_size=params.get('batchSize', Config.INGEST_BATCH_SIZE), only_missing=bool(params.get('missingOnly')),
+        cancel=cancel
+    )
+
+
+def _enrich_handler(db, params, cancel):
+    model = params.get('model', Config.ENRICH_MODEL)
+    client = enrichment.load_client(
+        params.get('client', Config.ENRICH_CLIENT), model,
+        base_url=params.get('baseUrl', Config.ENRICH_BASE_URL),
+        api_key=Config.ENRICH_API_KEY,
+        timeout=Config.ENRICH_TIMEOUT
+    )
+    return enrichment.enrich(
+        db, client, model,
+        limit=params.get('limit'),
+        retry_failed=bool(params.get('retryFailed')),
+        reprocess=bool(params.get('reprocess')),
+        concurrency=params.get('concurrency', Config.ENRICH_CONCURRENCY),
+        rate_per_minute=params.get('ratePerMinute', Config.ENRICH_RATE_PER_MINUTE),
+        burst=params.get('burst', Config.ENRICH_BURST),
+        max_retries=Config.ENRICH_MAX_RETRIES,
+        backoff_base=Config.ENRICH_BACKOFF_BASE,
+        backoff_max=Config.ENRICH_BACKOFF_MAX,
+        timeout=Config.ENRICH_TIMEOUT,
+        batch_size=params.get('batchSize', Config.ENRICH_BATCH_SIZE),
+        use_cache=params.get('useCache', Config.LLM_CACHE_ENABLED),
+        cancel=cancel
+    )
+
+
+# 任务类型及处理函数：handler(db, params, cancel) -> 结果字典，cancel为租约失效时置位的threading.Event
+HANDLERS = {
+    'enrich': _enrich_handler,
+    'rebuild-rollups': _rebuild_handler(rollups),
+    'rebuild-cube': _rebuild_handler(cube),
+    'rebuild-cooccurrence': _rebuild_handler(cooccurrence),
+    'rebuild-hotwords': _rebuild_handler(hotwords),
+    'reindex-search': _reindex_handler,
+    'derive-interactions': _interaction_handler
+}
+
+
+def enqueue(db, job_type, params=None, priority=0, max_attempts=None, delay=0):
+    """提交任务
+
+    Args:
+        db: 数据库对象
+        job_type: 任务类型，见HANDLERS
+        params: 任务参数
+        priority: 优先级，数值大的先执行
+        max_attempts: 最大尝试次数，默认JOBS_MAX_ATTEMPTS
+        delay: 延迟执行的秒数
+
+    Returns:
+        任务ID
+    """
+    if job_type not in HANDLERS:
+        raise ValueError(f"未知的任务类型: {job_type}，可选 {', '.join(HANDLERS)}")
+    now = datetime.utcnow()
+    job = {
+        'type': job_type,
+        'params': params or {},
+        'priority': priority,
+        'status': 'queued',
+        'attempts': 0,
+        'maxAttempts': int(max_attempts or Config.JOBS_MAX_ATTEMPTS),
+        'runAt': now + timedelta(seconds=delay),
+        'createdAt': now,
+        'worker': None,
+        'leaseUntil': None,
+        'error': None,
+        'result': None
+    }
+    return db.jobs.insert_one(job).inserted_id
+
+
+def claim(db, worker_id, types=None, lease_seconds=None):
+    """原子地领取一个可执行的任务
+
+    可执行的任务包括到期的queued任务和租约已过期的running任务，按优先级从高到低、
+    计划时间从早到晚领取。租约过期次数过多的任务直接转入dead状态。
+
+    Returns:
+        领取到的任务，没有可执行的任务时返回None
+    """
+    lease_seconds = lease_seconds or Config.JOBS_LEASE_SECONDS
+    while True:
+        now = datetime.utcnow()
+        query = {'$or': [
+            {'status': 'queued', 'runAt': {'$lte': now}},
+            {'status': 'running', 'leaseUntil': {'$lt': now}}
+        ]}
+        if types:
+            query['type'] = {'$in': list(types)}
+        job = db.jobs.find_one_and_update(
+            query,
+            {
+                '$set': {
+                    'status': 'running',
+                    'worker': worker_id,
+                    'leaseUntil': now + timedelta(seconds=lease_seconds),
+                    'heartbeatAt': now,
+                    'startedAt': now
+                },
+                '$inc': {'attempts': 1}
+            },
+            sort=[('priority', -1), ('runAt', 1)],
+            return_document=ReturnDocument.AFTER
+        )
+        if job is None:
+            return None
+        try:
+            max_attempts = int(job.get('maxAttempts') or Config.JOBS_MAX_ATTEMPTS)
+        except (TypeError, ValueError):
+            # 直接写入数据库的任务可能带有无效的最大尝试次数，不执行
+            _finish(db, job, worker_id, 'dead', error=f"maxAttempts无效: {job.get('maxAttempts')!r}")
+            logger.error(f"任务 {job['_id']} ({job['type']}) 的maxAttempts无效，已转入dead状态")
+            continue
+        if job['attempts'] <= max_attempts:
+            return job
+        # 之前的工作进程多次在执行中途失联，不再重试
+        _finish(db, job, worker_id, 'dead', error=job.get('error') or "租约多次过期，工作进程可能在执行中崩溃")
+        logger.error(f"任务 {job['_id']} ({job['type']}) 超过最大尝试次数，已转入dead状态")
+
+
+def heartbeat(db, job, worker_id, lease_seconds=None):
+    """续租，返回False表示租约已失效（已过期并被其他工作进程领取）"""
+    lease_seconds = lease_seconds or Config.JOBS_LEASE_SECONDS
+    now = datetime.utcnow()
+    result = db.jobs.update_one(
+        {'_id': job['_id'], 'status': 'running', 'worker': worker_id, 'attempts': job['attempts']},
+        {'$set': {'leaseUntil': now + timedelta(seconds=lease_seconds), 'heartbeatAt': now}}
+    )
+    return result.modified_count == 1
+
+
+def _finish(db, job, worker_id, status, result=None, error=None, run_at=None):
+    update = {'status': status, 'leaseUntil': None, 'error': error}
+    if status in ('done', 'dead'):
+        update['finishedAt'] = datetime.utcnow()
+    if result is not None:
+        update['result'] = result
+    if run_at is not None:
+        update['runAt'] = run_at
+    # 只有仍持有这次租约的工作进程才能更新任务状态
+    outcome = db.jobs.update_one(
+        {'_id': job['_id'], 'status': 'running', 'worker': worker_id, 'attempts': job['attempts']},
+        {'$set': update}
+    )
+    return outcome.modified_count == 1
+
+
+def complete(db, job, worker_id, result=None):
+    """标记任务完成，返回False表示租约已失效"""
+    return _finish(db, job, worker_id, 'done', result=result)
+
+
+def fail(db, job, worker_id, error):
+    """记录任务失败：未超过最大尝试次数时退避后重新排队，否则转入dead状态"""
+    if job['attempts'] >= job['maxAttempts']:
+        return _finish(db, job, worker_id, 'dead', error=error)
+    delay = random.uniform(0, Config.JOBS_RETRY_BACKOFF * (2 ** (job['attempts'] - 1)))
+    return _finish(db, job, worker_id, 'queued', error=error, run_at=datetime.utcnow() + timedelta(seconds=delay))
+
+
+def retry(db, job_id):
+    """将dead任务重新排队，尝试次数清零"""
+    result = db.jobs.update_one(
+        {'_id': ObjectId(job_id), 'status': 'dead'},
+        {'$set': {'status': 'queued', 'attempts': 0, 'runAt': datetime.utcnow(), 'finishedAt': None}}
+    )
+    return result.modified_count == 1
+
+
+def queue_stats(db, window_seconds=3600):
+    """队列统计：各状态任务数、待执行任务的积压和等待时间、最近一段时间的吞吐
+
+    Args:
+        db: 数据库对象
+        window_seconds: 吞吐统计的时间窗口
+    """
+    now = datetime.utcnow()
+    since = now - timedelta(seconds=window_seconds)
+    facets = list(db.jobs.aggregate([
+        {'$facet': {
+            'status': [{'$group': {'_id': {'status': '$status', 'type': '$type'}, 'count': {'$sum': 1}}}],
+            'ready': [
+                {'$match': {'status': 'queued', 'runAt': {'$lte': now}}},
+                {'$group': {'_id': None, 'count': {'$sum': 1}, 'oldest': {'$min': '$runAt'}}}
+            ],
+            'expired': [
+                {'$match': {'status': 'running', 'leaseUntil': {'$lt': now}}},
+                {'$count': 'count'}
+            ],
+            'finished': [
+                {'$match': {'finishedAt': {'$gte': since}}},
+                {'$group': {
+                    '_id': '$status',
+                    'count': {'$sum': 1},
+                    'avgSeconds': {'$avg': {'$divide': [{'$subtract': ['$finishedAt', '$startedAt']}, 1000]}}
+                }}
+            ]
+        }}
+    ]))[0]
+
+    by_status = {status: 0 for status in JOB_STATUSES}
+    by_type = {}
+    for row in facets['status']:
+        status, job_type = row['_id'].get('status'), row['_id'].get('type')
+        by_status[status] = by_status.get(status, 0) + row['count']
+        by_type.setdefault(job_type, {s: 0 for s in JOB_STATUSES})[status] = row['count']
+
+    ready = facets['ready'][0] if facets['ready'] else {'count': 0, 'oldest': None}
+    finished = {row['_id']: row for row in facets['finished']}
+    done = finished.get('done', {})
+    return {
+        'byStatus': by_status,
+        'byType': by_type,
+        'depth': ready['count'],
+        'lagSeconds': (now - ready['oldest']).total_seconds() if ready['oldest'] else 0,
+        'expiredLeases': facets['expired'][0]['count'] if facets['expired'] else 0,
+        'windowSeconds': window_seconds,
+        'completed': done.get('count', 0),
+        'deadLettered': finished.get('dead', {}).get('count', 0),
+        'throughputPerMinute': done.get('count', 0) / window_seconds * 60,
+        'avgRunSeconds': done.get('avgSeconds') or 0
+    }
+
+
+class Worker:
+    """任务工作进程：循环领取并执行任务，执行期间在后台线程中心跳续租
+
+    Args:
+        db: 数据库对象
+        worker_id: 工作进程标识，默认 主机名:PID
+        types: 只领取这些类型的任务，默认全部
+        lease_seconds: 租约时长
+        poll_interval: 没有任务时的轮询间隔（秒）
+    """
+
+    def __init__(self, db, worker_id=None, types=None, lease_seconds=None, poll_interval=None):
+        self.db = db
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.types = types
+        self.lease_seconds = lease_seconds or Config.JOBS_LEASE_SECONDS
+        self.poll_interval = poll_interval if poll_interval is not None else Config.JOBS_POLL_INTERVAL
+        self.stopping = threading.Event()
+
+    def _heartbeat(self, job, finished, lost):
+        interval = self.lease_seconds / 3
+        while not finished.wait(interval):
+            if not heartbeat(self.db, job, self.worker_id, self.lease_seconds):
+                logger.error(f"任务 {job['_id']} 的租约已失效，通知处理函数停止，结果将不会写回任务状态")
+                lost.set()
+                return
+
+    def run_one(self):
+        """领取并执行一个任务
+
+        领取出错（如数据库暂时不可用）时记录日志并按没有任务处理，工作进程不退出。
+
+        Returns:
+            执行的任务，没有可执行的任务时返回None
+        """
+        try:
+            job = claim(self.db, self.worker_id, self.types, self.lease_seconds)
+        except Exception as e:
+            logger.error(f"领取任务出错: {str(e)}")
+            return None
+        if job is None:
+            return None
+
+        logger.info(f"开始执行任务 {job['_id']} ({job['type']})，第 {job['attempts']} 次尝试")
+        finished = threading.Event()
+        lost = threading.Event()
+        beater = threading.Thread(target=self._heartbeat, args=(job, finished, lost), daemon=True)
+        beater.start()
+        started = time.perf_counter()
+        result, error = None, None
+        try:
+            # 租约失效时lost被置位，处理函数在批次之间检查并提前返回
+            result = HANDLERS[job['type']](self.db, job.get('params') or {}, lost)
+        except Exception as e:
+            error = str(e)
+        finally:
+            finished.set()
+            beater.join()
+
+        if lost.is_set():
+            return job
+        if error is not None:
+            logger.error(f"任务 {job['_id']} ({job['type']}) 执行出错: {error}")
+            fail(self.db, job, self.worker_id, error)
+            job['error'] = error
+        elif complete(self.db, job, self.worker_id, result):
+            logger.info(f"任务 {job['_id']} ({job['type']}) 完成，耗时 {time.perf_counter() - started:.1f}s")
+        return job
+
+    def run(self, max_jobs=None):
+        """持续领取任务，直到调用stop或执行了max_jobs个任务
+
+        Returns:
+            执行的任务数
+        """
+        executed = 0
+        while not self.stopping.is_set() and (max_jobs is None or executed < max_jobs):
+            job = self.run_one()
+            if job is None:
+                self.stopping.wait(self.poll_interval)
+                continue
+            executed += 1
+        return executed
+
+    def stop(self):
+        """执行完当前任务后停止"""
+        self.stopping.set()
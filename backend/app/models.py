@@ -37,7 +37,12 @@ class Message(BaseModel):
 class InteractionAnalysis(BaseModel):
     totalMessages: int
     agentMessages: int
+    userMessages: int
     imageMessages: int
+    # 时间指标单位为秒，消息缺少时间时为None
+    firstResponseTime: Optional[float] = None
+    avgResponseTime: Optional[float] = None
+    resolutionTime: Optional[float] = None
 
 # 完整会话数据模型
 class ConversationData(BaseModel):
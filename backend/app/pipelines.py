@@ -0,0 +1,38 @@
+"""
+会话字段约定模块
+派生统计和分析接口共用的字段路径、取值和聚合阶段，不依赖其他模块
+"""
+
+# 解决状态字段路径
+STATUS_FIELD = '$conversationSummary.resolutionStatus.status'
+
+# 解决状态取值
+STATUS_RESOLVED = '已解决'
+STATUS_PARTIALLY_RESOLVED = '部分解决'
+
+# 会话评估指标
+METRIC_NAMES = ['satisfaction', 'resolution', 'attitude', 'security']
+
+
+def tag_pairs_stage():
+    """将每个会话的去重标签展开为两两组合的$project阶段"""
+    return {'$project': {
+        'tagPairs': {
+            '$reduce': {
+                'input': {'$range': [0, {'$size': '$tags'}]},
+                'initialValue': [],
+                'in': {
+                    '$concatArrays': [
+                        '$$value',
+                        {
+                            '$map': {
+                                'input': {'$range': [{'$add': ['$$this', 1]}, {'$size': '$tags'}]},
+                                'as': 'j',
+                                'in': [{'$arrayElemAt': ['$tags', '$$this']}, {'$arrayElemAt': ['$tags', '$$j']}]
+                            }
+                        }
+                    ]
+                }
+            }
+        }
+    }}
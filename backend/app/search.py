@@ -0,0 +1,215 @@
+"""
+全文检索模块
+为会话生成中文友好的检索词，并构建可由索引支持的搜索条件
+
+MongoDB自带的文本索引不会切分中文，这里在写入时把中文切成相邻两字的二元词、
+把字母数字切成单词，空格拼接后存入 _search 字段，再用 default_language 为 none 的
+加权文本索引检索。查询按同样规则切分，每个检索词作为短语传给 $text，结果须包含全部检索词，
+并按 textScore 排序。
+"""
+import logging
+import re
+from pymongo import UpdateOne
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 会话中存放检索词的字段
+SEARCH_FIELD = '_search'
+
+# 各检索字段的来源路径，messages.content表示取消息数组中每条消息的content
+SEARCH_SOURCES = {
+    'key': ['id', 'customerInfo.userId', 'agent', 'tags'],
+    'issue': ['conversationSummary.mainIssue'],
+    'summary': [
+        'conversationSummary.mainSolution',
+        'conversationSummary.resolutionStatus.description',
+        'improvementSuggestions',
+        'hotWords'
+    ],
+    'content': ['messages.content']
+}
+
+# 文本索引中各检索字段的权重
+SEARCH_WEIGHTS = {'key': 10, 'issue': 8, 'summary': 4, 'content': 1}
+
+# 按textScore排序的排序键
+SCORE_SORT = [('score', {'$meta': 'textScore'})]
+
+# 中文字符段和字母数字段
+TOKEN_PATTERN = re.compile(r'([\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+)|([0-9A-Za-z]+)')
+
+# 形如会话ID或用户ID的查询：以#开头，或由字母数字组成且包含数字
+ID_PATTERN = re.compile(r'^#|^(?=.*\d)[0-9A-Za-z_\-]+$')
+
+
+def tokenize(text):
+    """将文本切分为检索词
+
+    中文按相邻两字切为二元词，只有一个字的中文段保留单字；字母数字按单词切分并转为小写。
+
+    Returns:
+        检索词列表，保持出现顺序，可能重复
+    """
+    tokens = []
+    for cjk, word in TOKEN_PATTERN.findall(text or ''):
+        if cjk:
+            if len(cjk) == 1:
+                tokens.append(cjk)
+            else:
+                tokens.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+        else:
+            tokens.append(word.lower())
+    return tokens
+
+
+def _values(doc, path):
+    """按点分路径读取字段值，途经数组时展开，返回字符串列表"""
+    values = [doc]
+    for key in path.split('.'):
+        next_values = []
+        for value in values:
+            if isinstance(value, list):
+                value = [item.get(key) for item in value if isinstance(item, dict)]
+                next_values.extend(value)
+            elif isinstance(value, dict) and key in value:
+                next_values.append(value[key])
+        values = next_values
+    strings = []
+    for value in values:
+        if isinstance(value, list):
+            strings.extend(str(item) for item in value if item is not None)
+        elif value is not None:
+            strings.append(str(value))
+    return strings
+
+
+def search_fields(doc):
+    """根据会话内容生成 _search 字段的值
+
+    Returns:
+        {检索字段名: 空格分隔的去重检索词}
+    """
+    fields = {}
+    for name, paths in SEARCH_SOURCES.items():
+        tokens = []
+        for path in paths:
+            for value in _values(doc, path):
+                tokens.extend(tokenize(value))
+        fields[name] = ' '.join(dict.fromkeys(tokens))
+    return fields
+
+
+def text_index():
+    """索引注册表中的加权文本索引定义"""
+    return {
+        'collection': 'conversations',
+        'keys': [(f'{SEARCH_FIELD}.{name}', 'text') for name in SEARCH_SOURCES],
+        'options': {
+            'name': 'search_text',
+            'weights': {f'{SEARCH_FIELD}.{name}': weight for name, weight in SEARCH_WEIGHTS.items()},
+            'default_language': 'none',
+            # 指向不存在的字段，避免会话中的language字段被当作分词语言
+            'language_override': f'{SEARCH_FIELD}_language'
+        }
+    }
+
+
+def search_query(text):
+    """构建搜索文本的查询条件
+
+    形如ID的查询同时按会话ID和客户ID做前缀匹配；包含单字中文段等无法由文本索引处理的查询
+    回退为正则匹配。
+
+    Args:
+        text: 用户输入的搜索文本
+
+    Returns:
+        可与其他筛选条件合并的查询条件字典
+    """
+    text = text.strip()
+    tokens = list(dict.fromkeys(tokenize(text)))
+    indexable = bool(tokens) and all(len(token) > 1 or token.isascii() for token in tokens)
+
+    if not indexable:
+        pattern = re.escape(text)
+        return {'$or': [
+            {'id': {'$regex': pattern, '$options': 'i'}},
+            {'customerInfo.userId': {'$regex': pattern, '$options': 'i'}},
+            {'conversationSummary.mainIssue': {'$regex': pattern, '$options': 'i'}}
+        ]}
+
+    text_query = {'$text': {'$search': ' '.join(f'"{token}"' for token in tokens)}}
+    if not ID_PATTERN.match(text):
+        return text_query
+
+    prefix = {'$regex': '^' + re.escape(text)}
+    return {'$or': [text_query, {'id': prefix}, {'customerInfo.userId': prefix}]}
+
+
+def uses_text(query):
+    """判断查询条件中是否包含 $text 检索"""
+    if '$text' in query:
+        return True
+    return any(uses_text(clause) for key in ('$or', '$and') for clause in query.get(key, []))
+
+
+# Unicode最大码位和代理区，字符串按UTF-8字节比较，与码位顺序一致
+MAX_CODE_POINT = 0x10FFFF
+SURROGATE_START, SURROGATE_END = 0xD800, 0xDFFF
+
+
+def prefix_range(prefix):
+    """将前缀转换为可由索引直接定位的字符串范围条件
+
+    上界为末位字符加一；加一会落入代理区时跳到代理区之后，末位已是最大码位时去掉该位、对前一位加一。
+    前缀全由最大码位组成时，不小于前缀的字符串都以前缀开头，只需下界。
+    """
+    stem = prefix.rstrip(chr(MAX_CODE_POINT))
+    if not stem:
+        return {'$gte': prefix}
+    code = ord(stem[-1]) + 1
+    if SURROGATE_START <= code <= SURROGATE_END:
+        code = SURROGATE_END + 1
+    return {'$gte': prefix, '$lt': stem[:-1] + chr(code)}
+
+
+def reindex(db, batch_size=500, only_missing=False, cancel=None):
+    """为已有会话重新生成 _search 字段
+
+    Args:
+        db: 数据库对象
+        batch_size: 每批写入的文档数
+        only_missing: 只处理缺少 _search 字段的会话
+        cancel: 取消标记（threading.Event），置位后写完已处理的会话即停止
+
+    Returns:
+        {'documents': 处理的会话数, 'updated': 检索词发生变化的会话数, 'cancelled': 是否已取消}
+    """
+    projection = {'_id': 1, SEARCH_FIELD: 1}
+    for paths in SEARCH_SOURCES.values():
+        for path in paths:
+            projection[path] = 1
+    query = {SEARCH_FIELD: {'$exists': False}} if only_missing else {}
+
+    documents = 0
+    updated = 0
+    cancelled = False
+    operations = []
+    for doc in db.conversations.find(query, projection):
+        # 每处理batch_size个会话检查一次取消标记
+        if documents % batch_size == 0 and cancel is not None and cancel.is_set():
+            cancelled = True
+            break
+        documents += 1
+        fields = search_fields(doc)
+        if doc.get(SEARCH_FIELD) != fields:
+            operations.append(UpdateOne({'_id': doc['_id']}, {'$set': {SEARCH_FIELD: fields}}))
+        if len(operations) >= batch_size:
+            updated += db.conversations.bulk_write(operations, ordered=False).modified_count
+            operations = []
+    if operations:
+        updated += db.conversations.bulk_write(operations, ordered=False).modified_count
+
+    logger.info(f"检索词已重建: {documents} 个会话，{updated} 个发生变化{'，已取消' if cancelled else ''}")
+    return {'documents': documents, 'updated': updated, 'cancelled': cancelled}
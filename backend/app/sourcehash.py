@@ -0,0 +1,25 @@
+"""
+会话源内容哈希模块
+为写入的会话计算稳定的内容哈希，重复导入时据此跳过内容未变化的会话
+
+哈希覆盖导入时提交的全部字段（含origin_conversation、agent、time等），
+不含_id和写入时生成的派生字段；字段顺序不影响结果。
+"""
+import hashlib
+import json
+from bson import json_util
+from .search import SEARCH_FIELD
+
+# 会话中存放源内容哈希的字段
+SOURCE_HASH_FIELD = 'sourceHash'
+
+# 不参与哈希的字段
+DERIVED_FIELDS = ('_id', SEARCH_FIELD, SOURCE_HASH_FIELD)
+
+
+def source_hash(doc):
+    """计算会话源内容的SHA-1哈希"""
+    source = {key: value for key, value in doc.items() if key not in DERIVED_FIELDS}
+    canonical = json.dumps(source, sort_keys=True, ensure_ascii=False, separators=(',', ':'),
+                           default=json_util.default)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
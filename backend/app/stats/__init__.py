@@ -0,0 +1,44 @@
+"""
+派生统计模块
+会话写入后同步维护各类预聚合数据，供看板类接口直接读取
+"""
+import itertools
+import logging
+from . import rollups, cube, cooccurrence, hotwords
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 派生统计模块及对应的重建命令
+MODULES = [
+    (rollups, 'rebuild-rollups'),
+    (cube, 'rebuild-cube'),
+    (cooccurrence, 'rebuild-cooccurrence'),
+    (hotwords, 'rebuild-hotwords')
+]
+
+# 会话写入代数，每次同步派生统计时递增，依赖会话内容的进程内缓存以此判断是否失效
+generation = 0
+_generations = itertools.count(1)
+
+
+def apply_changes(db, changes):
+    """将会话变更同步到所有派生统计
+
+    派生统计的更新失败不影响会话本身的写入，偏差可通过重建命令修复。
+
+    Args:
+        db: 数据库连接
+        changes: (before, after) 列表，新建时before为None，删除时after为None
+    """
+    global generation
+
+    if not changes:
+        return
+
+    generation = next(_generations)
+    for module, command in MODULES:
+        try:
+            module.apply_changes(db, changes)
+        except Exception as e:
+            logger.error(f"更新派生统计 {module.COLLECTION} 出错，请运行 `python manage.py {command}` 修复: {str(e)}")
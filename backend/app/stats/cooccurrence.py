@@ -0,0 +1,185 @@
+"""
+标签共现模块
+以稀疏的 (tagA, tagB) → count 结构维护标签两两共现次数，
+在会话写入时增量更新，查询Top共现和单个标签的相邻标签只需读取索引
+"""
+from datetime import datetime
+from itertools import combinations
+import logging
+from pymongo import UpdateOne, ReplaceOne
+from ..pipelines import tag_pairs_stage
+from .rollups import diff_documents
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 共现集合名称
+COLLECTION = 'tag_pairs'
+
+# 元数据文档ID，存在即表示共现矩阵已完成全量构建
+META_ID = 'meta'
+
+
+def doc_pairs(doc):
+    """返回会话去重标签的全部两两组合，组合内按字典序排列"""
+    if not doc:
+        return []
+    tags = sorted(set(doc.get('tags') or []))
+    return list(combinations(tags, 2))
+
+
+def pair_id(pair):
+    """生成标签对文档ID"""
+    return {'a': pair[0], 'b': pair[1]}
+
+
+def compute_deltas(changes):
+    """根据会话变更计算各标签对的计数增量
+
+    Args:
+        changes: (before, after) 列表
+
+    Returns:
+        {(tagA, tagB): increment}
+    """
+    deltas = {}
+    for before, after in changes:
+        for pair in doc_pairs(before):
+            deltas[pair] = deltas.get(pair, 0) - 1
+        for pair in doc_pairs(after):
+            deltas[pair] = deltas.get(pair, 0) + 1
+    return {pair: delta for pair, delta in deltas.items() if delta != 0}
+
+
+def apply_changes(db, changes):
+    """将会话变更以$inc增量写入共现矩阵
+
+    Args:
+        db: 数据库连接
+        changes: (before, after) 列表
+    """
+    deltas = compute_deltas(changes)
+    if not deltas:
+        return
+
+    operations = [
+        UpdateOne(
+            {'_id': pair_id(pair)},
+            {'$inc': {'count': delta}, '$setOnInsert': pair_id(pair)},
+            upsert=True
+        )
+        for pair, delta in deltas.items()
+    ]
+    db[COLLECTION].bulk_write(operations, ordered=False)
+
+
+def is_built(db):
+    """共现矩阵是否已完成全量构建"""
+    return db[COLLECTION].find_one({'_id': META_ID}, {'_id': 1}) is not None
+
+
+def top_pairs(db, limit=20):
+    """返回共现次数最多的标签对
+
+    Returns:
+        [{'tag_pair': [str, str], 'count': int}]
+    """
+    cursor = db[COLLECTION].find(
+        {'count': {'$gt': 0}},
+        {'_id': 0, 'a': 1, 'b': 1, 'count': 1}
+    ).sort('count', -1).limit(limit)
+    return [{'tag_pair': [doc['a'], doc['b']], 'count': doc['count']} for doc in cursor]
+
+
+def neighbours(db, tag, limit=20):
+    """返回与指定标签共现次数最多的标签
+
+    Returns:
+        [{'tag': str, 'tag_pair': [str, str], 'count': int}]
+    """
+    cursor = db[COLLECTION].find(
+        {'$or': [{'a': tag}, {'b': tag}], 'count': {'$gt': 0}},
+        {'_id': 0, 'a': 1, 'b': 1, 'count': 1}
+    ).sort('count', -1).limit(limit)
+    return [
+        {
+            'tag': doc['b'] if doc['a'] == tag else doc['a'],
+            'tag_pair': [doc['a'], doc['b']],
+            'count': doc['count']
+        }
+        for doc in cursor
+    ]
+
+
+def _compute_expected(db):
+    """从会话集合全量计算共现矩阵"""
+    pipeline = [
+        {'$project': {'tags': {'$setUnion': [{'$ifNull': ['$tags', []]}, []]}}},
+        {'$match': {'tags.1': {'$exists': True}}},
+        tag_pairs_stage(),
+        {'$unwind': '$tagPairs'},
+        {'$group': {'_id': '$tagPairs', 'count': {'$sum': 1}}}
+    ]
+    expected = {}
+    for row in db.conversations.aggregate(pipeline, allowDiskUse=True):
+        # $setUnion不保证输出顺序，组合内按与doc_pairs相同的顺序排列，同一标签对的不同顺序合并计数
+        pair = tuple(sorted(row['_id']))
+        if pair in expected:
+            expected[pair]['count'] += row['count']
+        else:
+            expected[pair] = {'_id': pair_id(pair), **pair_id(pair), 'count': row['count']}
+    return expected
+
+
+def rebuild(db, dry_run=False, cancel=None):
+    """从会话集合全量重算共现矩阵，并报告与现有计数的偏差
+
+    Args:
+        db: 数据库连接
+        dry_run: 为True时只报告偏差，不写入
+        cancel: 取消标记（threading.Event），置位后不再写入，返回的cancelled为True
+
+    Returns:
+        {'documents': int, 'drifted': int, 'drift': [{'id', 'field', 'expected', 'actual'}], 'cancelled': bool}
+    """
+    expected = _compute_expected(db)
+    actual = {
+        (doc.get('a'), doc.get('b')): doc
+        for doc in db[COLLECTION].find({'_id': {'$ne': META_ID}})
+    }
+
+    drift, drifted_pairs = diff_documents(expected, actual, ignore={'_id', 'a', 'b'})
+    for item in drift:
+        item['id'] = '/'.join(item['id'])
+
+    cancelled = False
+    if not dry_run:
+        operations = [
+            ReplaceOne({'_id': doc['_id']}, doc, upsert=True)
+            for doc in expected.values()
+        ]
+        for start in range(0, len(operations), 1000):
+            # 每批写入前检查取消标记，已写入的部分由下一次重建覆盖
+            if cancel is not None and cancel.is_set():
+                cancelled = True
+                break
+            db[COLLECTION].bulk_write(operations[start:start + 1000], ordered=False)
+    if cancelled:
+        logger.warning("标签共现矩阵重建已取消，未完成写入")
+    elif not dry_run:
+        stale_ids = [actual[pair]['_id'] for pair in actual if pair not in expected]
+        for start in range(0, len(stale_ids), 1000):
+            db[COLLECTION].delete_many({'_id': {'$in': stale_ids[start:start + 1000]}})
+        db[COLLECTION].replace_one(
+            {'_id': META_ID},
+            {'builtAt': datetime.now().strftime("%Y-%m-%d %H:%M:%S")},
+            upsert=True
+        )
+        logger.info(f"标签共现矩阵已重建: {len(expected)} 个标签对，{len(drifted_pairs)} 个存在偏差")
+
+    return {
+        'documents': len(expected),
+        'drifted': len(drifted_pairs),
+        'drift': drift,
+        'cancelled': cancelled
+    }
@@ -0,0 +1,243 @@
+"""
+按天分桶的指标立方体模块
+以 (日期, 客服, 标签, 解决状态) 为键预聚合计数和指标总和，
+任意时间范围的看板统计只需合并范围内的日桶，无需扫描会话集合
+"""
+from datetime import datetime
+import logging
+from pymongo import UpdateOne, ReplaceOne
+from ..pipelines import STATUS_FIELD
+from .rollups import compute_deltas, group_fields, diff_documents, VALUE_FIELDS
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 立方体集合名称
+COLLECTION = 'metric_cube'
+
+# 元数据文档ID，存在即表示立方体已完成全量构建
+META_ID = 'meta'
+
+# 日期字段长度，对应 YYYY-MM-DD
+DAY_LENGTH = 10
+
+
+def doc_day(doc):
+    """提取会话所在日期，时间缺失或格式不符时返回None"""
+    time = doc.get('time')
+    if not isinstance(time, str) or len(time) < DAY_LENGTH:
+        return None
+    return time[:DAY_LENGTH]
+
+
+def doc_keys(doc):
+    """返回会话所属的全部日桶键 (day, agent, tag, status)
+
+    每个会话计入一个tag为None的基础桶，用于总量、客服和状态统计；
+    另外按去重后的标签各计入一个标签桶，用于标签统计。
+    """
+    day = doc_day(doc)
+    if day is None:
+        return []
+
+    agent = doc.get('agent')
+    status = ((doc.get('conversationSummary') or {}).get('resolutionStatus') or {}).get('status')
+    keys = [(day, agent, None, status)]
+    for tag in set(doc.get('tags') or []):
+        keys.append((day, agent, tag, status))
+    return keys
+
+
+def bucket_id(key):
+    """生成日桶文档ID"""
+    day, agent, tag, status = key
+    return {'day': day, 'agent': agent, 'tag': tag, 'status': status}
+
+
+def apply_changes(db, changes):
+    """将会话变更以$inc增量写入立方体
+
+    Args:
+        db: 数据库连接
+        changes: (before, after) 列表
+    """
+    deltas = compute_deltas(changes, keys_func=doc_keys)
+    if not deltas:
+        return
+
+    operations = [
+        UpdateOne(
+            {'_id': bucket_id(key)},
+            {'$inc': delta, '$setOnInsert': bucket_id(key)},
+            upsert=True
+        )
+        for key, delta in deltas.items()
+    ]
+    db[COLLECTION].bulk_write(operations, ordered=False)
+
+
+def is_built(db):
+    """立方体是否已完成全量构建"""
+    return db[COLLECTION].find_one({'_id': META_ID}, {'_id': 1}) is not None
+
+
+def day_range(time_start=None, time_end=None):
+    """将时间范围参数转换为日期范围，按整天计算且包含首尾两天
+
+    Returns:
+        (start_day, end_day)
+    """
+    start_day = time_start[:DAY_LENGTH] if time_start else '0000-00-00'
+    end_day = time_end[:DAY_LENGTH] if time_end else '9999-99-99'
+    return start_day, end_day
+
+
+def time_match(start_day, end_day):
+    """与日期范围等价的会话time字段筛选条件"""
+    return {'time': {'$gte': start_day, '$lte': end_day + '\uffff'}}
+
+
+def _sum_fields():
+    return {field: {'$sum': f'${field}'} for field in VALUE_FIELDS}
+
+
+def load(db, start_day, end_day):
+    """合并日期范围内的日桶
+
+    Returns:
+        与rollups.load相同结构的字典 {'global', 'agent', 'tag', 'status'}，
+        立方体尚未构建时返回None
+    """
+    if not is_built(db):
+        return None
+
+    fields = _sum_fields()
+    pipeline = [
+        {'$match': {'day': {'$gte': start_day, '$lte': end_day}}},
+        {'$facet': {
+            'global': [
+                {'$match': {'tag': None}},
+                {'$group': {'_id': None, **fields}}
+            ],
+            'agent': [
+                {'$match': {'tag': None, 'agent': {'$ne': None}}},
+                {'$group': {'_id': '$agent', **fields}}
+            ],
+            'status': [
+                {'$match': {'tag': None, 'status': {'$ne': None}}},
+                {'$group': {'_id': '$status', **fields}}
+            ],
+            'tag': [
+                {'$match': {'tag': {'$ne': None}}},
+                {'$group': {'_id': '$tag', **fields}}
+            ]
+        }}
+    ]
+    result = list(db[COLLECTION].aggregate(pipeline))
+    facets = result[0] if result else {}
+
+    def rows(kind):
+        return [
+            {'key': row.pop('_id'), **row}
+            for row in facets.get(kind, [])
+            if row.get('count', 0) > 0
+        ]
+
+    overall = rows('global')
+    return {
+        'global': overall[0] if overall else {},
+        'agent': rows('agent'),
+        'tag': rows('tag'),
+        'status': rows('status')
+    }
+
+
+def _compute_expected(db):
+    """从会话集合全量计算全部日桶"""
+    fields = group_fields()
+    prepare = [
+        {'$match': {'time': {'$type': 'string'}}},
+        {'$project': {
+            'day': {'$substrCP': ['$time', 0, DAY_LENGTH]},
+            'agent': {'$ifNull': ['$agent', None]},
+            'status': {'$ifNull': [STATUS_FIELD, None]},
+            'tags': {'$setUnion': [{'$ifNull': ['$tags', []]}, []]},
+            'metrics': 1,
+            'interactionAnalysis': 1,
+            'conversationSummary.resolutionStatus.status': 1
+        }},
+        {'$match': {'day': {'$regex': r'^.{10}$'}}}
+    ]
+    base = prepare + [
+        {'$group': {'_id': {'day': '$day', 'agent': '$agent', 'tag': None, 'status': '$status'}, **fields}}
+    ]
+    tagged = prepare + [
+        {'$unwind': '$tags'},
+        {'$group': {'_id': {'day': '$day', 'agent': '$agent', 'tag': '$tags', 'status': '$status'}, **fields}}
+    ]
+
+    expected = {}
+    for pipeline in (base, tagged):
+        for row in db.conversations.aggregate(pipeline, allowDiskUse=True):
+            key_doc = row.pop('_id')
+            key = (key_doc['day'], key_doc['agent'], key_doc['tag'], key_doc['status'])
+            values = {field: value for field, value in row.items() if value != 0}
+            expected[key] = {'_id': bucket_id(key), **bucket_id(key), **values}
+    return expected
+
+
+def rebuild(db, dry_run=False, cancel=None):
+    """从会话集合全量重算立方体，并报告与现有日桶的偏差
+
+    Args:
+        db: 数据库连接
+        dry_run: 为True时只报告偏差，不写入
+        cancel: 取消标记（threading.Event），置位后不再写入，返回的cancelled为True
+
+    Returns:
+        {'documents': int, 'drifted': int, 'drift': [{'id', 'field', 'expected', 'actual'}], 'cancelled': bool}
+    """
+    expected = _compute_expected(db)
+    actual = {}
+    for doc in db[COLLECTION].find({'_id': {'$ne': META_ID}}):
+        key = (doc.get('day'), doc.get('agent'), doc.get('tag'), doc.get('status'))
+        actual[key] = doc
+
+    drift, drifted_keys = diff_documents(
+        expected, actual,
+        ignore={'_id', 'day', 'agent', 'tag', 'status'}
+    )
+    for item in drift:
+        item['id'] = '/'.join(str(part) for part in item['id'])
+
+    cancelled = False
+    if not dry_run:
+        operations = [
+            ReplaceOne({'_id': doc['_id']}, doc, upsert=True)
+            for doc in expected.values()
+        ]
+        for start in range(0, len(operations), 1000):
+            # 每批写入前检查取消标记，已写入的部分由下一次重建覆盖
+            if cancel is not None and cancel.is_set():
+                cancelled = True
+                break
+            db[COLLECTION].bulk_write(operations[start:start + 1000], ordered=False)
+    if cancelled:
+        logger.warning("指标立方体重建已取消，未完成写入")
+    elif not dry_run:
+        stale_ids = [actual[key]['_id'] for key in actual if key not in expected]
+        for start in range(0, len(stale_ids), 1000):
+            db[COLLECTION].delete_many({'_id': {'$in': stale_ids[start:start + 1000]}})
+        db[COLLECTION].replace_one(
+            {'_id': META_ID},
+            {'builtAt': datetime.now().strftime("%Y-%m-%d %H:%M:%S")},
+            upsert=True
+        )
+        logger.info(f"指标立方体已重建: {len(expected)} 个日桶，{len(drifted_keys)} 个存在偏差")
+
+    return {
+        'documents': len(expected),
+        'drifted': len(drifted_keys),
+        'drift': drift,
+        'cancelled': cancelled
+    }
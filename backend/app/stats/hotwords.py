@@ -0,0 +1,358 @@
+"""
+热词统计模块
+使用Space-Saving算法在有限内存内维护全局、按标签和按客服的Top热词，
+写入时在进程内累计，定期与持久化的摘要合并
+"""
+from collections import Counter
+from datetime import datetime
+import atexit
+import heapq
+import logging
+import threading
+import time
+from pymongo.errors import DuplicateKeyError
+from ..config import Config
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 热词摘要集合名称
+COLLECTION = 'hotword_sketches'
+
+# 全局范围
+GLOBAL_SCOPE = 'global'
+
+
+class SpaceSaving:
+    """Space-Saving频繁项摘要
+
+    最多保留capacity个计数器。每个计数器记录 [count, error]，
+    真实频次落在 [count - error, count] 区间内；未被跟踪的词频次不超过 min_count()。
+    """
+
+    def __init__(self, capacity, n=0):
+        self.capacity = capacity
+        self.n = n
+        self.counters = {}
+        self._heap = []
+
+    def __len__(self):
+        return len(self.counters)
+
+    def is_full(self):
+        return len(self.counters) >= self.capacity
+
+    def _push(self, word):
+        heapq.heappush(self._heap, (self.counters[word][0], word))
+        # 惰性删除会留下过期的堆项，过多时重建
+        if len(self._heap) > 4 * self.capacity + 16:
+            self._rebuild_heap()
+
+    def _rebuild_heap(self):
+        self._heap = [(entry[0], word) for word, entry in self.counters.items()]
+        heapq.heapify(self._heap)
+
+    def _peek_min(self):
+        while self._heap:
+            count, word = self._heap[0]
+            entry = self.counters.get(word)
+            if entry is not None and entry[0] == count:
+                return count, word
+            heapq.heappop(self._heap)
+        return 0, None
+
+    def min_count(self):
+        """最小计数器的值，摘要未满时为0"""
+        return self._peek_min()[0] if self.is_full() else 0
+
+    def add(self, word, weight=1):
+        """记录一次词出现"""
+        self.n += weight
+        entry = self.counters.get(word)
+        if entry is not None:
+            entry[0] += weight
+        elif not self.is_full():
+            self.counters[word] = [weight, 0]
+        else:
+            # 替换最小计数器，新词继承其计数作为误差上界
+            min_count, min_word = self._peek_min()
+            heapq.heappop(self._heap)
+            del self.counters[min_word]
+            self.counters[word] = [min_count + weight, min_count]
+        self._push(word)
+
+    def merge(self, other):
+        """合并另一个摘要，合并后的计数仍是真实频次的上界"""
+        self_floor = self.min_count()
+        other_floor = other.min_count()
+        merged = {}
+        for word in set(self.counters) | set(other.counters):
+            count1, error1 = self.counters.get(word, (self_floor, self_floor))
+            count2, error2 = other.counters.get(word, (other_floor, other_floor))
+            merged[word] = [count1 + count2, error1 + error2]
+
+        if len(merged) > self.capacity:
+            kept = heapq.nlargest(self.capacity, merged.items(), key=lambda item: item[1][0])
+            merged = dict(kept)
+
+        self.counters = merged
+        self.n += other.n
+        self._rebuild_heap()
+        return self
+
+    def top(self, limit):
+        """返回计数最高的词，[(word, count, error)]"""
+        items = heapq.nlargest(limit, self.counters.items(), key=lambda item: item[1][0])
+        return [(word, entry[0], entry[1]) for word, entry in items]
+
+    def bounds(self):
+        """摘要的误差界限"""
+        return {
+            'streamLength': self.n,
+            'capacity': self.capacity,
+            # 未被跟踪的词频次不超过该值
+            'maxError': self.min_count(),
+            # Space-Saving的理论误差上界 N/k
+            'errorBound': self.n / self.capacity if self.capacity > 0 else 0
+        }
+
+    def copy(self):
+        sketch = SpaceSaving(self.capacity, self.n)
+        sketch.counters = {word: list(entry) for word, entry in self.counters.items()}
+        sketch._rebuild_heap()
+        return sketch
+
+    def to_doc(self):
+        return {
+            'capacity': self.capacity,
+            'n': self.n,
+            'counters': [[word, entry[0], entry[1]] for word, entry in self.counters.items()]
+        }
+
+    @classmethod
+    def from_doc(cls, doc, capacity=None):
+        sketch = cls(capacity or doc.get('capacity') or Config.HOTWORDS_CAPACITY, doc.get('n', 0))
+        for word, count, error in doc.get('counters', []):
+            sketch.counters[word] = [count, error]
+        if len(sketch.counters) > sketch.capacity:
+            sketch.merge(cls(sketch.capacity))
+        sketch._rebuild_heap()
+        return sketch
+
+
+def scope_id(kind, key=None):
+    """生成统计范围ID"""
+    return GLOBAL_SCOPE if kind == GLOBAL_SCOPE else f'{kind}:{key}'
+
+
+def doc_scopes(doc):
+    """返回会话热词计入的全部统计范围"""
+    scopes = [GLOBAL_SCOPE]
+    if doc.get('agent') is not None:
+        scopes.append(scope_id('agent', doc['agent']))
+    for tag in set(doc.get('tags') or []):
+        scopes.append(scope_id('tag', tag))
+    return scopes
+
+
+def added_words(before, after):
+    """返回会话变更中新增的热词出现次数
+
+    Space-Saving只支持插入，删除会话或移除热词不会扣减计数，
+    由此产生的高估可通过重建命令消除。
+    """
+    if not after:
+        return Counter()
+    words = Counter(word for word in after.get('hotWords') or [] if isinstance(word, str))
+    if before:
+        words -= Counter(word for word in before.get('hotWords') or [] if isinstance(word, str))
+    return words
+
+
+class SketchStore:
+    """进程内的热词摘要缓冲
+
+    写入只更新进程内的增量摘要，定期与数据库中持久化的摘要合并，
+    多个进程各自合并自己的增量，不会相互覆盖。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._last_flush = time.monotonic()
+        self._db = None
+        self._atexit_registered = False
+
+    def observe(self, db, changes):
+        """记录会话变更中新增的热词"""
+        with self._lock:
+            self._db = db
+            if not self._atexit_registered:
+                atexit.register(self.flush)
+                self._atexit_registered = True
+            for before, after in changes:
+                words = added_words(before, after)
+                if not words:
+                    continue
+                for scope in doc_scopes(after):
+                    sketch = self._pending.get(scope)
+                    if sketch is None:
+                        sketch = self._pending[scope] = SpaceSaving(Config.HOTWORDS_CAPACITY)
+                    for word, weight in words.items():
+                        sketch.add(word, weight)
+
+    def discard(self):
+        """丢弃尚未持久化的增量"""
+        with self._lock:
+            self._pending = {}
+
+    def pending(self, scope):
+        """返回指定范围尚未持久化的增量摘要副本"""
+        with self._lock:
+            sketch = self._pending.get(scope)
+            return sketch.copy() if sketch is not None else None
+
+    def maybe_flush(self, db=None):
+        """距上次持久化超过配置间隔时执行持久化"""
+        if time.monotonic() - self._last_flush >= Config.HOTWORDS_FLUSH_SECONDS:
+            self.flush(db)
+
+    def flush(self, db=None):
+        """将增量摘要与持久化摘要合并"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+            db = db if db is not None else self._db
+        if not pending or db is None:
+            return
+
+        for scope, sketch in pending.items():
+            try:
+                _merge_into(db, scope, sketch)
+            except Exception as e:
+                logger.error(f"持久化热词摘要 {scope} 出错: {str(e)}")
+
+
+store = SketchStore()
+
+
+def _merge_into(db, scope, sketch, retries=5):
+    """以乐观锁将增量摘要合并进持久化摘要"""
+    for _ in range(retries):
+        doc = db[COLLECTION].find_one({'_id': scope})
+        if doc is None:
+            try:
+                db[COLLECTION].insert_one({'_id': scope, 'version': 1, **sketch.to_doc()})
+                return
+            except DuplicateKeyError:
+                continue
+
+        merged = SpaceSaving.from_doc(doc, Config.HOTWORDS_CAPACITY).merge(sketch)
+        result = db[COLLECTION].update_one(
+            {'_id': scope, 'version': doc.get('version', 0)},
+            {'$set': {**merged.to_doc(), 'version': doc.get('version', 0) + 1}}
+        )
+        if result.matched_count == 1:
+            return
+    logger.warning(f"热词摘要 {scope} 合并冲突次数过多，本次增量已丢弃")
+
+
+def apply_changes(db, changes):
+    """记录会话变更中的热词，并按间隔持久化
+
+    Args:
+        db: 数据库连接
+        changes: (before, after) 列表
+    """
+    store.observe(db, changes)
+    store.maybe_flush(db)
+
+
+def is_built(db):
+    """全局热词摘要是否已完成全量构建"""
+    return db[COLLECTION].find_one({'_id': GLOBAL_SCOPE, 'built': True}, {'_id': 1}) is not None
+
+
+def load(db, scope):
+    """读取指定范围的热词摘要，包含本进程尚未持久化的增量
+
+    Returns:
+        SpaceSaving实例，范围不存在时返回空摘要
+    """
+    doc = db[COLLECTION].find_one({'_id': scope})
+    sketch = SpaceSaving.from_doc(doc, Config.HOTWORDS_CAPACITY) if doc else SpaceSaving(Config.HOTWORDS_CAPACITY)
+    pending = store.pending(scope)
+    if pending is not None:
+        sketch.merge(pending)
+    return sketch
+
+
+def rebuild(db, dry_run=False, cancel=None):
+    """从会话集合全量重算所有范围的热词摘要
+
+    每个范围只保留有限个计数器，内存占用与会话数量无关。
+    写入时版本号递增，其他进程在重建前读取摘要的合并会因版本不符而重新读取，不会覆盖重建结果。
+    重建只丢弃本进程尚未持久化的增量，其他进程中重建前累计的增量仍会在其下次持久化时合并，
+    造成少量重复计数，需要精确结果时应在停止写入后重建。
+
+    Args:
+        db: 数据库连接
+        dry_run: 为True时只计算，不写入
+        cancel: 取消标记（threading.Event），置位后不再写入，返回的cancelled为True
+
+    Returns:
+        {'documents': int, 'drifted': int, 'drift': [{'id', 'field', 'expected', 'actual'}], 'cancelled': bool}，
+        偏差只比较全局Top热词
+    """
+    # 丢弃重建前尚未持久化的增量，避免重复计数
+    store.discard()
+    previous = db[COLLECTION].find_one({'_id': GLOBAL_SCOPE})
+
+    sketches = {GLOBAL_SCOPE: SpaceSaving(Config.HOTWORDS_CAPACITY)}
+    cursor = db.conversations.find(
+        {'hotWords.0': {'$exists': True}},
+        {'_id': 0, 'hotWords': 1, 'tags': 1, 'agent': 1}
+    )
+    for doc in cursor:
+        words = added_words(None, doc)
+        for scope in doc_scopes(doc):
+            sketch = sketches.get(scope)
+            if sketch is None:
+                sketch = sketches[scope] = SpaceSaving(Config.HOTWORDS_CAPACITY)
+            for word, weight in words.items():
+                sketch.add(word, weight)
+
+    # 比较全局Top热词的计数偏差
+    drift = []
+    if previous is not None:
+        actual = SpaceSaving.from_doc(previous, Config.HOTWORDS_CAPACITY).counters
+        for word, count, _ in sketches[GLOBAL_SCOPE].top(20):
+            actual_count = actual.get(word, [0])[0]
+            if actual_count != count:
+                drift.append({
+                    'id': GLOBAL_SCOPE,
+                    'field': word,
+                    'expected': count,
+                    'actual': actual_count
+                })
+
+    cancelled = cancel is not None and cancel.is_set()
+    if cancelled:
+        logger.warning("热词摘要重建已取消，未写入")
+    elif not dry_run:
+        built_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        for scope, sketch in sketches.items():
+            db[COLLECTION].update_one(
+                {'_id': scope},
+                {'$set': {'built': True, 'builtAt': built_at, **sketch.to_doc()}, '$inc': {'version': 1}},
+                upsert=True
+            )
+        db[COLLECTION].delete_many({'_id': {'$nin': list(sketches)}})
+        logger.info(f"热词摘要已重建: {len(sketches)} 个范围")
+
+    return {
+        'documents': len(sketches),
+        'drifted': 1 if drift else 0,
+        'drift': drift,
+        'cancelled': cancelled
+    }
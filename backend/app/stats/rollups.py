@@ -0,0 +1,289 @@
+"""
+看板汇总模块
+维护按客服、标签、解决状态和全局划分的计数器与指标总和，
+在会话写入时通过$inc增量更新，使看板类接口只需读取少量汇总文档
+"""
+from datetime import datetime
+import logging
+from pymongo import UpdateOne, ReplaceOne
+from ..pipelines import STATUS_FIELD, STATUS_RESOLVED, STATUS_PARTIALLY_RESOLVED, METRIC_NAMES
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 汇总集合名称
+COLLECTION = 'rollups'
+
+# 元数据文档ID，存在即表示汇总已完成全量构建
+META_ID = 'meta'
+
+# 需要累计的交互统计字段
+INTERACTION_FIELDS = ['totalMessages', 'agentMessages', 'userMessages']
+
+# 汇总维度
+KINDS = ['global', 'agent', 'tag', 'status']
+
+# 汇总文档中的全部计数字段
+VALUE_FIELDS = ['count', 'resolved_count', 'partially_resolved_count'] + [
+    f'{name}_{suffix}'
+    for name in METRIC_NAMES + INTERACTION_FIELDS
+    for suffix in ('sum', 'n')
+]
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def rollup_id(kind, key=None):
+    """生成汇总文档ID"""
+    return kind if kind == 'global' else f'{kind}:{key}'
+
+
+def doc_values(doc):
+    """计算单个会话对汇总计数器的贡献
+
+    字段命名与聚合管道的分组结果保持一致（count、resolved_count、satisfaction_sum等），
+    *_n 记录该字段为数值的会话数，用于计算与$avg语义一致的平均值。
+    """
+    summary = doc.get('conversationSummary') or {}
+    status = (summary.get('resolutionStatus') or {}).get('status')
+    values = {
+        'count': 1,
+        'resolved_count': 1 if status == STATUS_RESOLVED else 0,
+        'partially_resolved_count': 1 if status == STATUS_PARTIALLY_RESOLVED else 0
+    }
+
+    metrics = doc.get('metrics') or {}
+    for name in METRIC_NAMES:
+        value = (metrics.get(name) or {}).get('value')
+        if _is_number(value):
+            values[f'{name}_sum'] = value
+            values[f'{name}_n'] = 1
+
+    interaction = doc.get('interactionAnalysis') or {}
+    for name in INTERACTION_FIELDS:
+        value = interaction.get(name)
+        if _is_number(value):
+            values[f'{name}_sum'] = value
+            values[f'{name}_n'] = 1
+
+    return values
+
+
+def doc_keys(doc):
+    """返回会话所属的全部汇总维度 (kind, key)"""
+    keys = [('global', None)]
+    if doc.get('agent') is not None:
+        keys.append(('agent', doc['agent']))
+    for tag in set(doc.get('tags') or []):
+        keys.append(('tag', tag))
+    status = ((doc.get('conversationSummary') or {}).get('resolutionStatus') or {}).get('status')
+    if status is not None:
+        keys.append(('status', status))
+    return keys
+
+
+def compute_deltas(changes, keys_func=doc_keys):
+    """根据会话变更计算各汇总文档的增量
+
+    Args:
+        changes: (before, after) 列表，新建时before为None，删除时after为None
+        keys_func: 返回会话所属汇总键列表的函数
+
+    Returns:
+        {key: {field: increment}}
+    """
+    deltas = {}
+    for before, after in changes:
+        for doc, sign in ((before, -1), (after, 1)):
+            if not doc:
+                continue
+            values = doc_values(doc)
+            for key in keys_func(doc):
+                delta = deltas.setdefault(key, {})
+                for field, value in values.items():
+                    delta[field] = delta.get(field, 0) + sign * value
+
+    # 去除抵消为0的字段，例如只修改了无关字段的更新
+    return {
+        key: {field: value for field, value in delta.items() if value != 0}
+        for key, delta in deltas.items()
+        if any(value != 0 for value in delta.values())
+    }
+
+
+def apply_changes(db, changes):
+    """将会话变更以$inc增量写入汇总集合
+
+    Args:
+        db: 数据库连接
+        changes: (before, after) 列表
+    """
+    deltas = compute_deltas(changes)
+    if not deltas:
+        return
+
+    operations = [
+        UpdateOne(
+            {'_id': rollup_id(kind, key)},
+            {'$inc': delta, '$setOnInsert': {'kind': kind, 'key': key}},
+            upsert=True
+        )
+        for (kind, key), delta in deltas.items()
+    ]
+    db[COLLECTION].bulk_write(operations, ordered=False)
+
+
+def is_built(db):
+    """汇总是否已完成全量构建"""
+    return db[COLLECTION].find_one({'_id': META_ID}, {'_id': 1}) is not None
+
+
+def load(db):
+    """读取全部汇总文档
+
+    Returns:
+        {'global': dict, 'agent': [dict], 'tag': [dict], 'status': [dict]}，
+        汇总尚未构建时返回None
+    """
+    if not is_built(db):
+        return None
+
+    result = {'global': {}, 'agent': [], 'tag': [], 'status': []}
+    for doc in db[COLLECTION].find({'kind': {'$in': KINDS}, 'count': {'$gt': 0}}):
+        if doc['kind'] == 'global':
+            result['global'] = doc
+        else:
+            result[doc['kind']].append(doc)
+    return result
+
+
+def average(row, field):
+    """按 *_sum / *_n 计算平均值，与$avg忽略缺失值的语义一致"""
+    n = row.get(f'{field}_n', 0)
+    return row.get(f'{field}_sum', 0) / n if n > 0 else 0
+
+
+def group_fields():
+    """$group阶段中计算与doc_values相同计数器的累加器"""
+    fields = {
+        'count': {'$sum': 1},
+        'resolved_count': {'$sum': {'$cond': [{'$eq': [STATUS_FIELD, STATUS_RESOLVED]}, 1, 0]}},
+        'partially_resolved_count': {'$sum': {'$cond': [{'$eq': [STATUS_FIELD, STATUS_PARTIALLY_RESOLVED]}, 1, 0]}}
+    }
+    paths = [(name, f'$metrics.{name}.value') for name in METRIC_NAMES]
+    paths += [(name, f'$interactionAnalysis.{name}') for name in INTERACTION_FIELDS]
+    for name, path in paths:
+        fields[f'{name}_sum'] = {'$sum': path}
+        fields[f'{name}_n'] = {'$sum': {'$cond': [{'$isNumber': path}, 1, 0]}}
+    return fields
+
+
+def _compute_expected(db):
+    """从会话集合全量计算汇总文档"""
+    fields = group_fields()
+    pipeline = [{'$facet': {
+        'global': [{'$group': {'_id': None, **fields}}],
+        'agent': [
+            {'$match': {'agent': {'$ne': None}}},
+            {'$group': {'_id': '$agent', **fields}}
+        ],
+        'tag': [
+            {'$addFields': {'_tags': {'$setUnion': [{'$ifNull': ['$tags', []]}, []]}}},
+            {'$unwind': '$_tags'},
+            {'$group': {'_id': '$_tags', **fields}}
+        ],
+        'status': [
+            {'$match': {'conversationSummary.resolutionStatus.status': {'$ne': None}}},
+            {'$group': {'_id': STATUS_FIELD, **fields}}
+        ]
+    }}]
+    result = list(db.conversations.aggregate(pipeline, allowDiskUse=True))
+    facets = result[0] if result else {}
+
+    expected = {}
+    for kind in KINDS:
+        for row in facets.get(kind, []):
+            key = row.pop('_id')
+            values = {field: value for field, value in row.items() if value != 0}
+            expected[rollup_id(kind, key)] = {'kind': kind, 'key': key, **values}
+    return expected
+
+
+def diff_documents(expected, actual, ignore):
+    """比较重算结果与现有文档的计数字段
+
+    Args:
+        expected: {文档ID: 重算的文档}
+        actual: {文档ID: 现有文档}
+        ignore: 不参与比较的非计数字段
+
+    Returns:
+        (偏差明细列表, 存在偏差的文档ID集合)
+    """
+    drift = []
+    drifted_ids = set()
+    for doc_id in set(expected) | set(actual):
+        expected_doc = expected.get(doc_id, {})
+        actual_doc = actual.get(doc_id, {})
+        fields = (set(expected_doc) | set(actual_doc)) - ignore
+        for field in sorted(fields):
+            expected_value = expected_doc.get(field, 0)
+            actual_value = actual_doc.get(field, 0)
+            if abs(expected_value - actual_value) > 1e-9:
+                drift.append({
+                    'id': doc_id,
+                    'field': field,
+                    'expected': expected_value,
+                    'actual': actual_value
+                })
+                drifted_ids.add(doc_id)
+    return drift, drifted_ids
+
+
+def rebuild(db, dry_run=False, cancel=None):
+    """从会话集合全量重算汇总，并报告与现有汇总的偏差
+
+    Args:
+        db: 数据库连接
+        dry_run: 为True时只报告偏差，不写入
+        cancel: 取消标记（threading.Event），置位后不再写入，返回的cancelled为True
+
+    Returns:
+        {'documents': int, 'drifted': int, 'drift': [{'id', 'field', 'expected', 'actual'}], 'cancelled': bool}
+    """
+    expected = _compute_expected(db)
+    actual = {
+        doc['_id']: doc
+        for doc in db[COLLECTION].find({'kind': {'$in': KINDS}})
+    }
+
+    drift, drifted_ids = diff_documents(expected, actual, ignore={'_id', 'kind', 'key'})
+
+    cancelled = cancel is not None and cancel.is_set()
+    if cancelled:
+        logger.warning("汇总重建已取消，未写入")
+    elif not dry_run:
+        operations = [
+            ReplaceOne({'_id': doc_id}, doc, upsert=True)
+            for doc_id, doc in expected.items()
+        ]
+        if operations:
+            db[COLLECTION].bulk_write(operations, ordered=False)
+        stale_ids = [doc_id for doc_id in actual if doc_id not in expected]
+        if stale_ids:
+            db[COLLECTION].delete_many({'_id': {'$in': stale_ids}})
+        db[COLLECTION].replace_one(
+            {'_id': META_ID},
+            {'kind': 'meta', 'builtAt': datetime.now().strftime("%Y-%m-%d %H:%M:%S")},
+            upsert=True
+        )
+        logger.info(f"汇总已重建: {len(expected)} 个文档，{len(drifted_ids)} 个存在偏差")
+
+    return {
+        'documents': len(expected),
+        'drifted': len(drifted_ids),
+        'drift': drift,
+        'cancelled': cancelled
+    }
@@ -0,0 +1,234 @@
+"""
+客服会话导出解析模块
+流式读取客服系统导出的Excel工作簿，将会话详情内容拆分为结构化消息并批量写入会话集合
+
+工作簿以只读模式逐行读取，每chunk_size行交给一个工作进程解析；同时在途的分块数有上限，
+主进程按提交顺序取回结果并写入，峰值内存只与分块大小和在途分块数有关，与工作表行数无关。
+"""
+import logging
+import os
+import re
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from .search import search_fields, SEARCH_FIELD
+from .sourcehash import source_hash, SOURCE_HASH_FIELD
+from .interaction import interaction_metrics, INTERACTION_FIELD
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 导出文件的列名
+ID_COLUMN = '会话ID'
+ISSUE_COLUMN = '问题类型'
+CONTENT_COLUMN = '会话详情内容'
+
+# 消息头：发送者 + 空格 + 发送时间，独占一行且位于段落开头
+HEADER_PATTERN = re.compile(r'^(?P<sender>[^\s，。：,]{1,30}(?: [^\s，。：,]{1,30})?) (?P<time>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})$')
+
+# 导出时客户被匿名为"省/市MMDD-NNNN"，以编号结尾的发送者视为客户，其余为客服
+CUSTOMER_PATTERN = re.compile(r'\d{4}-\d{4}$')
+
+# 报告中保留的错误明细条数，避免大量错误行占用内存
+MAX_REPORTED_ERRORS = 100
+
+
+def normalize_text(text):
+    """去掉Excel转义的回车符并统一换行"""
+    return text.replace('_x000D_', '').replace('\r\n', '\n').replace('\r', '\n')
+
+
+def parse_messages(text):
+    """将会话详情内容拆分为消息列表
+
+    内容按空行分段，以消息头开头的段落开始一条新消息，其余段落并入上一条消息。
+
+    Returns:
+        [{'type', 'content', 'time', 'sender'}]，type为user或agent
+    """
+    messages = []
+    for block in re.split(r'\n\s*\n', normalize_text(text)):
+        lines = block.strip('\n').split('\n')
+        if not lines or not lines[0].strip():
+            continue
+        match = HEADER_PATTERN.match(lines[0].strip())
+        if match is None:
+            if messages:
+                messages[-1]['content'] = f"{messages[-1]['content']}\n\n{block.strip()}".strip()
+            continue
+        sender = match.group('sender')
+        messages.append({
+            'type': 'user' if CUSTOMER_PATTERN.search(sender) else 'agent',
+            'content': '\n'.join(lines[1:]).strip(),
+            'time': match.group('time'),
+            'sender': sender
+        })
+
+    # 少数客户没有匿名编号，会话中有多个发送者且都没有编号时，视第一个发言者为客户
+    if messages and not any(message['type'] == 'user' for message in messages):
+        first = messages[0]['sender']
+        if any(message['sender'] != first for message in messages):
+            for message in messages:
+                if message['sender'] == first:
+                    message['type'] = 'user'
+    return messages
+
+
+def build_conversation(conversation_id, issue, text):
+    """由导出的一行生成会话文档
+
+    agent取发言最多的客服，customerInfo.userId取客户的匿名编号，会话时间取第一条消息时间。
+    原始内容保存在origin_conversation中，供后续模型分析使用。
+    """
+    messages = parse_messages(text)
+    agents = Counter(message['sender'] for message in messages if message['type'] == 'agent')
+    customer = next((message['sender'] for message in messages if message['type'] == 'user'), '')
+
+    doc = {
+        'id': conversation_id,
+        'time': messages[0]['time'] if messages else '',
+        'agent': agents.most_common(1)[0][0] if agents else '',
+        'customerInfo': {'userId': customer},
+        'conversationSummary': {'mainIssue': issue or ''},
+        'messages': messages,
+        INTERACTION_FIELD: interaction_metrics(messages),
+        'origin_conversation': text
+    }
+    # 与ingest.prepare相同，在工作进程中生成源内容哈希和检索词，主进程只负责写入
+    doc[SOURCE_HASH_FIELD] = source_hash(doc)
+    doc[SEARCH_FIELD] = search_fields(doc)
+    return doc
+
+
+def parse_rows(rows):
+    """工作进程入口：解析一个分块
+
+    Args:
+        rows: [(行号, 会话ID, 问题类型, 会话详情内容)]
+
+    Returns:
+        (会话列表, 错误列表)，错误为 {'row', 'id', 'error'}
+    """
+    docs = []
+    errors = []
+    for row_number, conversation_id, issue, text in rows:
+        if not conversation_id or not text:
+            errors.append({'row': row_number, 'id': conversation_id, 'error': "缺少会话ID或会话详情内容"})
+            continue
+        try:
+            doc = build_conversation(str(conversation_id), issue, str(text))
+        except Exception as e:
+            errors.append({'row': row_number, 'id': conversation_id, 'error': str(e)})
+            continue
+        if not doc['messages']:
+            errors.append({'row': row_number, 'id': conversation_id, 'error': "会话详情内容中没有可识别的消息"})
+            continue
+        docs.append(doc)
+    return docs, errors
+
+
+def iter_chunks(path, sheet=None, chunk_size=500):
+    """以只读模式逐行读取工作簿，按chunk_size行分块
+
+    Yields:
+        [(行号, 会话ID, 问题类型, 会话详情内容)]
+    """
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise RuntimeError("读取Excel需要安装openpyxl: pip install openpyxl")
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        worksheet = workbook[sheet] if sheet else workbook.worksheets[0]
+        rows = worksheet.iter_rows(values_only=True)
+        header = [str(value).strip() if value is not None else '' for value in next(rows, ())]
+        for column in (ID_COLUMN, CONTENT_COLUMN):
+            if column not in header:
+                raise ValueError(f"工作表缺少列: {column}")
+        id_index = header.index(ID_COLUMN)
+        content_index = header.index(CONTENT_COLUMN)
+        issue_index = header.index(ISSUE_COLUMN) if ISSUE_COLUMN in header else None
+
+        def cell(row, index):
+            return row[index] if index is not None and index < len(row) else None
+
+        chunk = []
+        for row_number, row in enumerate(rows, start=2):
+            if not any(value is not None for value in row):
+                continue
+            chunk.append((row_number, cell(row, id_index), cell(row, issue_index), cell(row, content_index)))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+    finally:
+        workbook.close()
+
+
+def ingest_workbook(db, path, sheet=None, chunk_size=500, workers=None, max_in_flight=None,
+                    replace=False, apply_stats=True, progress=None):
+    """并行解析工作簿并批量写入会话集合
+
+    Args:
+        db: 数据库对象
+        path: 工作簿路径
+        sheet: 工作表名称，默认第一个工作表
+        chunk_size: 每个分块的行数，也是每批写入的会话数
+        workers: 工作进程数，默认CPU核数
+        max_in_flight: 同时在途的分块数上限，默认工作进程数的2倍
+        replace: 更新源内容有变化的已有会话；默认跳过全部已有会话，以免覆盖已分析的结果
+        apply_stats: 是否同步派生统计
+        progress: 每写入一个分块后调用，参数为当前统计
+
+    Returns:
+        {'rows', 'inserted', 'updated', 'skipped', 'duplicate', 'error', 'errors'}，
+        errors最多保留MAX_REPORTED_ERRORS条明细
+    """
+    from . import ingest
+
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or workers * 2
+    report = {'rows': 0, **ingest.summarize([]), 'errors': []}
+
+    def record_errors(errors):
+        report['errors'].extend(errors[:MAX_REPORTED_ERRORS - len(report['errors'])])
+
+    def write(docs, errors):
+        report['rows'] += len(docs) + len(errors)
+        report['error'] += len(errors)
+        record_errors(errors)
+        if not docs:
+            return
+        if replace:
+            results = ingest.upsert_batch(db, docs, apply_stats=apply_stats)
+        else:
+            # 已存在的会话可能已经过模型分析，默认跳过而不是覆盖
+            existing = {
+                doc['id'] for doc in db.conversations.find({'id': {'$in': [doc['id'] for doc in docs]}}, {'id': 1})
+            }
+            report['skipped'] += sum(1 for doc in docs if doc['id'] in existing)
+            docs = [doc for doc in docs if doc['id'] not in existing]
+            results = ingest.insert_batch(db, docs, apply_stats=apply_stats) if docs else []
+        for status, count in ingest.summarize(results).items():
+            report[status] += count
+        record_errors([
+            {'row': None, 'id': result['id'], 'error': result['error']}
+            for result in results if result['status'] == 'error'
+        ])
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # 按提交顺序取回结果，在途分块达到上限时先写入最早的分块，读取随之暂停
+        pending = deque()
+        for chunk in iter_chunks(path, sheet, chunk_size):
+            pending.append(executor.submit(parse_rows, chunk))
+            if len(pending) >= max_in_flight:
+                write(*pending.popleft().result())
+                if progress:
+                    progress(report)
+        while pending:
+            write(*pending.popleft().result())
+            if progress:
+                progress(report)
+
+    return report
@@ -0,0 +1,243 @@
+"""
+合并提交模块
+将单条会话创建请求放入进程内队列，由后台线程按数量或时间攒批后一次写入
+
+请求线程在所属批次写入确认后才返回，语义与逐条插入一致；队列有上限，
+数据库处理不过来时新请求在入队处等待，超时后拒绝，以此形成背压。
+等待确认超时的请求仍留在队列中，之后可能写入成功，调用方不应视为失败。
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from . import ingest
+from .database import get_client
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 进程级共享的合并提交器，按PID区分以保证fork安全
+_committer = None
+_committer_pid = None
+_committer_lock = threading.Lock()
+
+
+class QueueFull(Exception):
+    """写入队列已满，在等待时间内未能入队"""
+
+
+class PendingWrite:
+    """等待合并提交的单条写入"""
+
+    __slots__ = ('doc', 'enqueued', 'result', 'done')
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.enqueued = time.perf_counter()
+        self.result = None
+        self.done = threading.Event()
+
+
+class GroupCommitter:
+    """合并提交器：后台线程从队列取出写入，攒满batch_size条或等待max_delay秒后批量插入"""
+
+    # 后台线程在队列为空时检查停止标记的间隔（秒）
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, db, batch_size=500, max_delay=0.05, queue_size=10000):
+        self.db = db
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self.reset_metrics()
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def reset_metrics(self):
+        with self._lock:
+            self.batches = 0
+            self.documents = 0
+            self.failed_documents = 0
+            self.failed_batches = 0
+            self.rejected = 0
+            self.last_batch_size = 0
+            self.max_batch_size = 0
+            self.last_flush_ms = 0.0
+            self.total_flush_ms = 0.0
+            self.max_flush_ms = 0.0
+            self.total_ack_ms = 0.0
+            self.max_ack_ms = 0.0
+
+    def submit(self, doc, timeout=None, wait=None):
+        """提交一条已校验并预处理的会话，等待所属批次写入确认
+
+        Args:
+            doc: prepare处理后的会话
+            timeout: 队列已满时等待入队的秒数
+            wait: 入队后等待写入确认的秒数，None表示一直等待
+
+        Returns:
+            {'id', 'status', 'error'}，status为inserted或error
+
+        Raises:
+            QueueFull: 等待timeout秒后仍无法入队
+            TimeoutError: 等待wait秒后批次仍未写入确认，会话仍在队列中，之后可能写入
+        """
+        pending = PendingWrite(doc)
+        try:
+            self.queue.put(pending, timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise QueueFull(f"写入队列已满（{self.queue.maxsize}），请稍后重试")
+        if not pending.done.wait(wait):
+            raise TimeoutError("等待批量写入确认超时")
+        return pending.result
+
+    def stop(self, timeout=10):
+        """写入队列中剩余的会话并停止后台线程，最多等待timeout秒
+
+        队列已满时无法放入结束标记，后台线程写完队列后根据停止标记退出；
+        超时后不再等待，未写入的会话随进程退出丢弃。
+        """
+        self._stopping.set()
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            logger.warning("写入队列已满，未能放入结束标记，等待后台线程写完队列")
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning(f"合并提交线程未在 {timeout}s 内结束，队列中剩余约 {self.queue.qsize()} 条会话未写入")
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                first = self.queue.get(timeout=self.POLL_INTERVAL)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    break
+                continue
+            if first is None:
+                break
+
+            # 从第一条开始计时，攒满batch_size条或等待max_delay秒后提交
+            batch = [first]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    pending = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if pending is None:
+                    stopping = True
+                    break
+                batch.append(pending)
+
+            self._commit(batch)
+
+    def _commit(self, batch):
+        started = time.perf_counter()
+        failed_batch = False
+        try:
+            # 派生统计的错误由stats.apply_changes逐个记录，这里的异常只来自插入本身
+            results = ingest.insert_batch(self.db, [pending.doc for pending in batch])
+        except Exception as e:
+            logger.error(f"批量写入会话失败: {str(e)}")
+            failed_batch = True
+            results = [
+                {'id': pending.doc.get('id'), 'status': 'error', 'error': f"批量写入失败: {str(e)}"}
+                for pending in batch
+            ]
+        finished = time.perf_counter()
+
+        flush_ms = (finished - started) * 1000
+        ack_ms = [(finished - pending.enqueued) * 1000 for pending in batch]
+        with self._lock:
+            self.batches += 1
+            self.documents += len(batch)
+            self.failed_documents += sum(1 for result in results if result['status'] != 'inserted')
+            self.failed_batches += 1 if failed_batch else 0
+            self.last_batch_size = len(batch)
+            self.max_batch_size = max(self.max_batch_size, len(batch))
+            self.last_flush_ms = flush_ms
+            self.total_flush_ms += flush_ms
+            self.max_flush_ms = max(self.max_flush_ms, flush_ms)
+            self.total_ack_ms += sum(ack_ms)
+            self.max_ack_ms = max(self.max_ack_ms, max(ack_ms))
+
+        for pending, result in zip(batch, results):
+            pending.result = result
+            pending.done.set()
+
+    def snapshot(self):
+        """返回队列深度、批次大小和写入延迟统计"""
+        with self._lock:
+            batches = self.batches
+            return {
+                'batchSize': self.batch_size,
+                'maxDelayMs': self.max_delay * 1000,
+                'queueDepth': self.queue.qsize(),
+                'queueCapacity': self.queue.maxsize,
+                'batches': batches,
+                'documents': self.documents,
+                'failedDocuments': self.failed_documents,
+                'failedBatches': self.failed_batches,
+                'rejected': self.rejected,
+                'lastBatchSize': self.last_batch_size,
+                'avgBatchSize': self.documents / batches if batches > 0 else 0,
+                'maxBatchSize': self.max_batch_size,
+                'lastFlushMs': self.last_flush_ms,
+                'avgFlushMs': self.total_flush_ms / batches if batches > 0 else 0,
+                'maxFlushMs': self.max_flush_ms,
+                'avgAckMs': self.total_ack_ms / self.documents if self.documents > 0 else 0,
+                'maxAckMs': self.max_ack_ms
+            }
+
+
+def get_committer(config):
+    """获取进程级共享的合并提交器，首次调用或fork后创建
+
+    Args:
+        config: 应用配置映射
+    """
+    global _committer, _committer_pid
+
+    pid = os.getpid()
+    if _committer is not None and _committer_pid == pid:
+        return _committer
+
+    with _committer_lock:
+        if _committer is None or _committer_pid != pid:
+            db = get_client(config)[config['DB_NAME']]
+            _committer = GroupCommitter(
+                db,
+                batch_size=config.get('WRITE_BEHIND_BATCH_SIZE', 500),
+                max_delay=config.get('WRITE_BEHIND_MAX_DELAY_MS', 50) / 1000,
+                queue_size=config.get('WRITE_BEHIND_QUEUE_SIZE', 10000)
+            )
+            _committer_pid = pid
+            logger.info(f"已启用合并提交: 每批最多 {_committer.batch_size} 条，最长等待 {_committer.max_delay * 1000:.0f}ms")
+    return _committer
+
+
+def get_metrics():
+    """获取合并提交统计，未启用时返回None"""
+    if _committer is None or _committer_pid != os.getpid():
+        return None
+    return _committer.snapshot()
+
+
+def stop_committer():
+    """进程退出时写入队列中剩余的会话"""
+    with _committer_lock:
+        if _committer is not None and _committer_pid == os.getpid():
+            _committer.stop()
+
+
+atexit.register(stop_committer)
@@ -1,9 +1,27 @@
+"""
+ConvoInsight数据导入工具
+
+流式读取会话数据文件，按批upsert到conversations集合，支持断点续传。
+
+用法:
+    python import_data.py [文件路径] [--batch-size N] [--checkpoint 路径] [--restart] [--no-stats]
+    python import_data.py --self-check
+
+文件可以是会话JSON数组，也可以是NDJSON（每行一个会话，或连续排列的多个JSON对象）。
+解析按块增量进行，内存占用与文件大小无关。每批写入成功后记录已处理到的字节偏移，
+中断后再次运行会从检查点继续；写入按会话ID upsert，源内容哈希未变化的会话直接跳过，
+重复导入同一文件只写入有变化的会话。NDJSON中无法解析的行会被跳过并报告字节偏移，不中断导入。
+"""
+import argparse
+import codecs
+import io
 import json
 import os
-import re
+import sys
+import time
 from pymongo import MongoClient
 from pymongo.errors import ConnectionFailure
-from dotenv import load_dotenv
+from app.config import Config
 
 # ANSI颜色代码
 class Colors:
@@ -32,18 +50,21 @@ def print_warning(message):
 def print_error(message):
     print(f"{Colors.FAIL}❌ {message}{Colors.ENDC}")
 
+# 每次从文件读取的字节数
+CHUNK_SIZE = 1 << 20
+
+# JSON空白字符
+WHITESPACE = ' \t\r\n'
+
+# 单条记录的最大字符数，超过时不再为其继续读取，避免缓冲区随文件增长
+MAX_RECORD_SIZE = 64 << 20
+
 def get_db_connection():
-    """从.env文件加载配置并连接到MongoDB"""
-    load_dotenv()
-    
-    uri = os.getenv("MONGO_URI")
-    db_name = os.getenv("DB_NAME")
-
-    if not uri or not db_name:
-        print_error("无法从.env文件加载数据库配置。请先运行 `python run.py` 来生成配置。")
-        return None, None
+    """按应用配置（.env中的MONGODB_URI和DB_NAME）连接到MongoDB"""
+    uri = Config.MONGODB_URI
+    db_name = Config.DB_NAME
 
-    print_info(f"从.env文件加载配置: DB_NAME={db_name}")
+    print_info(f"从配置加载数据库: DB_NAME={db_name}")
 
     try:
         client = MongoClient(uri)
@@ -54,58 +75,349 @@ def get_db_connection():
         print_error(f"无法连接到MongoDB: {e}")
         return None, None
 
-def import_conversation_details(db, file_path):
-    """导入会话详情数据"""
-    print_info("正在导入会话详情数据...")
+def detect_format(file_path):
+    """根据第一个非空白字符判断文件格式：[ 为JSON数组，否则为NDJSON"""
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(4096)
+            if not chunk:
+                return 'ndjson'
+            text = chunk.decode('utf-8-sig', errors='ignore').lstrip(WHITESPACE)
+            if text:
+                return 'array' if text[0] == '[' else 'ndjson'
+
+def iter_documents(f, fmt, offset=0, chunk_size=CHUNK_SIZE, max_record_size=MAX_RECORD_SIZE, on_error=None):
+    """从字节偏移offset开始增量解析会话
+
+    解析失败时，若出错位置之后已经读到换行，说明记录本身有误（JSON字符串不能包含未转义的换行），
+    否则视为记录尚未读完，继续读取，直到单条记录超过max_record_size个字符。
+    NDJSON跳到下一个换行处重新同步，JSON数组无法重新同步，直接抛出错误。
+
+    Args:
+        f: 以二进制模式打开的文件
+        fmt: 'array' 或 'ndjson'
+        offset: 起始字节偏移，0或之前返回的偏移
+        chunk_size: 每次读取的字节数
+        max_record_size: 单条记录的最大字符数
+        on_error: NDJSON中跳过的记录通过 on_error(字节偏移, 错误信息) 报告，未指定时抛出错误
+
+    Yields:
+        (会话, 该会话结束处的字节偏移)
+
+    Raises:
+        ValueError: JSON数组格式错误或记录过大，或NDJSON记录有误且未指定on_error
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    separators = WHITESPACE + (',' if fmt == 'array' else '')
+    f.seek(offset)
+
+    buffer = ''
+    index = 0            # 下一个待解析字符在buffer中的位置
+    known_chars = 0      # buffer中已换算为字节偏移的字符数
+    known_bytes = offset # buffer[:known_chars] 结束处的字节偏移
+    opened = fmt != 'array' or offset > 0
+    eof = False
+
+    def fill():
+        nonlocal buffer, index, known_chars, eof
+        # 丢弃已换算过偏移的部分，只保留未解析的尾部
+        buffer = buffer[known_chars:]
+        index -= known_chars
+        known_chars = 0
+        chunk = f.read(chunk_size)
+        if chunk:
+            buffer += text_decoder.decode(chunk)
+        else:
+            buffer += text_decoder.decode(b'', final=True)
+            eof = True
+
+    def advance(position):
+        nonlocal index, known_chars, known_bytes
+        known_bytes += len(buffer[known_chars:position].encode('utf-8'))
+        known_chars = position
+        index = position
+
+    def skip_line(position):
+        # 丢弃到position之后的第一个换行为止，期间读取的内容不再保留
+        while True:
+            newline = buffer.find('\n', position)
+            if newline != -1:
+                advance(newline + 1)
+                return
+            advance(len(buffer))
+            if eof:
+                return
+            fill()
+            position = index
+
+    while True:
+        # 跳过空白和数组元素之间的逗号
+        while True:
+            while index < len(buffer) and buffer[index] in separators:
+                index += 1
+            if index < len(buffer) or eof:
+                break
+            fill()
+        if index >= len(buffer):
+            return
+
+        char = buffer[index]
+        if char == '\ufeff' and known_bytes == 0:
+            index += 1
+            continue
+        if not opened:
+            if char != '[':
+                raise ValueError(f"JSON数组应以 [ 开头，实际为 {char!r}")
+            opened = True
+            index += 1
+            continue
+        if fmt == 'array' and char == ']':
+            return
+
+        try:
+            doc, end = decoder.raw_decode(buffer, index)
+        except json.JSONDecodeError as e:
+            malformed = eof or buffer.find('\n', e.pos) != -1
+            oversized = not malformed and len(buffer) - index > max_record_size
+            if not malformed and not oversized:
+                fill()
+                continue
+            start = known_bytes + len(buffer[known_chars:index].encode('utf-8'))
+            if oversized:
+                message = f"字节偏移 {start} 处的记录超过 {max_record_size} 个字符"
+            else:
+                message = f"字节偏移 {start} 处的记录无法解析: {e.msg}"
+            if fmt != 'ndjson' or on_error is None:
+                raise ValueError(message)
+            on_error(start, message)
+            skip_line(e.pos if malformed else index)
+            continue
+
+        known_bytes += len(buffer[known_chars:end].encode('utf-8'))
+        known_chars = end
+        index = end
+        yield doc, known_bytes
+
+def self_check():
+    """用构造的数据校验iter_documents：各种读取块大小、BOM、多字节字符、从任意返回的偏移续传、错误行重新同步
+
+    Returns:
+        失败的检查项列表，全部通过时为空
+    """
+    docs = [{'id': '1', 'text': '中文, ] } 逗号'}, {'id': '2', 'nested': {'list': [1, 2, {'s': '[{'}]}}, {'id': '3'}]
+    samples = {
+        'array': ('\ufeff[\n  ' + ',\n  '.join(json.dumps(doc, ensure_ascii=False) for doc in docs) + '\n]\n', docs),
+        'ndjson': ('\n'.join(json.dumps(doc, ensure_ascii=False, indent=1 if i == 1 else None)
+                             for i, doc in enumerate(docs)) + '\n', docs),
+        'ndjson-concat': (''.join(json.dumps(doc, ensure_ascii=False) for doc in docs), docs)
+    }
+    failures = []
+
+    def parse(data, fmt, offset=0, chunk_size=CHUNK_SIZE, **options):
+        return list(iter_documents(io.BytesIO(data), fmt, offset, chunk_size, **options))
+
+    for name, (text, expected) in samples.items():
+        data = text.encode('utf-8')
+        fmt = 'array' if name == 'array' else 'ndjson'
+        for chunk_size in range(1, 65):
+            results = parse(data, fmt, chunk_size=chunk_size)
+            if [doc for doc, _ in results] != expected:
+                failures.append(f"{name} 块大小 {chunk_size}: 解析结果不一致")
+                continue
+            # 从每个返回的偏移续传，应得到其后的全部会话
+            for position, (_, offset) in enumerate(results):
+                resumed = [doc for doc, _ in parse(data, fmt, offset, chunk_size)]
+                if resumed != expected[position + 1:]:
+                    failures.append(f"{name} 块大小 {chunk_size}: 从偏移 {offset} 续传结果不一致")
+
+    # NDJSON中的错误行：报告其字节偏移并从下一行继续
+    lines = [json.dumps(docs[0], ensure_ascii=False), '{bad}', json.dumps(docs[2])]
+    data = ('\n'.join(lines) + '\n').encode('utf-8')
+    bad_offset = len((lines[0] + '\n').encode('utf-8'))
+    for chunk_size in (1, 7, 64, CHUNK_SIZE):
+        errors = []
+        results = parse(data, 'ndjson', chunk_size=chunk_size, on_error=lambda offset, message: errors.append(offset))
+        if [doc for doc, _ in results] != [docs[0], docs[2]] or errors != [bad_offset]:
+            failures.append(f"错误行 块大小 {chunk_size}: 未跳过错误行或偏移不正确 {errors}")
+
+    # 超过单条记录上限时不再继续读取
+    data = ('{"id": "' + 'x' * 1000 + '"}\n' + json.dumps(docs[2]) + '\n').encode('utf-8')
+    errors = []
+    results = parse(data, 'ndjson', chunk_size=16, max_record_size=100, on_error=lambda offset, message: errors.append(offset))
+    if [doc for doc, _ in results] != [docs[2]] or errors != [0]:
+        failures.append("记录过大: 未按上限跳过")
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        collection = db['conversation_details']
-        # 确保每次导入前清空旧数据，避免重复
-        collection.delete_many({})
-        result = collection.insert_one(data)
-        print_success(f"成功导入会话详情 (文档ID: {result.inserted_id})")
-        return True
-    except FileNotFoundError:
-        print_error(f"文件未找到: {file_path}")
-        return False
-    except Exception as e:
-        print_error(f"导入会话详情时发生错误: {e}")
-        return False
+        parse(('[' + data.decode('utf-8').replace('\n', ',', 1)).encode('utf-8'), 'array', chunk_size=16, max_record_size=100)
+        failures.append("记录过大: JSON数组未报错")
+    except ValueError:
+        pass
+
+    return failures
+
+def load_checkpoint(checkpoint_path, file_path):
+    """读取检查点，文件与检查点记录不一致时返回None"""
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path, 'r', encoding='utf-8') as f:
+        checkpoint = json.load(f)
+    if checkpoint.get('file') != os.path.abspath(file_path) or checkpoint.get('size') != os.path.getsize(file_path):
+        print_warning("检查点与当前文件不一致（路径或大小不同），将从头导入")
+        return None
+    return checkpoint
+
+def save_checkpoint(checkpoint_path, checkpoint):
+    """原子地写入检查点，避免中断时留下不完整的文件"""
+    temp_path = checkpoint_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f, ensure_ascii=False)
+    os.replace(temp_path, checkpoint_path)
+
+def import_conversations(db, file_path, batch_size=1000, checkpoint_path=None, restart=False, apply_stats=True):
+    """流式导入会话数据
+
+    Args:
+        db: 数据库对象
+        file_path: 数据文件路径
+        batch_size: 每批写入的会话数
+        checkpoint_path: 检查点文件路径，默认为数据文件路径加 .checkpoint
+        restart: 忽略已有检查点，从头导入
+        apply_stats: 是否同步派生统计
+
+    Returns:
+        导入统计，与检查点内容相同
+    """
+    from app import ingest
+
+    checkpoint_path = checkpoint_path or file_path + '.checkpoint'
+    checkpoint = None if restart else load_checkpoint(checkpoint_path, file_path)
+    if checkpoint:
+        print_info(f"从检查点继续: 已处理 {checkpoint['documents']} 条，字节偏移 {checkpoint['offset']}")
+    else:
+        checkpoint = {
+            'file': os.path.abspath(file_path),
+            'size': os.path.getsize(file_path),
+            'format': detect_format(file_path),
+            'offset': 0,
+            'documents': 0,
+            **{status: 0 for status in ingest.summarize([])}
+        }
+        print_info(f"文件格式: {checkpoint['format']}，大小: {checkpoint['size'] / 1024 / 1024:.1f} MB")
+
+    started = time.perf_counter()
+    imported = 0
+
+    def skip(offset, message):
+        checkpoint['error'] += 1
+        print_warning(f"{message}，已跳过该行")
+
+    def flush(batch, offset):
+        nonlocal imported
+        results = ingest.upsert_batch(db, batch, offset=checkpoint['documents'], apply_stats=apply_stats)
+        for status, count in ingest.summarize(results).items():
+            checkpoint[status] += count
+        for result in results:
+            if result['status'] == 'error':
+                print_warning(f"第 {result['index'] + 1} 条会话 {result['id'] or ''} 写入失败: {result['error']}")
+        checkpoint['documents'] += len(batch)
+        checkpoint['offset'] = offset
+        save_checkpoint(checkpoint_path, checkpoint)
+
+        imported += len(batch)
+        elapsed = time.perf_counter() - started
+        percent = offset / checkpoint['size'] * 100 if checkpoint['size'] else 100
+        print_info(
+            f"已处理 {checkpoint['documents']} 条 ({percent:.1f}%)，"
+            f"本次 {imported / elapsed if elapsed > 0 else 0:.0f} 条/秒"
+        )
+
+    with open(file_path, 'rb') as f:
+        batch = []
+        offset = checkpoint['offset']
+        for doc, offset in iter_documents(f, checkpoint['format'], checkpoint['offset'], on_error=skip):
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                flush(batch, offset)
+                batch = []
+        if batch:
+            flush(batch, offset)
+
+    # 导入完成后删除检查点
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    elapsed = time.perf_counter() - started
+    checkpoint['elapsed'] = elapsed
+    checkpoint['docsPerSecond'] = imported / elapsed if elapsed > 0 else 0
+    return checkpoint
 
 def main():
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='ConvoInsight数据导入工具')
+    parser.add_argument('file', nargs='?', default=os.path.join(base_dir, 'conversation_detail.json'),
+                        help='会话JSON数组或NDJSON文件，默认为 conversation_detail.json')
+    parser.add_argument('--batch-size', type=int, default=Config.INGEST_BATCH_SIZE,
+                        help=f'每批写入的会话数，默认{Config.INGEST_BATCH_SIZE}')
+    parser.add_argument('--checkpoint', help='检查点文件路径，默认为数据文件路径加 .checkpoint')
+    parser.add_argument('--restart', action='store_true', help='忽略已有检查点，从头导入')
+    parser.add_argument('--no-stats', action='store_true',
+                        help='导入时不同步派生统计，导入后需运行 manage.py 的 rebuild-* 命令')
+    parser.add_argument('--self-check', action='store_true', help='校验流式解析器后退出，不连接数据库')
+    args = parser.parse_args()
+
+    if args.self_check:
+        failures = self_check()
+        for failure in failures:
+            print_error(failure)
+        if failures:
+            sys.exit(1)
+        print_success("流式解析器自检通过")
+        return
+
     print_header("========================")
     print_header("  ConvoInsight数据导入工具  ")
     print_header("========================\n")
 
+    # 检查文件是否存在
+    if not os.path.exists(args.file):
+        print_error(f"数据文件未找到: {args.file}")
+        sys.exit(1)
+
     client, db_name = get_db_connection()
     if not client or not db_name:
-        return
+        sys.exit(1)
 
     db = client[db_name]
-    
-    # 定义数据文件路径
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    conversation_detail_file = os.path.join(base_dir, 'conversation_detail.json')
-
-    # 检查文件是否存在
-    if not os.path.exists(conversation_detail_file):
-        print_error(f"数据文件 'conversation_detail.json' 未在目录下找到: {base_dir}")
-        client.close()
-        return
-
     print_info(f"使用数据库: {Colors.BOLD}{db_name}{Colors.ENDC}")
 
     # 导入数据
-    success = import_conversation_details(db, conversation_detail_file)
+    try:
+        summary = import_conversations(
+            db, args.file,
+            batch_size=args.batch_size,
+            checkpoint_path=args.checkpoint,
+            restart=args.restart,
+            apply_stats=not args.no_stats
+        )
+    except Exception as e:
+        print_error(f"导入过程中发生错误: {e}")
+        print_info("已写入的批次记录在检查点中，修复问题后重新运行即可继续导入")
+        client.close()
+        sys.exit(1)
 
-    if success:
-        print_header("\n数据导入摘要:")
-        print_success("所有数据已成功导入!")
+    print_header("\n数据导入摘要:")
+    print_info(
+        f"共 {summary['documents']} 条: 新增 {summary['inserted']}，更新 {summary['updated']}，"
+        f"跳过 {summary['skipped']}，重复 {summary['duplicate']}，失败 {summary['error']}"
+    )
+    print_info(f"耗时 {summary['elapsed']:.1f}s，{summary['docsPerSecond']:.0f} 条/秒")
+    if summary['error']:
+        print_warning("部分会话写入失败，请检查以上日志")
     else:
-        print_header("\n数据导入摘要:")
-        print_error("数据导入过程中发生错误，请检查以上日志。")
+        print_success("所有数据已成功导入!")
+    if args.no_stats:
+        print_warning("导入时未同步派生统计，请运行 manage.py 的 rebuild-rollups、rebuild-cube、"
+                      "rebuild-cooccurrence、rebuild-hotwords 命令")
 
     # 关闭连接
     client.close()
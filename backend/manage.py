@@ -0,0 +1,428 @@
+"""
+ConvoInsight管理命令
+
+用法:
+    python manage.py rebuild-rollups [--dry-run]
+    python manage.py rebuild-cube [--dry-run]
+    python manage.py rebuild-cooccurrence [--dry-run]
+    python manage.py rebuild-hotwords [--dry-run]
+    python manage.py ensure-indexes
+    python manage.py advise-indexes [--max-ratio N] [--limit N]
+    python manage.py reindex-search [--missing-only] [--batch-size N]
+    python manage.py derive-interactions [--missing-only] [--batch-size N] [--workers N] [--max-in-flight N] [--no-stats]
+    python manage.py ingest-excel 文件路径 [--sheet 名称] [--chunk-size N] [--workers N] [--max-in-flight N] [--replace] [--no-stats]
+    python manage.py enqueue 任务类型 [--params JSON] [--priority N] [--max-attempts N] [--delay 秒]
+    python manage.py worker [--types 类型,...] [--max-jobs N] [--lease 秒] [--poll 秒]
+    python manage.py enrich [--limit N] [--concurrency N] [--rate N] [--burst N] [--batch-size N] [--model 名称] [--client 客户端] [--base-url 地址] [--retry-failed] [--reprocess] [--no-cache]
+    python manage.py llm-cache-stats
+    python manage.py compact-llm-cache [--older-than 天数] [--dry-run]
+    python manage.py backfill-llm-usage [--model 名称]
+"""
+import argparse
+import json
+import signal
+import time
+from app import create_app
+from app.database import get_db
+from app.stats import rollups, cube, cooccurrence, hotwords
+from app import indexes, search, transcripts, enrichment, jobs, interaction
+from app.config import Config
+from import_data import Colors, print_header, print_info, print_success, print_warning, print_error
+
+
+def print_drift(report, limit=20):
+    """打印重建报告中的偏差明细"""
+    if report['drifted'] == 0:
+        print_success("未发现偏差")
+        return
+
+    print_warning(f"{report['drifted']} 个文档存在偏差，共 {len(report['drift'])} 处:")
+    for item in report['drift'][:limit]:
+        print(f"  {item['id']}.{item['field']}: 期望 {item['expected']}，实际 {item['actual']}")
+    if len(report['drift']) > limit:
+        print_info(f"另有 {len(report['drift']) - limit} 处偏差未显示")
+
+
+def rebuild_rollups(args):
+    """从会话集合全量重建看板汇总"""
+    db = get_db()
+    report = rollups.rebuild(db, dry_run=args.dry_run)
+    print_info(f"汇总文档数: {Colors.BOLD}{report['documents']}{Colors.ENDC}")
+    print_drift(report)
+    if not args.dry_run:
+        print_success("看板汇总已重建")
+
+
+def rebuild_cube(args):
+    """从会话集合全量重建按天分桶的指标立方体"""
+    db = get_db()
+    report = cube.rebuild(db, dry_run=args.dry_run)
+    print_info(f"日桶文档数: {Colors.BOLD}{report['documents']}{Colors.ENDC}")
+    print_drift(report)
+    if not args.dry_run:
+        print_success("指标立方体已重建")
+
+
+def rebuild_cooccurrence(args):
+    """从会话集合全量重建标签共现矩阵"""
+    db = get_db()
+    report = cooccurrence.rebuild(db, dry_run=args.dry_run)
+    print_info(f"标签对数: {Colors.BOLD}{report['documents']}{Colors.ENDC}")
+    print_drift(report)
+    if not args.dry_run:
+        print_success("标签共现矩阵已重建")
+
+
+def rebuild_hotwords(args):
+    """从会话集合全量重建热词摘要"""
+    db = get_db()
+    report = hotwords.rebuild(db, dry_run=args.dry_run)
+    print_info(f"热词统计范围数: {Colors.BOLD}{report['documents']}{Colors.ENDC}")
+    print_drift(report)
+    if not args.dry_run:
+        print_success("热词摘要已重建")
+
+
+def ensure_indexes(args):
+    """按索引注册表同步创建全部索引"""
+    db = get_db()
+    report = indexes.ensure_indexes(db)
+    for name in report['created']:
+        print_info(f"索引就绪: {name}")
+    for item in report['failed']:
+        print_error(f"索引创建失败: {item['name']}: {item['error']}")
+    if not report['failed']:
+        print_success(f"全部 {len(report['created'])} 个索引已就绪")
+
+
+def advise_indexes(args):
+    """对各接口的典型查询运行explain并报告索引问题"""
+    db = get_db()
+    results = indexes.advise(db, max_ratio=args.max_ratio, limit=args.limit)
+    if not results:
+        print_warning("会话集合为空，无法生成示例查询")
+        return
+
+    flagged = 0
+    for result in results:
+        summary = (
+            f"{result['name']}: {' <- '.join(result['stages'])}，"
+            f"索引 {', '.join(result['indexes']) or '无'}，"
+            f"检查文档 {result['docsExamined']} / 返回 {result['nReturned']}"
+        )
+        if result['problems']:
+            flagged += 1
+            print_warning(f"{summary}\n    问题: {'；'.join(result['problems'])}")
+        else:
+            print_info(summary)
+
+    if flagged:
+        print_warning(f"{flagged} 个查询存在索引问题，请运行 ensure-indexes 或调整索引注册表")
+    else:
+        print_success("所有典型查询均命中索引")
+
+
+def reindex_search(args):
+    """为已有会话重新生成全文检索词"""
+    db = get_db()
+    report = search.reindex(db, batch_size=args.batch_size, only_missing=args.missing_only)
+    print_info(f"处理会话数: {Colors.BOLD}{report['documents']}{Colors.ENDC}")
+    print_success(f"检索词已更新: {report['updated']} 个会话")
+
+
+def derive_interactions(args):
+    """由消息列表并行重算已有会话的交互指标"""
+    db = get_db()
+    started = time.perf_counter()
+
+    def progress(report):
+        elapsed = time.perf_counter() - started
+        print_info(f"已处理 {report['documents']} 个会话，更新 {report['updated']}，{report['documents'] / elapsed:.0f} 个/秒")
+
+    report = interaction.backfill(
+        db,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        max_in_flight=args.max_in_flight,
+        only_missing=args.missing_only,
+        apply_stats=not args.no_stats,
+        progress=progress
+    )
+    print_info(f"处理会话数: {Colors.BOLD}{report['documents']}{Colors.ENDC}，耗时 {time.perf_counter() - started:.1f}s")
+    print_success(f"交互指标已更新: {report['updated']} 个会话")
+
+
+def ingest_excel(args):
+    """并行解析客服系统导出的Excel工作簿并写入会话集合"""
+    db = get_db()
+    started = time.perf_counter()
+
+    def progress(report):
+        elapsed = time.perf_counter() - started
+        print_info(f"已处理 {report['rows']} 行，新增 {report['inserted']}，{report['rows'] / elapsed:.0f} 行/秒")
+
+    report = transcripts.ingest_workbook(
+        db, args.file,
+        sheet=args.sheet,
+        chunk_size=args.chunk_size,
+        workers=args.workers,
+        max_in_flight=args.max_in_flight,
+        replace=args.replace,
+        apply_stats=not args.no_stats,
+        progress=progress
+    )
+
+    print_info(
+        f"共 {report['rows']} 行: 新增 {report['inserted']}，更新 {report['updated']}，跳过 {report['skipped']}，"
+        f"失败 {report['error']}"
+    )
+    for error in report['errors']:
+        location = f"第 {error['row']} 行" if error['row'] else "写入"
+        print_warning(f"{location} {error['id'] or ''}: {error['error']}")
+    if args.no_stats:
+        print_warning("导入时未同步派生统计，请运行 rebuild-rollups、rebuild-cube、rebuild-cooccurrence、rebuild-hotwords")
+    print_success(f"导入完成，耗时 {time.perf_counter() - started:.1f}s")
+
+
+def enrich(args):
+    """并发调用模型分析尚未生成指标的会话"""
+    db = get_db()
+    pending = db.conversations.count_documents(enrichment.pending_query(args.retry_failed, args.reprocess))
+    total = min(pending, args.limit) if args.limit else pending
+    if total == 0:
+        print_success("没有待分析的会话")
+        return
+    print_info(f"待分析会话: {Colors.BOLD}{total}{Colors.ENDC}，模型 {args.model}，并发 {args.concurrency}，"
+               f"每分钟调用上限 {args.rate or '不限'}")
+
+    client = enrichment.load_client(
+        args.client, args.model,
+        base_url=args.base_url,
+        api_key=Config.ENRICH_API_KEY,
+        timeout=Config.ENRICH_TIMEOUT
+    )
+
+    def progress(report):
+        print_info(
+            f"已处理 {report['processed']}/{total}，失败 {report['failed']}，重试 {report['retries']}，"
+            f"{report['perMinute']:.1f} 个/分钟，{report['tokens']} tokens"
+        )
+
+    report = enrichment.enrich(
+        db, client, args.model,
+        limit=args.limit,
+        retry_failed=args.retry_failed,
+        reprocess=args.reprocess,
+        concurrency=args.concurrency,
+        rate_per_minute=args.rate,
+        burst=args.burst,
+        max_retries=args.max_retries,
+        backoff_base=Config.ENRICH_BACKOFF_BASE,
+        backoff_max=Config.ENRICH_BACKOFF_MAX,
+        timeout=Config.ENRICH_TIMEOUT,
+        batch_size=args.batch_size,
+        use_cache=not args.no_cache,
+        progress=progress
+    )
+
+    print_info(
+        f"共处理 {report['processed']} 个会话: 成功 {report['succeeded']}，失败 {report['failed']}；"
+        f"模型调用 {report['calls']} 次，重试 {report['retries']} 次，限流等待 {report['rateLimitWaitSeconds']:.1f}s"
+    )
+    print_info(
+        f"缓存命中 {report['cacheHits']} 次，未命中 {report['cacheMisses']} 次，命中率 {report['cacheHitRate']:.1%}，"
+        f"节省 {report['tokensSaved']} tokens"
+    )
+    print_info(
+        f"耗时 {report['elapsed']:.1f}s，{report['perMinute']:.1f} 个/分钟，共 {report['tokens']} tokens，"
+        f"成本约 {report['cost']:.4f}"
+    )
+    if report['failed']:
+        print_warning("部分会话分析失败，失败原因记录在会话的enrichment.error中，可使用 --retry-failed 重新处理")
+    else:
+        print_success("会话分析完成")
+
+
+def llm_cache_stats(args):
+    """按提示词版本和模型统计模型结果缓存"""
+    db = get_db()
+    rows = enrichment.cache.cache_stats(db)
+    if not rows:
+        print_warning("模型结果缓存为空")
+        return
+    for row in rows:
+        label = '当前' if row['current'] else '旧版本'
+        print_info(
+            f"{row['promptVersion']} ({label}) / {row['model']}: 条目 {row['entries']}，"
+            f"累计命中 {row['hits']}，节省 {row['tokensSaved']} tokens"
+        )
+
+
+def compact_llm_cache(args):
+    """清理旧提示词版本和长期未命中的模型结果缓存"""
+    db = get_db()
+    count = enrichment.cache.compact(db, older_than_days=args.older_than, dry_run=args.dry_run)
+    if args.dry_run:
+        print_info(f"将删除 {count} 个缓存条目")
+    else:
+        print_success(f"已删除 {count} 个缓存条目")
+
+
+def backfill_llm_usage(args):
+    """按会话上已有的token_usage回填分析任务之前的历史用量"""
+    db = get_db()
+    count = enrichment.usage.backfill(db, model=args.model)
+    print_success(f"已回填 {count} 行历史用量")
+
+
+def enqueue(args):
+    """向任务队列提交任务"""
+    db = get_db()
+    job_id = jobs.enqueue(
+        db, args.type,
+        params=json.loads(args.params) if args.params else None,
+        priority=args.priority,
+        max_attempts=args.max_attempts,
+        delay=args.delay
+    )
+    print_success(f"任务已提交: {job_id}")
+
+
+def worker(args):
+    """从任务队列领取并执行任务，收到SIGTERM或Ctrl+C后执行完当前任务再退出"""
+    db = get_db()
+    types = [item.strip() for item in args.types.split(',') if item.strip()] if args.types else None
+    for job_type in types or []:
+        if job_type not in jobs.HANDLERS:
+            print_error(f"未知的任务类型: {job_type}，可选 {', '.join(jobs.HANDLERS)}")
+            return
+
+    job_worker = jobs.Worker(db, types=types, lease_seconds=args.lease, poll_interval=args.poll)
+
+    def shutdown(signum, frame):
+        print_warning("收到停止信号，执行完当前任务后退出")
+        job_worker.stop()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    print_info(f"工作进程 {job_worker.worker_id} 已启动，任务类型: {', '.join(types or jobs.HANDLERS)}")
+    executed = job_worker.run(max_jobs=args.max_jobs)
+    print_success(f"工作进程已退出，共执行 {executed} 个任务")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ConvoInsight管理命令')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_rollups = subparsers.add_parser('rebuild-rollups', help='从会话集合全量重建看板汇总并报告偏差')
+    parser_rollups.add_argument('--dry-run', action='store_true', help='只报告偏差，不写入')
+    parser_rollups.set_defaults(func=rebuild_rollups)
+
+    parser_cube = subparsers.add_parser('rebuild-cube', help='从会话集合全量重建按天分桶的指标立方体并报告偏差')
+    parser_cube.add_argument('--dry-run', action='store_true', help='只报告偏差，不写入')
+    parser_cube.set_defaults(func=rebuild_cube)
+
+    parser_pairs = subparsers.add_parser('rebuild-cooccurrence', help='从会话集合全量重建标签共现矩阵并报告偏差')
+    parser_pairs.add_argument('--dry-run', action='store_true', help='只报告偏差，不写入')
+    parser_pairs.set_defaults(func=rebuild_cooccurrence)
+
+    parser_hotwords = subparsers.add_parser('rebuild-hotwords', help='从会话集合全量重建热词摘要并报告全局Top热词偏差')
+    parser_hotwords.add_argument('--dry-run', action='store_true', help='只报告偏差，不写入')
+    parser_hotwords.set_defaults(func=rebuild_hotwords)
+
+    parser_ensure = subparsers.add_parser('ensure-indexes', help='按索引注册表同步创建全部索引')
+    parser_ensure.set_defaults(func=ensure_indexes)
+
+    parser_advise = subparsers.add_parser('advise-indexes', help='对各接口的典型查询运行explain，标记全表扫描和扫描返回比过高的查询')
+    parser_advise.add_argument('--max-ratio', type=float, default=10, help='docsExamined/nReturned 告警阈值，默认10')
+    parser_advise.add_argument('--limit', type=int, default=10, help='每个查询读取的文档数，默认10')
+    parser_advise.set_defaults(func=advise_indexes)
+
+    parser_search = subparsers.add_parser('reindex-search', help='为已有会话重新生成全文检索词')
+    parser_search.add_argument('--missing-only', action='store_true', help='只处理缺少检索词的会话')
+    parser_search.add_argument('--batch-size', type=int, default=500, help='每批写入的文档数，默认500')
+    parser_search.set_defaults(func=reindex_search)
+
+    parser_interaction = subparsers.add_parser('derive-interactions', help='由消息列表并行重算已有会话的交互指标')
+    parser_interaction.add_argument('--missing-only', action='store_true', help='只处理还没有时间指标的会话')
+    parser_interaction.add_argument('--batch-size', type=int, default=Config.INGEST_BATCH_SIZE,
+                                    help=f'每批的会话数，默认{Config.INGEST_BATCH_SIZE}')
+    parser_interaction.add_argument('--workers', type=int, help='工作进程数，默认CPU核数')
+    parser_interaction.add_argument('--max-in-flight', type=int, help='同时在途的批数上限，默认工作进程数的2倍')
+    parser_interaction.add_argument('--no-stats', action='store_true', help='不同步派生统计，完成后运行rebuild-*命令')
+    parser_interaction.set_defaults(func=derive_interactions)
+
+    parser_excel = subparsers.add_parser('ingest-excel', help='并行解析客服系统导出的Excel工作簿并写入会话集合')
+    parser_excel.add_argument('file', help='导出的xlsx文件，需包含会话ID和会话详情内容列')
+    parser_excel.add_argument('--sheet', help='工作表名称，默认第一个工作表')
+    parser_excel.add_argument('--chunk-size', type=int, default=Config.EXCEL_CHUNK_SIZE,
+                              help=f'每个分块的行数，默认{Config.EXCEL_CHUNK_SIZE}')
+    parser_excel.add_argument('--workers', type=int, default=Config.EXCEL_WORKERS, help='工作进程数，默认CPU核数')
+    parser_excel.add_argument('--max-in-flight', type=int, default=Config.EXCEL_MAX_IN_FLIGHT,
+                              help='同时在途的分块数上限，默认工作进程数的2倍')
+    parser_excel.add_argument('--replace', action='store_true', help='更新源内容有变化的已有会话，默认跳过全部已有会话')
+    parser_excel.add_argument('--no-stats', action='store_true', help='导入时不同步派生统计，导入后运行rebuild-*命令')
+    parser_excel.set_defaults(func=ingest_excel)
+
+    parser_enqueue = subparsers.add_parser('enqueue', help='向任务队列提交任务')
+    parser_enqueue.add_argument('type', choices=list(jobs.HANDLERS), help='任务类型')
+    parser_enqueue.add_argument('--params', help='任务参数（JSON对象），如 \'{"limit": 100}\'')
+    parser_enqueue.add_argument('--priority', type=int, default=0, help='优先级，数值大的先执行，默认0')
+    parser_enqueue.add_argument('--max-attempts', type=int, help=f'最大尝试次数，默认{Config.JOBS_MAX_ATTEMPTS}')
+    parser_enqueue.add_argument('--delay', type=float, default=0, help='延迟执行的秒数')
+    parser_enqueue.set_defaults(func=enqueue)
+
+    parser_worker = subparsers.add_parser('worker', help='从任务队列领取并执行任务，可在多台主机上同时运行')
+    parser_worker.add_argument('--types', help='只执行这些类型的任务，逗号分隔，默认全部')
+    parser_worker.add_argument('--max-jobs', type=int, help='执行指定数量的任务后退出，默认持续运行')
+    parser_worker.add_argument('--lease', type=float, default=Config.JOBS_LEASE_SECONDS,
+                               help=f'租约时长（秒），默认{Config.JOBS_LEASE_SECONDS:g}')
+    parser_worker.add_argument('--poll', type=float, default=Config.JOBS_POLL_INTERVAL,
+                               help=f'空闲时的轮询间隔（秒），默认{Config.JOBS_POLL_INTERVAL:g}')
+    parser_worker.set_defaults(func=worker)
+
+    parser_enrich = subparsers.add_parser('enrich', help='并发调用模型分析尚未生成指标的会话')
+    parser_enrich.add_argument('--limit', type=int, help='最多处理的会话数，默认全部')
+    parser_enrich.add_argument('--concurrency', type=int, default=Config.ENRICH_CONCURRENCY,
+                               help=f'同时分析的会话数，默认{Config.ENRICH_CONCURRENCY}')
+    parser_enrich.add_argument('--rate', type=float, default=Config.ENRICH_RATE_PER_MINUTE,
+                               help='每分钟最多发起的模型调用数，0为不限')
+    parser_enrich.add_argument('--burst', type=int, default=Config.ENRICH_BURST,
+                               help=f'允许的瞬时突发调用数，默认{Config.ENRICH_BURST}')
+    parser_enrich.add_argument('--max-retries', type=int, default=Config.ENRICH_MAX_RETRIES,
+                               help=f'单次调用的最大重试次数，默认{Config.ENRICH_MAX_RETRIES}')
+    parser_enrich.add_argument('--batch-size', type=int, default=Config.ENRICH_BATCH_SIZE,
+                               help=f'每批写回的会话数，默认{Config.ENRICH_BATCH_SIZE}')
+    parser_enrich.add_argument('--model', default=Config.ENRICH_MODEL, help=f'模型名称，默认{Config.ENRICH_MODEL}')
+    parser_enrich.add_argument('--client', default=Config.ENRICH_CLIENT, help='模型客户端：openai或"模块路径:类名"')
+    parser_enrich.add_argument('--base-url', default=Config.ENRICH_BASE_URL, help='OpenAI兼容接口地址，可指向本地模拟服务')
+    parser_enrich.add_argument('--retry-failed', action='store_true', help='重新处理之前分析失败的会话')
+    parser_enrich.add_argument('--reprocess', action='store_true',
+                               help='重新分析未用当前提示词版本处理过的会话，未受影响的阶段由缓存返回')
+    parser_enrich.add_argument('--no-cache', action='store_true', default=not Config.LLM_CACHE_ENABLED,
+                               help='不使用模型结果缓存')
+    parser_enrich.set_defaults(func=enrich)
+
+    parser_cache_stats = subparsers.add_parser('llm-cache-stats', help='按提示词版本和模型统计模型结果缓存')
+    parser_cache_stats.set_defaults(func=llm_cache_stats)
+
+    parser_compact = subparsers.add_parser('compact-llm-cache', help='清理旧提示词版本和长期未命中的模型结果缓存')
+    parser_compact.add_argument('--older-than', type=float, help='同时删除超过指定天数未命中的条目')
+    parser_compact.add_argument('--dry-run', action='store_true', help='只统计将删除的条目数')
+    parser_compact.set_defaults(func=compact_llm_cache)
+
+    parser_backfill_usage = subparsers.add_parser('backfill-llm-usage', help='按会话上的token_usage回填历史模型用量')
+    parser_backfill_usage.add_argument('--model', default='legacy', help='历史数据使用的模型名称，用于按单价估算成本')
+    parser_backfill_usage.set_defaults(func=backfill_llm_usage)
+
+    args = parser.parse_args()
+
+    print_header(f"ConvoInsight管理命令: {args.command}")
+    app = create_app()
+    with app.app_context():
+        args.func(args)
+
+
+if __name__ == '__main__':
+    main()